@@ -0,0 +1,103 @@
+"""
+End-of-day reconciliation throughput: N claims sent one by one to
+/api/prevalidation vs. in one /api/prevalidation/batch request, against a
+seeded SQLite file, through the in-process ASGI app.
+
+Run from the app directory:
+    python -m benchmarks.bench_batch_prevalidation [--claims 2000] [--patients 500] [--workers 0]
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+ITEM_LINES = [
+    ("MED015CA", "medicine", 5, 30), ("LAB01", "lab", 240, 1), ("MED001IVFES", "medicine", 70, 4),
+    ("IPDB1", "other", 900, 2), ("ASD05", "other", 800, 1), ("LAB02", "lab", 150, 1),
+]
+
+
+def _claim(patient: str, visit: date) -> dict:
+    lines = random.sample(ITEM_LINES, 3)
+    return {
+        "username": "u", "password": "p", "patient_id": patient, "visit_date": visit.isoformat(),
+        "service_type": random.choice(["OPD", "OPD", "IPD"]), "service_code": "S1", "doctor_nmc": "1",
+        "diagnosis": {}, "icd_codes": ["A00"], "hospital_type": "government", "claim_time": "discharge",
+        "department": "med", "claim_code": "C1",
+        "claimable_items": [
+            {"type": kind, "item_code": code, "quantity": qty, "cost": cost, "name": code.lower(), "category": "item"}
+            for code, kind, cost, qty in lines
+        ],
+    }
+
+
+def _seed(patients: int):
+    from insurance_database import ImisResponse, PatientInformation, SessionLocal
+    from services.usage_ledger import backfill_usage_ledger
+
+    random.seed(21)
+    db = SessionLocal()
+    base = datetime(2026, 6, 1)
+    for n in range(patients):
+        code = f"P{n}"
+        db.add(PatientInformation(patient_code=code, patient_uuid=f"u{n}", copayment="10", allowed_money=100000, used_money=0))
+        for _ in range(4):
+            stamp = base + timedelta(days=random.randint(0, 120))
+            code_, kind, cost, qty = random.choice(ITEM_LINES)
+            db.add(ImisResponse(
+                patient_id=code, claim_code="C", status="accepted", created_at=stamp, fetched_at=stamp,
+                service_type="OPD", service_code="S1", department="med", items=[], raw_response={},
+                item_code=[{"item_code": code_, "name": code_.lower(), "qty": qty, "cost": cost}],
+            ))
+    db.commit()
+    backfill_usage_ledger(db)
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--claims", type=int, default=2000)
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+    os.environ["MY_API_KEYS"] = "bench"
+    os.environ["BATCH_PROCESS_WORKERS"] = str(args.workers)
+    os.environ["BATCH_PROCESS_MIN_CLAIMS"] = "1"
+    os.environ["BATCH_PREVALIDATION_MAX_CLAIMS"] = str(max(args.claims, 1))
+    from fastapi.testclient import TestClient
+    import main as app_main
+
+    _seed(args.patients)
+    claims = [
+        _claim(f"P{random.randrange(args.patients)}", date(2026, 10, 1) + timedelta(days=random.randint(0, 17)))
+        for _ in range(args.claims)
+    ]
+    headers = {"X-API-Key": "bench"}
+
+    with TestClient(app_main.app) as client, contextlib.redirect_stdout(io.StringIO()):
+        # Warm-up; also starts the worker processes when --workers is set
+        client.post("/api/prevalidation", json=claims[0], headers=headers)
+        client.post("/api/prevalidation/batch", json={"claims": claims[:64]}, headers=headers)
+        start = time.perf_counter()
+        single = [client.post("/api/prevalidation", json=c, headers=headers).status_code for c in claims]
+        single_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = client.post("/api/prevalidation/batch", json={"claims": claims}, headers=headers).json()
+        batch_s = time.perf_counter() - start
+
+    same = single == [r["status_code"] for r in batch["results"]]
+    print(f"{args.claims} claims, {args.patients} patients, workers={args.workers}")
+    print(f"single endpoint: {single_s:7.2f} s  ({args.claims / single_s:8.0f} claims/s)")
+    print(f"batch endpoint:  {batch_s:7.2f} s  ({args.claims / batch_s:8.0f} claims/s)   statuses match: {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Worker start-up time and resident memory of the catalogs: json.load of the
+JSON files vs. opening the compiled catalog.bin, at --entries synthetic
+entries per table (Linux, reads /proc/self/status).
+
+Run from the app directory:
+    python -m benchmarks.bench_catalog_load [--entries 50000]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+from rule_loader import get_all_items, get_all_services
+from services.catalog_binary import build_catalog_file
+
+_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+if sys.argv[1] == "json":
+    tables = [json.load(open(p, encoding="utf-8")) for p in sys.argv[2:]]
+    touched = [t[len(t) // 2]["name"] for t in tables]
+else:
+    from services.catalog_binary import CatalogFile
+    catalog = CatalogFile(sys.argv[2])
+    touched = [t.entry(len(t) // 2)["name"] for t in catalog.tables.values()]
+elapsed = time.perf_counter() - start
+rss_kb = next(int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmRSS"))
+print(elapsed, rss_kb)
+"""
+
+
+def _inflate(entries, size):
+    out = []
+    while len(out) < size:
+        src = random.choice(entries)
+        out.append(dict(src, code=f"{src['code']}-{len(out)}", name=f"{src['name']} {random.randint(1, 999)}"))
+    return out
+
+
+def _child(*args):
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, "-c", _CHILD, *args], cwd=cwd, capture_output=True, text=True, check=True)
+    elapsed, rss_kb = out.stdout.split()
+    return float(elapsed), int(rss_kb)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=50_000)
+    args = parser.parse_args()
+
+    random.seed(9)
+    items = _inflate(get_all_items(), args.entries)
+    services = _inflate(get_all_services(), args.entries)
+    tmp = tempfile.mkdtemp()
+    paths = [os.path.join(tmp, "items.json"), os.path.join(tmp, "services.json")]
+    for path, data in zip(paths, (items, services)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+    binary = build_catalog_file(os.path.join(tmp, "catalog.bin"), {
+        "items": ("medicines", items), "services": ("packages", services),
+    }, {})
+
+    print(f"{args.entries} entries per table; catalog.bin is {binary.stat().st_size / 1e6:.1f} MB")
+    for label, argv in (("json.load", ["json", *paths]), ("catalog.bin", ["bin", str(binary)])):
+        elapsed, rss_kb = _child(*argv)
+        print(f"{label:<12} {elapsed * 1000:8.1f} ms   RSS {rss_kb / 1024:6.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
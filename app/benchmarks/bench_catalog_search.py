@@ -0,0 +1,61 @@
+"""
+Catalog typeahead: linear `q in name.lower()` scan vs. the prebuilt
+CatalogSearchIndex, on a catalog inflated to --entries synthetic rows.
+
+Run from the app directory:
+    python -m benchmarks.bench_catalog_search [--entries 50000] [--runs 200]
+"""
+import argparse
+import random
+import time
+
+from rule_loader import get_all_items, get_all_services
+from services.catalog_search import CatalogSearchIndex
+
+QUERIES = ["pa", "dex", "dextrose 5", "inj", "500ml", "tab.", "lab", "xyzq", "ct scan", "amoxi"]
+
+
+def _catalog(size: int):
+    random.seed(5)
+    base = get_all_items() + get_all_services()
+    entries = []
+    while len(entries) < size:
+        src = random.choice(base)
+        entries.append(dict(src, code=f"{src['code']}-{len(entries)}", name=f"{src['name']} {random.randint(1, 999)}"))
+    return entries
+
+
+def _linear(entries, q, limit):
+    query = q.strip().lower()
+    return [e for e in entries if query in e.get("name", "").lower()][:limit]
+
+
+def _time(fn, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=50_000)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=15)
+    args = parser.parse_args()
+
+    entries = _catalog(args.entries)
+    start = time.perf_counter()
+    index = CatalogSearchIndex(entries)
+    print(f"{len(entries)} entries, index built in {(time.perf_counter() - start) * 1000:.0f} ms\n")
+
+    print(f"{'query':<12} {'matches':>8} {'linear ms':>10} {'index ms':>9}")
+    for q in QUERIES:
+        matches = len(index.search(q, len(entries)))
+        linear = _time(lambda: _linear(entries, q, args.limit), max(1, args.runs // 20))
+        indexed = _time(lambda: index.search(q, args.limit), args.runs)
+        print(f"{q:<12} {matches:>8} {linear * 1000:>10.2f} {indexed * 1000:>9.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Query plans and timings for the claim-history access patterns, with and
+without the indexes declared in insurance_database, on a seeded SQLite file.
+
+Run from the app directory:
+    python -m benchmarks.bench_claim_queries [--claims 1000000] [--patients 50000]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+from insurance_database import Base
+
+QUERIES = {
+    "last OPD ticket": (
+        "SELECT id FROM imis_responses WHERE patient_id = :p AND service_type = 'OPD' "
+        "AND status NOT IN ('rejected', 'unknown') ORDER BY created_at ASC LIMIT 1"
+    ),
+    "patient history": "SELECT id, claim_code FROM imis_responses WHERE patient_id = :p ORDER BY claim_code DESC",
+    "patient by uuid": "SELECT id FROM patient_information WHERE patient_uuid = :u",
+    "pending claims": "SELECT id FROM imis_responses WHERE status = 'pending' ORDER BY fetched_at LIMIT 100",
+    "item units in window": (
+        "SELECT l.item_code, SUM(l.qty) FROM patient_usage_ledger l "
+        "JOIN imis_responses r ON r.id = l.imis_response_id "
+        "WHERE l.patient_code = :p AND l.item_code IN ('MED015CA', 'LAB01') "
+        "AND l.service_date BETWEEN :start AND :end AND r.status NOT IN ('rejected', 'unknown') "
+        "GROUP BY l.item_code"
+    ),
+    "claim lines of claim": "SELECT * FROM claim_lines WHERE imis_response_id = :c ORDER BY sequence",
+}
+
+STATUSES = ["accepted", "accepted", "accepted", "pending", "rejected", "unknown"]
+SERVICE_TYPES = ["OPD", "OPD", "IPD", "ER"]
+ITEM_CODES = ["MED015CA", "LAB01", "LAB02", "MED001IVFES", "IPDB1", "ASD05"]
+
+
+def _seed(engine, claims: int, patients: int, chunk: int = 50000):
+    random.seed(11)
+    base = datetime(2025, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO patient_information (id, patient_code, patient_uuid, created_at) VALUES (:id, :code, :uuid, :at)"
+        ), [{"id": i, "code": f"P{i}", "uuid": f"uuid-{i}", "at": base} for i in range(1, patients + 1)])
+
+    claim_id = 0
+    while claim_id < claims:
+        rows, lines, ledger = [], [], []
+        for _ in range(min(chunk, claims - claim_id)):
+            claim_id += 1
+            patient = f"P{random.randint(1, patients)}"
+            stamp = base + timedelta(minutes=random.randint(0, 60 * 24 * 600))
+            items = [{"item_code": random.choice(ITEM_CODES), "name": "X", "qty": 1, "cost": 100} for _ in range(3)]
+            rows.append({
+                "id": claim_id, "patient_id": patient, "claim_code": f"C{claim_id:08d}",
+                "status": random.choice(STATUSES), "created_at": stamp, "fetched_at": stamp,
+                "service_type": random.choice(SERVICE_TYPES), "item_code": json.dumps(items),
+            })
+            for seq, item in enumerate(items, start=1):
+                lines.append({"r": claim_id, "seq": seq, "code": item["item_code"]})
+                ledger.append({"p": patient, "r": claim_id, "code": item["item_code"], "d": stamp.date()})
+        with engine.begin() as conn:
+            conn.execute(text(
+                "INSERT INTO imis_responses (id, patient_id, claim_code, status, created_at, fetched_at, service_type, item_code) "
+                "VALUES (:id, :patient_id, :claim_code, :status, :created_at, :fetched_at, :service_type, :item_code)"
+            ), rows)
+            conn.execute(text(
+                "INSERT INTO claim_lines (imis_response_id, sequence, item_code, qty, cost) VALUES (:r, :seq, :code, 1, 100)"
+            ), lines)
+            conn.execute(text(
+                "INSERT INTO patient_usage_ledger (patient_code, imis_response_id, item_code, service_date, qty, amount) "
+                "VALUES (:p, :r, :code, :d, 1, 100)"
+            ), ledger)
+        print(f"  seeded {claim_id} claims", flush=True)
+
+
+def _set_indexes(engine, enabled: bool):
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if enabled:
+                    index.create(bind=conn, checkfirst=True)
+                else:
+                    index.drop(bind=conn, checkfirst=True)
+        conn.execute(text("ANALYZE"))
+
+
+def _measure(engine, patients: int, runs: int):
+    results = {}
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            def params():
+                n = random.randint(1, patients)
+                return {"p": f"P{n}", "u": f"uuid-{n}", "c": n, "start": "2025-06-01", "end": "2025-09-01"}
+            plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql), params()).fetchall()
+            start = time.perf_counter()
+            for _ in range(runs):
+                conn.execute(text(sql), params()).fetchall()
+            elapsed = (time.perf_counter() - start) / runs
+            results[name] = (elapsed, " | ".join(row[-1] for row in plan))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--claims", type=int, default=1_000_000)
+    parser.add_argument("--patients", type=int, default=50_000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    print(f"Seeding {args.claims} claims for {args.patients} patients into {path}")
+    _seed(engine, args.claims, args.patients)
+
+    _set_indexes(engine, False)
+    before = _measure(engine, args.patients, max(1, args.runs // 10))
+    _set_indexes(engine, True)
+    after = _measure(engine, args.patients, args.runs)
+
+    for name in QUERIES:
+        (t0, plan0), (t1, plan1) = before[name], after[name]
+        print(f"\n{name}: {t0 * 1000:.2f} ms -> {t1 * 1000:.3f} ms")
+        print(f"  without indexes: {plan0}")
+        print(f"  with indexes:    {plan1}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Per-claim-line catalog lookup cost under concurrency: the old locked,
+two-probe path (get_items() then get_services() behind _cache_lock) vs. the
+snapshot's single-probe lookup_code().
+
+Run from the app directory:
+    python -m benchmarks.bench_code_lookup [--lookups 200000] [--threads 1 4 16]
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import rule_loader
+
+
+def _locked_lookup_factory():
+    snapshot = rule_loader.get_snapshot()
+    items, services = snapshot.items.by_code, snapshot.services.by_code
+    lock = Lock()
+
+    def get_items(code):
+        with lock:
+            return items.get(str(code))
+
+    def get_services(code):
+        with lock:
+            return services.get(str(code))
+
+    return lambda code: get_items(code) or get_services(code)
+
+
+def _run(lookup, codes, threads):
+    chunk = len(codes) // threads
+
+    def work(part):
+        for code in part:
+            lookup(code)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(work, [codes[i * chunk:(i + 1) * chunk] for i in range(threads)]))
+    return (time.perf_counter() - start) / (chunk * threads)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lookups", type=int, default=200_000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    snapshot = rule_loader.get_snapshot()
+    pool = list(snapshot.items.by_code) + list(snapshot.services.by_code) + ["UNKNOWN"]
+    random.seed(3)
+    codes = [random.choice(pool) for _ in range(args.lookups)]
+
+    lookups = {
+        "locked get_items/get_services": _locked_lookup_factory(),
+        "get_items() or get_services()": lambda c: rule_loader.get_items(c) or rule_loader.get_services(c),
+        "lookup_code()": rule_loader.lookup_code,
+        "snapshot.lookup_code()": snapshot.lookup_code,
+    }
+    print(f"{'path':<32}" + "".join(f"{f'{t} thr ns':>12}" for t in args.threads))
+    for name, fn in lookups.items():
+        row = [_run(fn, codes, t) * 1e9 for t in args.threads]
+        print(f"{name:<32}" + "".join(f"{ns:>12.0f}" for ns in row))
+
+
+if __name__ == "__main__":
+    main()
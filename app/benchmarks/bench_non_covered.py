@@ -0,0 +1,92 @@
+"""
+Non-covered service detection: per-rule substring scan vs. the compiled
+Aho-Corasick matcher, on large IPD claims.
+
+Run from the app directory:
+    python -m benchmarks.bench_non_covered [--lines 500] [--history 200] [--rules 50]
+"""
+import argparse
+import random
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from rule_loader import get_all_items, get_all_services, get_rules
+from services.rule_engine import compile_rules
+
+
+def _naive(lines, history, non_covered):
+    hits = 0
+    for name in lines:
+        for nc in non_covered:
+            if nc["name"].lower() in name.lower() and not nc["claimable"]:
+                if nc.get("annual_cost_threshold_npr"):
+                    sum(
+                        Decimal(str(x.get("qty", 0))) * Decimal(str(x.get("rate", 0)))
+                        for prev in history
+                        for x in prev
+                        if nc["name"].lower() in x.get("name", "").lower()
+                    )
+                hits += 1
+    return hits
+
+
+def _compiled(lines, history, compiled):
+    hits = 0
+    spent = None
+    for name in lines:
+        for nc in compiled.match_non_covered(name.lower()):
+            if not nc.claimable:
+                if nc.annual_cost_threshold_npr and spent is None:
+                    spent = defaultdict(Decimal)
+                    for prev in history:
+                        for x in prev:
+                            for match in compiled.match_non_covered(x.get("name", "").lower()):
+                                spent[match.name] += Decimal(str(x.get("qty", 0))) * Decimal(str(x.get("rate", 0)))
+                hits += 1
+    return hits
+
+
+def _best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=500, help="claim lines per IPD claim")
+    parser.add_argument("--history", type=int, default=200, help="previous claims for the patient")
+    parser.add_argument("--rules", type=int, default=50, help="non-covered entries (real ones padded with catalog names)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(7)
+    catalog_names = [e["name"] for e in get_all_items() + get_all_services()]
+    rules = dict(get_rules())
+    non_covered = list(rules["non_covered_services"]["items"])
+    for name in random.sample(catalog_names, max(0, args.rules - len(non_covered))):
+        non_covered.append({"name": name.split()[0], "claimable": False, "annual_cost_threshold_npr": 1000})
+    rules["non_covered_services"] = dict(rules["non_covered_services"], items=non_covered)
+    compiled = compile_rules(rules)
+
+    lines = random.sample(catalog_names, min(args.lines, len(catalog_names)))
+    history = [
+        [{"name": random.choice(catalog_names), "qty": 1, "rate": 100} for _ in range(20)]
+        for _ in range(args.history)
+    ]
+
+    naive_t, naive_hits = _best_of(lambda: _naive(lines, history, non_covered), args.repeat)
+    compiled_t, compiled_hits = _best_of(lambda: _compiled(lines, history, compiled), args.repeat)
+    assert naive_hits == compiled_hits
+
+    print(f"lines={len(lines)} history_claims={len(history)} non_covered={len(non_covered)} matches={naive_hits}")
+    print(f"per-rule scan : {naive_t * 1000:9.2f} ms")
+    print(f"aho-corasick  : {compiled_t * 1000:9.2f} ms  ({naive_t / compiled_t:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""
+Compiles data/items.json and data/services.json into the memory-mapped
+catalog file rule_loader prefers over parsing JSON. Re-run after editing
+either JSON file (a stale catalog.bin is ignored).
+
+    python -m build_catalog [--out data/catalog.bin]
+"""
+import argparse
+
+from rule_loader import build_catalog_binary, catalog_binary_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default=str(catalog_binary_path()))
+    args = parser.parse_args()
+    path = build_catalog_binary(args.out)
+    print(f"Wrote {path} ({path.stat().st_size} bytes)")
+
+
+if __name__ == "__main__":
+    main()
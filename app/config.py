@@ -7,3 +7,165 @@ load_dotenv()
 def get_valid_api_keys() -> set[str]:
     keys = os.getenv("MY_API_KEYS", "")
     return {k.strip() for k in keys.split(",") if k.strip()}
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# IMIS HTTP client (shared, app-scoped connection pool)
+IMIS_MAX_CONNECTIONS = _env_int("IMIS_MAX_CONNECTIONS", 100)
+IMIS_MAX_KEEPALIVE_CONNECTIONS = _env_int("IMIS_MAX_KEEPALIVE_CONNECTIONS", 20)
+IMIS_KEEPALIVE_EXPIRY = _env_float("IMIS_KEEPALIVE_EXPIRY", 30.0)
+IMIS_HTTP2 = _env_bool("IMIS_HTTP2", True)
+IMIS_CONNECT_TIMEOUT = _env_float("IMIS_CONNECT_TIMEOUT", 5.0)
+
+# Per-operation read timeouts (seconds)
+IMIS_PATIENT_TIMEOUT = _env_float("IMIS_PATIENT_TIMEOUT", 20.0)
+IMIS_ELIGIBILITY_TIMEOUT = _env_float("IMIS_ELIGIBILITY_TIMEOUT", 30.0)
+IMIS_CLAIM_TIMEOUT = _env_float("IMIS_CLAIM_TIMEOUT", 60.0)
+IMIS_CLAIM_QUERY_TIMEOUT = _env_float("IMIS_CLAIM_QUERY_TIMEOUT", 30.0)
+
+# Adaptive timeouts for the read operations (claim submission keeps IMIS_CLAIM_TIMEOUT): p99 of recent
+# successful calls times a factor, between the minimum and the timeouts above
+IMIS_ADAPTIVE_TIMEOUTS = _env_bool("IMIS_ADAPTIVE_TIMEOUTS", True)
+IMIS_TIMEOUT_MIN = _env_float("IMIS_TIMEOUT_MIN", 5.0)
+IMIS_TIMEOUT_P99_FACTOR = _env_float("IMIS_TIMEOUT_P99_FACTOR", 3.0)
+IMIS_TIMEOUT_SAMPLES = _env_int("IMIS_TIMEOUT_SAMPLES", 200)
+IMIS_TIMEOUT_MIN_SAMPLES = _env_int("IMIS_TIMEOUT_MIN_SAMPLES", 20)
+
+# Circuit breaker per IMIS operation: rolling window of calls, trip rates and seconds open before probing
+IMIS_BREAKER_WINDOW = _env_int("IMIS_BREAKER_WINDOW", 50)
+IMIS_BREAKER_MIN_CALLS = _env_int("IMIS_BREAKER_MIN_CALLS", 10)
+IMIS_BREAKER_FAILURE_RATE = _env_float("IMIS_BREAKER_FAILURE_RATE", 0.5)
+IMIS_BREAKER_SLOW_CALL_SECONDS = _env_float("IMIS_BREAKER_SLOW_CALL_SECONDS", 15.0)
+IMIS_BREAKER_SLOW_CALL_RATE = _env_float("IMIS_BREAKER_SLOW_CALL_RATE", 0.8)
+IMIS_BREAKER_OPEN_SECONDS = _env_float("IMIS_BREAKER_OPEN_SECONDS", 30.0)
+IMIS_BREAKER_HALF_OPEN_PROBES = _env_int("IMIS_BREAKER_HALF_OPEN_PROBES", 3)
+
+# In-process IMIS response cache (TTL in seconds, 0 disables)
+IMIS_PATIENT_CACHE_TTL = _env_float("IMIS_PATIENT_CACHE_TTL", 300.0)
+IMIS_ELIGIBILITY_CACHE_TTL = _env_float("IMIS_ELIGIBILITY_CACHE_TTL", 60.0)
+IMIS_CACHE_MAXSIZE = _env_int("IMIS_CACHE_MAXSIZE", 5000)
+
+# Claim submission: requests per second per IMIS host (0 disables) and burst size
+IMIS_SUBMIT_RATE_LIMIT = _env_float("IMIS_SUBMIT_RATE_LIMIT", 10.0)
+IMIS_SUBMIT_RATE_BURST = _env_int("IMIS_SUBMIT_RATE_BURST", 10)
+
+# Bulk claim submission: claims per request and claims in flight to IMIS at once
+IMIS_BULK_MAX_CLAIMS = _env_int("IMIS_BULK_MAX_CLAIMS", 500)
+IMIS_BULK_CONCURRENCY = _env_int("IMIS_BULK_CONCURRENCY", 8)
+
+# Claim outbox worker: poll interval (s), claims sent at once, hours of retrying before giving up and backoff (s)
+OUTBOX_WORKER_ENABLED = _env_bool("OUTBOX_WORKER_ENABLED", True)
+OUTBOX_POLL_INTERVAL = _env_float("OUTBOX_POLL_INTERVAL", 2.0)
+OUTBOX_BATCH_SIZE = _env_int("OUTBOX_BATCH_SIZE", 8)
+OUTBOX_GIVE_UP_HOURS = _env_float("OUTBOX_GIVE_UP_HOURS", 48.0)
+OUTBOX_BACKOFF_BASE = _env_float("OUTBOX_BACKOFF_BASE", 5.0)
+OUTBOX_BACKOFF_MAX = _env_float("OUTBOX_BACKOFF_MAX", 900.0)
+# A queued claim keeps its submitter's IMIS password until it is final (up to OUTBOX_GIVE_UP_HOURS), so the
+# password sits in the database file, its WAL and every backup taken meanwhile. It is stored encrypted with this
+# Fernet key (Fernet.generate_key()); keep the key out of the database and its backups. Changing it fails the
+# claims still queued. Unset, /submit_claim/async is unavailable.
+OUTBOX_CREDENTIALS_KEY = os.getenv("OUTBOX_CREDENTIALS_KEY", "")
+
+# /patient/full-info: stored records younger than MAX_STALE are answered at once and refreshed in the
+# background once older than FRESH; when IMIS is down, records up to OUTAGE_MAX_AGE are served (seconds)
+ELIGIBILITY_STALE_WHILE_REVALIDATE = _env_bool("ELIGIBILITY_STALE_WHILE_REVALIDATE", True)
+ELIGIBILITY_FRESH_SECONDS = _env_float("ELIGIBILITY_FRESH_SECONDS", 60.0)
+ELIGIBILITY_MAX_STALE_SECONDS = _env_float("ELIGIBILITY_MAX_STALE_SECONDS", 6 * 3600.0)
+ELIGIBILITY_OUTAGE_MAX_AGE = _env_float("ELIGIBILITY_OUTAGE_MAX_AGE", 7 * 86400.0)
+
+# Cache-Control sent with the full /items and /services catalog (clients revalidate via ETag)
+CATALOG_CACHE_CONTROL = os.getenv("CATALOG_CACHE_CONTROL", "public, max-age=0, must-revalidate")
+
+# Seconds between checks of validation_rules.json / items.json / services.json for changes (0 disables)
+RULES_RELOAD_INTERVAL = _env_float("RULES_RELOAD_INTERVAL", 10.0)
+
+# Compiled catalog (python -m build_catalog); defaults to data/catalog.bin, used only while it matches the JSON files
+CATALOG_BINARY_PATH = os.getenv("CATALOG_BINARY_PATH", "")
+# Seconds between checks, in every worker, whether an existing catalog.bin is older than the JSON files; the
+# stale file is rebuilt under a per-host file lock, a missing one is never created (0 disables)
+CATALOG_REBUILD_INTERVAL = _env_float("CATALOG_REBUILD_INTERVAL", 300.0)
+
+# Batch prevalidation: claims per request, and worker processes for large batches (0 evaluates in a thread)
+BATCH_PREVALIDATION_MAX_CLAIMS = _env_int("BATCH_PREVALIDATION_MAX_CLAIMS", 5000)
+BATCH_PROCESS_WORKERS = _env_int("BATCH_PROCESS_WORKERS", 0)
+BATCH_PROCESS_MIN_CLAIMS = _env_int("BATCH_PROCESS_MIN_CLAIMS", 500)
+
+# Fiscal year start used for annual limits (Shrawan 1 falls around 16 July)
+FISCAL_YEAR_START_MONTH = _env_int("FISCAL_YEAR_START_MONTH", 7)
+FISCAL_YEAR_START_DAY = _env_int("FISCAL_YEAR_START_DAY", 16)
+
+# Database. Any SQLAlchemy URL; PostgreSQL (postgresql://...) is the production backend.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///insurance_database.db")
+DB_ECHO = _env_bool("DB_ECHO", False)
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 10)
+DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 20)
+DB_POOL_TIMEOUT = _env_float("DB_POOL_TIMEOUT", 30.0)
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", 1800)
+
+# SQLite tuning, applied on every new connection when DATABASE_URL is sqlite
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+SQLITE_FOREIGN_KEYS = _env_bool("SQLITE_FOREIGN_KEYS", True)
+
+# Retention (0 keeps rows forever). Patients are only pruned once they have no claim history or queued claims.
+RETENTION_INTERVAL = _env_float("RETENTION_INTERVAL", 3600.0)
+RETENTION_PATIENT_HOURS = _env_float("RETENTION_PATIENT_HOURS", 24.0)
+RETENTION_CLAIM_DAYS = _env_float("RETENTION_CLAIM_DAYS", 0)
+RETENTION_DOCUMENT_DAYS = _env_float("RETENTION_DOCUMENT_DAYS", 0)
+RETENTION_OUTBOX_DAYS = _env_float("RETENTION_OUTBOX_DAYS", 30.0)
+# Rows per delete transaction, pause between chunks (s) and chunks per table per run
+RETENTION_CHUNK_SIZE = _env_int("RETENTION_CHUNK_SIZE", 500)
+RETENTION_CHUNK_PAUSE = _env_float("RETENTION_CHUNK_PAUSE", 0.05)
+RETENTION_MAX_CHUNKS = _env_int("RETENTION_MAX_CHUNKS", 200)
+
+# Periodic jobs run once per cluster: a worker runs a job only while holding its lease in scheduled_jobs.
+# Disable on workers that should never run jobs.
+SCHEDULER_ENABLED = _env_bool("SCHEDULER_ENABLED", True)
+# How often each worker checks whether a job is due (capped at the job's interval)
+SCHEDULER_POLL_INTERVAL = _env_float("SCHEDULER_POLL_INTERVAL", 30.0)
+# Random delay added to startup and to every poll so workers do not all hit the table at once
+SCHEDULER_JITTER = _env_float("SCHEDULER_JITTER", 10.0)
+# A run's lease, renewed while it runs; a job whose worker died is taken over once it expires
+SCHEDULER_LEASE_SECONDS = _env_float("SCHEDULER_LEASE_SECONDS", 120.0)
+
+# Claim status sync: re-reads claims IMIS has not finished adjudicating, with a service account.
+# Disabled unless IMIS_SYNC_USERNAME is set.
+IMIS_SYNC_USERNAME = os.getenv("IMIS_SYNC_USERNAME", "")
+IMIS_SYNC_PASSWORD = os.getenv("IMIS_SYNC_PASSWORD", "")
+CLAIM_SYNC_INTERVAL = _env_float("CLAIM_SYNC_INTERVAL", 900.0)
+# Statuses that may still change in IMIS
+CLAIM_SYNC_PENDING_STATUSES = tuple(
+    s.strip() for s in os.getenv("CLAIM_SYNC_PENDING_STATUSES", "pending,entered,checked,processed,queued").split(",")
+    if s.strip()
+)
+# A claim is re-checked at most this often (seconds since it was last fetched)
+CLAIM_SYNC_MIN_AGE = _env_float("CLAIM_SYNC_MIN_AGE", 1800.0)
+# Claims read and updated per transaction, claims per run and IMIS lookups in flight
+CLAIM_SYNC_PAGE_SIZE = _env_int("CLAIM_SYNC_PAGE_SIZE", 100)
+CLAIM_SYNC_MAX_CLAIMS = _env_int("CLAIM_SYNC_MAX_CLAIMS", 2000)
+CLAIM_SYNC_CONCURRENCY = _env_int("CLAIM_SYNC_CONCURRENCY", 4)
+
+# Prometheus text-format metrics at GET /metrics (per worker process)
+METRICS_ENABLED = _env_bool("METRICS_ENABLED", True)
+# How often the event loop lag is sampled (seconds)
+METRICS_LOOP_LAG_INTERVAL = _env_float("METRICS_LOOP_LAG_INTERVAL", 0.5)
+
+# Async driver URL for the async endpoints; derived from DATABASE_URL when unset
+DATABASE_ASYNC_URL = os.getenv("DATABASE_ASYNC_URL", "")
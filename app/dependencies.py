@@ -1,6 +1,8 @@
 # app/dependencies.py
-from fastapi import Header, HTTPException, status
+import httpx
+from fastapi import Header, HTTPException, Request, status
 from config import get_valid_api_keys
+from services import imis_services
 import logging
 
 console=logging.getLogger("X-API-Key")
@@ -16,3 +18,8 @@ def get_api_key(api_key: str = Header(..., alias="X-API-Key")) -> str:
         )
     return api_key
 
+
+def get_imis_client(request: Request) -> httpx.AsyncClient:
+    """Shared IMIS client opened in the app lifespan."""
+    client = getattr(request.app.state, "imis_client", None)
+    return client or imis_services.get_imis_client()
@@ -1,7 +1,10 @@
-from sqlalchemy import (create_engine, Column, Integer, String, Float,Date, ForeignKey, JSON,Numeric)
+from sqlalchemy import (create_engine, event, inspect, text, Column, Integer, String, Float,Date, ForeignKey, JSON,Numeric, Index, Boolean, Text)
+from sqlalchemy.engine import make_url
 from sqlalchemy.types import DateTime
 from datetime import datetime
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import config
 Base = declarative_base()
 
 class PatientInformation(Base):
@@ -21,9 +24,17 @@ class PatientInformation(Base):
     policy_expiry = Column(String(20))
     imis_full_response = Column(JSON)
     eligibility_raw = Column(JSON)
+    eligibility_fetched_at = Column(DateTime)   # last successful IMIS refresh of the fields above
+    credentials_digest = Column(String(64))     # sha256 of the IMIS credentials that refresh was made with
+    needs_refresh = Column(Boolean)             # a claim changed used_money since; ask IMIS before serving the row
     created_at = Column(DateTime, default=datetime.utcnow)
     imis_responses = relationship("ImisResponse",    cascade="all, delete-orphan",passive_deletes=True,back_populates="patient")
 
+    __table_args__ = (
+        Index("ix_patient_information_patient_uuid", "patient_uuid"),
+        Index("ix_patient_information_created_at", "created_at"),
+    )
+
 
 class ImisResponse(Base):
     __tablename__ = "imis_responses"
@@ -42,6 +53,127 @@ class ImisResponse(Base):
     department=Column(String)
 
     patient = relationship("PatientInformation", back_populates="imis_responses")
+    lines = relationship("ClaimLine", cascade="all, delete-orphan", passive_deletes=True,
+                         back_populates="claim", order_by="ClaimLine.sequence")
+
+    __table_args__ = (
+        # last OPD ticket lookup in prevalidation
+        Index("ix_imis_responses_patient_type_created", "patient_id", "service_type", "created_at"),
+        # patient claim history, newest claim code first
+        Index("ix_imis_responses_patient_claim_code", "patient_id", "claim_code"),
+        # claims still awaiting adjudication, oldest first
+        Index("ix_imis_responses_status_fetched", "status", "fetched_at"),
+        Index("ix_imis_responses_claim_code", "claim_code"),
+        Index("ix_imis_responses_fetched_at", "fetched_at"),
+    )
+
+
+class ClaimLine(Base):
+    """Normalized claim lines of an ImisResponse (mirrors the `item_code` / `items` JSON)."""
+    __tablename__ = "claim_lines"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    imis_response_id = Column(Integer, ForeignKey("imis_responses.id", ondelete="CASCADE"), nullable=False)
+    sequence = Column(Integer, nullable=False)
+    item_code = Column(String(50), nullable=False)
+    name = Column(String(255))
+    qty = Column(Integer, default=0)
+    cost = Column(Numeric(12, 2), default=0)
+    category = Column(String(20))
+    type = Column(String(50))
+    adjudication_status = Column(String(50))
+
+    claim = relationship("ImisResponse", back_populates="lines")
+
+    __table_args__ = (
+        Index("ix_claim_lines_response_sequence", "imis_response_id", "sequence"),
+        Index("ix_claim_lines_item_code", "item_code"),
+    )
+
+
+class PatientUsageLedger(Base):
+    """
+    One row per submitted claim line, so validation caps can be answered with
+    indexed aggregates instead of scanning a patient's whole claim history.
+    A line in several non-covered buckets gets one more row per further
+    bucket, with its amount and no units.
+    """
+    __tablename__ = "patient_usage_ledger"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    patient_code = Column(String(20), ForeignKey("patient_information.patient_code", ondelete="CASCADE"), nullable=False)
+    imis_response_id = Column(Integer, ForeignKey("imis_responses.id", ondelete="CASCADE"), nullable=False)
+    item_code = Column(String(50), nullable=False)
+    service_date = Column(Date, nullable=False)
+    qty = Column(Integer, default=0)
+    amount = Column(Numeric(14, 2), default=0)
+    non_covered = Column(String(100))   # matched non-covered service bucket, if any
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_usage_patient_item_date", "patient_code", "item_code", "service_date"),
+        Index("ix_usage_patient_bucket_date", "patient_code", "non_covered", "service_date"),
+        Index("ix_usage_imis_response", "imis_response_id"),
+    )
+
+
+class ClaimOutbox(Base):
+    """
+    Claims waiting to be (re)sent to IMIS. Each row keeps one ACSN for all of
+    its attempts, so a retry after a timeout can be matched against a claim
+    IMIS already accepted. Credentials are cleared once the row is final.
+    """
+    __tablename__ = "claim_outbox"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String(64), unique=True, nullable=False)
+    acsn = Column(String(64), unique=True, nullable=False)
+    patient_id = Column(String(50), nullable=False)
+    claim_code = Column(String(50))
+    claim = Column(JSON, nullable=False)          # ClaimInput without credentials
+    payload = Column(JSON, nullable=False)        # FHIR Claim as sent
+    username = Column(String(100))
+    password = Column(String(255))                # Fernet token (OUTBOX_CREDENTIALS_KEY), cleared once final
+    status = Column(String(20), nullable=False, default="pending")  # pending, in_flight, succeeded, failed, dead
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = Column(DateTime)
+    needs_lookup = Column(Boolean, nullable=False, default=False)  # last attempt may have reached IMIS
+    last_status_code = Column(Integer)
+    last_error = Column(Text)
+    imis_response_id = Column(Integer, ForeignKey("imis_responses.id", ondelete="SET NULL"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = Column(DateTime)
+
+    __table_args__ = (
+        # worker poll: due rows, oldest first
+        Index("ix_claim_outbox_status_next_attempt", "status", "next_attempt_at"),
+        # retention of finished rows
+        Index("ix_claim_outbox_completed_at", "completed_at"),
+    )
+
+
+class ScheduledJob(Base):
+    """
+    One row per periodic job, shared by every worker. A worker runs the job
+    only after taking its lease (a conditional UPDATE), so each run happens
+    once per cluster; the last run's outcome is kept for the metrics.
+    """
+    __tablename__ = "scheduled_jobs"
+
+    name = Column(String(50), primary_key=True)
+    owner = Column(String(100))
+    lease_until = Column(DateTime)
+    next_run_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_started_at = Column(DateTime)
+    last_finished_at = Column(DateTime)
+    last_status = Column(String(20))              # succeeded, failed
+    last_duration = Column(Float)
+    last_error = Column(Text)
+    last_result = Column(JSON)                    # what the job returned, e.g. rows deleted per table
+    runs = Column(Integer, nullable=False, default=0)
+    failures = Column(Integer, nullable=False, default=0)
 
 
 class ClaimDocument(Base):
@@ -50,19 +182,125 @@ class ClaimDocument(Base):
     id = Column(Integer, primary_key=True)
     claim_id = Column(String, index=True)
     file_url = Column(String)
+    original_filename = Column(String)
+    file_size = Column(Integer)
     document_type = Column(String) 
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_claim_documents_created_at", "created_at"),
+    )
 
 
 #engine and sessions
-engine = create_engine("sqlite:///insurance_database.db", echo=True)
+def is_sqlite(url) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    # SQLite ignores ON DELETE CASCADE / SET NULL unless enabled per connection
+    cursor.execute(f"PRAGMA foreign_keys={'ON' if config.SQLITE_FOREIGN_KEYS else 'OFF'}")
+    cursor.close()
+
+
+def engine_options(url) -> dict:
+    """Pool and logging options for DATABASE_URL, tuned per backend."""
+    options = {"echo": config.DB_ECHO}
+    if is_sqlite(url):
+        # Sessions are opened in the threadpool and used on the event loop thread
+        options["connect_args"] = {"check_same_thread": False, "timeout": config.SQLITE_BUSY_TIMEOUT_MS / 1000}
+    else:
+        options.update(
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+    return options
+
+
+def create_db_engine(url: str = None):
+    url = url or config.DATABASE_URL
+    db_engine = create_engine(url, **engine_options(url))
+    if is_sqlite(url):
+        event.listen(db_engine, "connect", _apply_sqlite_pragmas)
+    return db_engine
+
+
+# Async drivers used for the same database by the async endpoints
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_database_url(url: str = None) -> str:
+    if config.DATABASE_ASYNC_URL and url is None:
+        return config.DATABASE_ASYNC_URL
+    parsed = make_url(url or config.DATABASE_URL)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name(), parsed.drivername)
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+def create_async_db_engine(url: str = None):
+    url = async_database_url(url)
+    db_engine = create_async_engine(url, **engine_options(url))
+    if is_sqlite(url):
+        event.listen(db_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+    return db_engine
+
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False,autoflush=False, bind=engine)
-session = SessionLocal()
+
+async_engine = create_async_db_engine()
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def ensure_indexes(bind):
+    """
+    create_all() only indexes tables it creates; this adds indexes declared
+    later to tables that already exist.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+
+def ensure_columns(bind):
+    """
+    create_all() does not alter existing tables; this adds nullable columns
+    declared later to tables that already exist.
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
 #to create tables
 Base.metadata.create_all(engine)
+ensure_columns(engine)
+ensure_indexes(engine)
 
@@ -1,27 +1,57 @@
 import asyncio
+import math
 import re
 import contextlib
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 
 from router.claim import router as claim_router
 from router.documents import router as documents_router
-from tasks import prune_old_patients
+from services import imis_services
+from services import batch_prevalidation
+from services import claim_outbox
+from services.circuit_breaker import CircuitOpenError
+from services import metrics
+import config
+import rule_loader
+from insurance_database import async_engine, engine
+from services import scheduler
+import tasks as periodic_jobs
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
     """
-    Starts the prune_old_patients task on startup and cancels it on shutdown.
+    Opens the shared IMIS client, loads the rules/catalog snapshot and starts
+    the job scheduler, rule file watcher, catalog.bin rebuild, claim outbox
+    and event loop lag tasks on startup; cancels the tasks and closes the
+    client's pool on shutdown.
     """
-    task = asyncio.create_task(prune_old_patients())
+    app.state.imis_client = imis_services.get_imis_client()
+    await asyncio.to_thread(rule_loader.get_snapshot)
+    tasks = []
+    if config.SCHEDULER_ENABLED:
+        tasks.append(asyncio.create_task(scheduler.run(periodic_jobs.JOBS)))
+    if config.RULES_RELOAD_INTERVAL > 0:
+        tasks.append(asyncio.create_task(rule_loader.watch_for_changes()))
+    if config.CATALOG_REBUILD_INTERVAL > 0:
+        tasks.append(asyncio.create_task(rule_loader.rebuild_stale_catalog()))
+    if config.OUTBOX_WORKER_ENABLED:
+        tasks.append(asyncio.create_task(claim_outbox.run_worker()))
+    if config.METRICS_ENABLED:
+        tasks.append(asyncio.create_task(metrics.sample_event_loop_lag()))
     try:
         yield
     finally:
-        task.cancel()
-        with contextlib.suppress(asyncio.CancelledError):
-            await task
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        await imis_services.close_imis_client()
+        batch_prevalidation.shutdown_pool()
+        await async_engine.dispose()
 
 
 app = FastAPI(
@@ -45,6 +75,26 @@ app.add_middleware(
 )
 
 
+if config.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine, "sync")
+    metrics.instrument_engine(async_engine.sync_engine, "async")
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics_endpoint():
+        """Prometheus text format; unauthenticated so scrapers need no API key."""
+        return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "operation": exc.operation},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+
 app.include_router(claim_router, prefix="/api")
 app.include_router(documents_router, prefix="/docs")
 
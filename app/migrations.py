@@ -0,0 +1,25 @@
+"""
+Schema upkeep and backfills for databases created before the normalized
+tables existed. Safe to re-run.
+
+    python -m migrations
+"""
+from insurance_database import SessionLocal, engine, ensure_columns, ensure_indexes
+from services.claim_lines import backfill_claim_lines
+from services.usage_ledger import backfill_usage_ledger
+
+
+def run():
+    ensure_columns(engine)
+    ensure_indexes(engine)
+    db = SessionLocal()
+    try:
+        lines = backfill_claim_lines(db)
+        ledger = backfill_usage_ledger(db)
+    finally:
+        db.close()
+    return {"claim_lines": lines, "usage_ledger": ledger}
+
+
+if __name__ == "__main__":
+    print(run())
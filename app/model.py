@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Dict, Any,Literal
-from datetime import date
+from datetime import date, datetime
 import uuid
 from enum import Enum
 
@@ -120,6 +120,55 @@ class FullClaimValidationResponse(BaseModel):
     # claim_code:str
 
 
+class BatchPrevalidationRequest(BaseModel):
+    claims: List[ClaimInput] = Field(..., min_length=1, description="Claims to prevalidate; results come back in the same order")
+
+
+class BatchPrevalidationOutcome(BaseModel):
+    index: int
+    patient_id: str
+    status_code: int
+    result: Optional[Dict[str, Any]] = None
+    detail: Optional[Any] = None
+
+
+class BatchPrevalidationResponse(BaseModel):
+    count: int
+    valid_count: int
+    results: List[BatchPrevalidationOutcome]
+
+
+class BulkClaimSubmissionRequest(BaseModel):
+    claims: List[ClaimInput] = Field(..., min_length=1, description="Claims to submit to IMIS; outcomes stream back as each one completes")
+
+
+class ClaimSummary(BaseModel):
+    id: int
+    patient_id: str
+    claim_code: str
+    status: Optional[str] = None
+    created_at: Optional[datetime] = None
+    fetched_at: Optional[datetime] = None
+    service_type: Optional[str] = None
+    service_code: Optional[str] = None
+    department: Optional[str] = None
+    # only with include_raw
+    items: Optional[Any] = None
+    item_code: Optional[Any] = None
+    raw_response: Optional[Any] = None
+
+
+class ClaimsPage(BaseModel):
+    count: int
+    results: List[ClaimSummary]
+    next_cursor: Optional[str] = None
+
+
+class PatientClaimsPage(ClaimsPage):
+    patient_code: str
+    patient_uuid: str
+
+
 class PatientInfo(BaseModel):
     imis_patient: Dict[str, Any]
     eligibility: Dict[str, Any]
@@ -134,4 +183,5 @@ class LoginInput(BaseModel):
 class PatientFullInfoRequest(BaseModel):
     patient_identifier: str
     username: str
-    password: str
\ No newline at end of file
+    password: str
+    force_refresh: bool = Field(False, description="Skip the stored record and wait for IMIS")
\ No newline at end of file
@@ -1,20 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException,Request
-from sqlalchemy.orm import Session
-from services.imis_services import extract_copayment
-from model import ClaimInput, FullClaimValidationResponse ,PatientFullInfoRequest
+from fastapi import APIRouter, Depends, Header, HTTPException,Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from services.circuit_breaker import CircuitOpenError
+from model import ClaimInput, FullClaimValidationResponse ,PatientFullInfoRequest, BatchPrevalidationRequest, BatchPrevalidationResponse, BulkClaimSubmissionRequest, ClaimsPage, PatientClaimsPage
 from services.local_validator import prevalidate_claim
+from services.batch_prevalidation import prevalidate_batch
 from services import imis_services
-from insurance_database import get_db, ImisResponse, PatientInformation
-from services.imis_parser import parse_eligibility_response
+from services import claim_outbox
+from services import scheduler
+from insurance_database import get_async_db, ImisResponse, PatientInformation
+from services.patient_eligibility import get_patient_full_info, mark_needs_refresh
+from services.claim_queries import ClaimFilters, export_claims_ndjson, fetch_claim_status, fetch_claims_page, fetch_patient_claims_page
+from services.claim_submission import build_claim_payload, claim_total, parse_claim_response, store_claims, stream_bulk_submission
+from services.batch_prevalidation import load_patients
 from decimal import Decimal 
-from datetime import datetime
-import logging,uuid,json
-from rule_loader import get_all_items,get_all_services
-from dependencies import get_api_key
-from typing import  Optional
+from datetime import date, datetime
+import logging
+import rule_loader
+from rule_loader import get_items_payload,get_services_payload,search_items,search_services
+from dependencies import get_api_key, get_imis_client
+from typing import  Literal, Optional
 from fastapi import Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import status
+import httpx
+import config
 
 
 
@@ -56,104 +66,35 @@ BASE_URL = "https://ourdomaintostorethefiles.com/uploads/claims/"
 @router.post("/patient/full-info")
 async def get_patient_and_eligibility(
     identifier: PatientFullInfoRequest,
-    db: Session = Depends(get_db),
-    api_key: str = Depends(get_api_key)
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key),
+    imis_client: httpx.AsyncClient = Depends(get_imis_client)
 ):
-    patient_identifier = identifier.patient_identifier
-    username=identifier.username
-    password=identifier.password
-    patient_info = await imis_services.get_patient_info(patient_identifier, username, password)
-    data = patient_info.get("data") or {}
-    entries = data.get("entry") or []
-
-    if not (patient_info.get("success") and len(entries) > 0):
-        raise HTTPException(status_code=404, detail="Patient not found in IMIS")
-
-    resource = entries[0]["resource"]
-    patient_uuid = resource.get("id")
-
-    eligibility_raw = await imis_services.check_eligibility(patient_identifier, username, password)
-    if not eligibility_raw.get("success"):
-        raise HTTPException(status_code=eligibility_raw.get("status", 500),
-                            detail="Eligibility request failed in IMIS")
-
-    copayment = extract_copayment(patient_info.get("data"))
-    parsed = parse_eligibility_response(eligibility_raw) or {}
-    allowed_money = Decimal(str(parsed.get("allowed_money") or "0"))
-    used_money = Decimal(str(parsed.get("used_money") or "0"))
-
-    birth_date_str = resource.get("birthDate") 
-    birth_date_obj = None
-
-    if birth_date_str:
-        birth_date_obj = datetime.strptime(birth_date_str, "%Y-%m-%d").date()
-
-    record = db.query(PatientInformation).filter_by(patient_code=patient_identifier).first()
-    if not record:
-        record = PatientInformation(
-            patient_code=patient_identifier,
-            patient_uuid=patient_uuid,
-            name=" ".join(resource.get("name", [{}])[0].get("given", [])),
-            birth_date=birth_date_obj,
-            gender=resource.get("gender"),
-            copayment=copayment,
-            allowed_money=allowed_money,
-            used_money=used_money,
-            category=parsed.get("category"),
-            policy_id=parsed.get("policy_id"),
-            policy_expiry=parsed.get("policy_expiry"),
-            imis_full_response=patient_info.get("data"),
-            eligibility_raw=eligibility_raw
-        )
-        db.add(record)
-    else:
-        record.patient_uuid = patient_uuid
-        record.name = " ".join(resource.get("name", [{}])[0].get("given", []))
-        record.birth_date = birth_date_obj
-        record.gender = resource.get("gender")
-        record.copayment = copayment
-        record.allowed_money = allowed_money
-        record.used_money = used_money
-        record.category = parsed.get("category")
-        record.policy_id = parsed.get("policy_id")
-        record.policy_expiry = parsed.get("policy_expiry")
-        record.imis_full_response = patient_info.get("data")
-        record.eligibility_raw = eligibility_raw
-
-    try:
-        db.commit()
-        db.refresh(record)
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to save patient eligibility: {str(e)}")
-
-    return {
-        "patient_code": record.patient_code,
-        "uuid": record.patient_uuid,
-        "name": record.name,
-        "birthDate": record.birth_date,
-        "gender": record.gender,
-        "copayment": str(record.copayment),
-        "allowed_money": str(record.allowed_money),
-        "used_money": str(record.used_money),
-        "category": record.category,
-        "policy_id": record.policy_id,
-        "policy_expiry": record.policy_expiry,
-        "imis": record.imis_full_response,
-        "eligibility": record.eligibility_raw
-    }
+    """
+    Patient details and eligibility. A recently stored record is answered at
+    once and refreshed from IMIS in the background; `freshness` tells where
+    the data came from and how old it is.
+    """
+    return await get_patient_full_info(
+        db,
+        identifier.patient_identifier,
+        identifier.username,
+        identifier.password,
+        imis_client,
+        force_refresh=identifier.force_refresh,
+    )
 
 
 @router.post("/prevalidation", response_model=FullClaimValidationResponse)
 async def eligibility_check_endpoint(
     input_data: ClaimInput,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     api_key: str = Depends(get_api_key)
 ):
     # Patient lookup
-    patient = db.query(PatientInformation).filter(
-        PatientInformation.patient_code == input_data.patient_id
-    ).first()
+    patient = (await db.execute(
+        select(PatientInformation).where(PatientInformation.patient_code == input_data.patient_id).limit(1)
+    )).scalars().first()
 
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
@@ -163,7 +104,7 @@ async def eligibility_check_endpoint(
     used_money = patient.used_money or 0
 
     # Run local prevalidation (collects all warnings, no exceptions)
-    local_validation_result = prevalidate_claim(
+    local_validation_result = await prevalidate_claim(
         claim=input_data,
         db=db,
         allowed_money=Decimal(str(allowed_money)),
@@ -182,6 +123,29 @@ async def eligibility_check_endpoint(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY
         )
 
+
+@router.post("/prevalidation/batch", response_model=BatchPrevalidationResponse)
+async def batch_prevalidation_endpoint(
+    input_data: BatchPrevalidationRequest,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Prevalidates many claims in one request. Each result carries the status
+    code /prevalidation would have answered with (200, 422, 404 or 400).
+    """
+    if len(input_data.claims) > config.BATCH_PREVALIDATION_MAX_CLAIMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.BATCH_PREVALIDATION_MAX_CLAIMS} claims per batch",
+        )
+    results = await prevalidate_batch(db, input_data.claims)
+    return {
+        "count": len(results),
+        "valid_count": sum(1 for r in results if r["status_code"] == 200),
+        "results": results,
+    }
+
 # @router.post("/prevalidation", response_model=FullClaimValidationResponse)
 # async def eligibility_check_endpoint(
 #     input_data: ClaimInput, 
@@ -224,162 +188,42 @@ async def submit_claim_endpoint(
     input:ClaimInput,
     #claim_id: str,
     request:Request,
-    db: Session = Depends(get_db),
-    api_key: str = Depends(get_api_key)
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key),
+    imis_client: httpx.AsyncClient = Depends(get_imis_client)
 ):
     username=input.username
     password=input.password
-    patient = db.query(PatientInformation).filter(PatientInformation.patient_code == input.patient_id).first()
+    patient = (await db.execute(
+        select(PatientInformation).where(PatientInformation.patient_code == input.patient_id).limit(1)
+    )).scalars().first()
     if not patient:
         raise HTTPException(status_code=500, detail="Claim has no linked patient")
 
     patient_uuid = patient.patient_uuid
     
-    imis_claim_code = uuid.uuid4().hex
-
-    care_type_map = {"OPD": "O", "IPD": "I", "ER": "O","Referral":"O"}
-    service_type_mapped = {"OPD": "O", "ER": "E", "IPD": "O", "Referral": "R"}
-    if input.service_type in ["OPD", "ER"]:
-        type_field = [{"text": service_type_mapped.get(input.service_type, "O")}]
-    else:
-        type_field = {"text": service_type_mapped.get(input.service_type, "O")}
-
-    icd_codes = json.loads(input.icd_codes) if isinstance(input.icd_codes, str) else input.icd_codes
-    fhir_claim_payload = {
-        "resourceType": "Claim",
-        "billablePeriod": {
-            "start": input.visit_date.isoformat(),
-            "end": input.visit_date.isoformat()
-        },
-        "created": datetime.utcnow().isoformat(),
-        "patient": {"reference": f"Patient/{patient_uuid}"},
-
-        "identifier": [
-            {
-                "type": {"coding": [{"code": "ACSN", "system": "https://hl7.org/fhir/valueset-identifier-type.html"}]},
-                "use": "usual",
-                "value": imis_claim_code
-            },
-            {
-                "type": {"coding": [{"code": "MR", "system": "https://hl7.org/fhir/valueset-identifier-type.html"}]},
-                "use": "usual",
-                "value": input.claim_code
-            }
-        ],
-        "item": [
-            {
-                "sequence": i + 1,
-                "category": {"text": item.category},         
-                "quantity": {"value": item.quantity},         
-                "service": {"text": item.item_code},         
-                "unitPrice": {"value": item.cost},  
-            }
-            for i, item in enumerate(input.claimable_items)
-        ],
-        "total":{"value": sum(round(item.cost * item.quantity, 2) 
-        for item in input.claimable_items
-        )},
-        "careType":care_type_map.get(input.service_type),#care type shall be I and O 
-        # "enterer": {"reference": "Practitioner/7aa79c53-057e-4e77-8576-dfcfb03584a8"},
-        # "facility": {"reference": "Location/1ac457d3-efd3-4a67-89b3-bf8cbe18045d"},
-        #here for testing this is commented out above is the hardcoded value for now
-        "enterer": {"reference": f"Practitioner/{input.enterer_reference}"},
-        "facility": {"reference": f"Location/{input.facility_reference}"},
-        "diagnosis": [
-            {"sequence": i + 1, 
-             "type": [{"coding": [{"code": "icd_0"}], "text": "icd_0"}],
-             "diagnosisCodeableConcept": {"coding": [{"code": code}]}}
-            for i, code in enumerate(icd_codes or [])
-        ],
-        "nmc": ",".join(input.doctor_nmc) if isinstance(input.doctor_nmc, list) else input.doctor_nmc,
-        "type": {"text":service_type_mapped.get(input.service_type,"E")},#service_type_mapped.get(claim.service_type, # visit type shall be O R and E only Others Referral and Emergency   
-    }
-
+    fhir_claim_payload = build_claim_payload(input, patient_uuid)
 
     try:
-        imis_response = await imis_services.submit_claim(fhir_claim_payload, username,password)
+        imis_response = await imis_services.submit_claim(fhir_claim_payload, username,password, client=imis_client)
+    except CircuitOpenError:
+        raise
     except Exception as exc:
         logging.error(f"IMIS submission failed for claim {input.claim_code}: {exc}")
         raise HTTPException(status_code=500, detail=f"IMIS submission failed: {str(exc)}") from exc
 
-    imis_json_str = (imis_response.get("response") or "").strip()
-    try:
-        imis_json = json.loads(imis_json_str) if imis_json_str else {}
-    except json.JSONDecodeError:
-        logging.error(f"IMIS returned invalid JSON: {imis_json_str!r}")
-        imis_json = {}
-
-
-    #imis_json = json.loads(imis_json_str) if imis_json_str else {}
-
-    claim_code = "UNKNOWN_CLAIM_CODE"
-    for ident in imis_json.get("identifier", []):
-        codings = ident.get("type", {}).get("coding", [])
-        if any(c.get("code") == "MR" for c in codings):
-            claim_code = ident.get("value")
-            break
-
-    outcome_status = imis_json.get("outcome", {}).get("text", "unknown")
-    created_date_str = imis_json.get("created")
-    created_date = datetime.fromisoformat(created_date_str) if created_date_str else datetime.utcnow()
-
-    seq_to_code = {}
-    for add_item in imis_json.get("addItem", []):
-        seq_list = add_item.get("sequenceLinkId", [])
-        service_list = add_item.get("service", {}).get("coding", [])
-        code = service_list[0].get("code") if service_list else None
-        for seq in seq_list:
-            seq_to_code[seq] = code
-
-    items_info = []
-    for item in imis_json.get("item", []):
-        seq_id = item.get("sequenceLinkId")
-        service_code = seq_to_code.get(seq_id, None)
-        for adj in item.get("adjudication", []):
-            status = adj.get("reason", {}).get("text")
-            items_info.append({
-                "sequence_id": seq_id,
-                "item_code": service_code,
-                "status": status
-            })
-    items_list = [
-    {
-        "item_code": item.item_code,
-        "name": item.name,
-        "qty": item.quantity,
-        "cost": item.cost,
-        "category": item.category,
-        "type": item.type
-    }
-    for item in input.claimable_items
-]
-    items_list = [
-    {
-        "item_code": item.item_code,
-        "name": item.name,
-        "qty": item.quantity,
-        "cost": item.cost,
-        "category": item.category,
-        "type": item.type
-    }
-    for item in input.claimable_items
-]
-    imis_record = ImisResponse(
-        patient_id=input.patient_id,
-        claim_code=claim_code,
-        status=outcome_status,
-        created_at=created_date,
-        items=items_info,
-        raw_response=imis_json,
-        fetched_at=datetime.utcnow(),
-        service_type=input.service_type,
-        service_code=input.service_code,
-        item_code=items_list,
-        department=input.department,
-    )
-    db.add(imis_record)
-    db.commit()
-    db.refresh(imis_record)
+    parsed = parse_claim_response(imis_response.get("response"))
+    imis_json = parsed["imis_json"]
+    claim_code = parsed["claim_code"]
+    outcome_status = parsed["status"]
+    created_date = parsed["created_at"]
+    items_info = parsed["items"]
+
+    (imis_record,) = await store_claims(db, [(input, parsed)])
+    if imis_response.get("success"):
+        await mark_needs_refresh(db, input.patient_id, claim_total(input))
+    await db.commit()
+    await db.refresh(imis_record)
     def detect_system(request: Request):
         user_agent = request.headers.get("User-Agent", "").lower()
         ip = request.client.host
@@ -419,69 +263,227 @@ async def submit_claim_endpoint(
     }
 
 
-@router.get("/claims/all")
-def get_all_claims(db: Session = Depends(get_db),    api_key: str = Depends(get_api_key)):
-    claims = db.query(ImisResponse).order_by(ImisResponse.claim_code.desc()).all()
-    return {
-        "count": len(claims),
-        "results": claims
-    }
+@router.post("/submit_claim/bulk")
+async def bulk_submit_claim_endpoint(
+    input_data: BulkClaimSubmissionRequest,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key),
+    imis_client: httpx.AsyncClient = Depends(get_imis_client)
+):
+    """
+    Submits many claims to IMIS, at most IMIS_BULK_CONCURRENCY at a time and
+    within the per-host submission rate limit. Streams NDJSON: one "result"
+    line per claim in completion order (with its index in the request), then
+    a "summary" line once all ImisResponse rows are stored in one transaction.
+    """
+    if len(input_data.claims) > config.IMIS_BULK_MAX_CLAIMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.IMIS_BULK_MAX_CLAIMS} claims per bulk submission",
+        )
+    patients = await load_patients(db, sorted({c.patient_id for c in input_data.claims}))
+    return StreamingResponse(
+        stream_bulk_submission(input_data.claims, patients, imis_client),
+        media_type="application/x-ndjson",
+    )
 
 
-@router.get("/claims/patient/{patient_uuid}")
-def get_claims_by_patient(patient_uuid: str, db: Session = Depends(get_db),    api_key: str = Depends(get_api_key)):
-    patient = db.query(PatientInformation).filter(PatientInformation.patient_uuid == patient_uuid).first()
+@router.post("/submit_claim/async", status_code=status.HTTP_202_ACCEPTED)
+async def async_submit_claim_endpoint(
+    input: ClaimInput,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """
+    Queues the claim in the outbox and returns at once; the outbox worker
+    submits it to IMIS with retries. Submitting the same claim again (an
+    identical claim body, or the same Idempotency-Key) returns the existing
+    entry instead of a duplicate; a corrected claim is queued as a new one.
+    """
+    if not claim_outbox.credentials_configured():
+        raise HTTPException(status_code=503, detail="Queued submission is not configured (OUTBOX_CREDENTIALS_KEY)")
+    patient = (await db.execute(
+        select(PatientInformation).where(PatientInformation.patient_code == input.patient_id).limit(1)
+    )).scalars().first()
     if not patient:
-        raise HTTPException(status_code=404, detail="Patient not found")
+        raise HTTPException(status_code=500, detail="Claim has no linked patient")
 
-    claims = db.query(ImisResponse).filter(ImisResponse.patient_id == patient.patient_code).order_by(ImisResponse.claim_code.desc()).all()
-    
+    entry, created = await claim_outbox.enqueue(db, input, patient, idempotency_key)
+    body = claim_outbox.describe(entry)
+    body["status_url"] = f"/api/submit_claim/async/{entry.id}"
+    return JSONResponse(content=body, status_code=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK)
+
+
+@router.get("/submit_claim/async/{outbox_id}")
+async def async_submit_status_endpoint(
+    outbox_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key)
+):
+    entry = await claim_outbox.get_entry(db, outbox_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Queued claim not found")
+    body = claim_outbox.describe(entry)
+    if entry.imis_response_id is not None:
+        record = await db.get(ImisResponse, entry.imis_response_id)
+        if record is not None:
+            body["imis"] = {
+                "claim_code": record.claim_code,
+                "status": record.status,
+                "created_at": record.created_at.isoformat() if record.created_at else None,
+                "items": record.items,
+            }
+    return body
+
+
+@router.get("/submit_claim/outbox")
+async def outbox_stats_endpoint(
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key)
+):
+    """Outbox rows per status and the age of the oldest claim not yet sent."""
+    return await claim_outbox.queue_stats(db)
+
+
+@router.get("/imis/cache-stats")
+def get_imis_cache_stats(api_key: str = Depends(get_api_key)):
+    return imis_services.cache_stats()
+
+
+@router.get("/imis/metrics")
+async def imis_metrics_endpoint(api_key: str = Depends(get_api_key)):
+    """Circuit breaker state, counters and current timeouts per IMIS operation, plus cache stats."""
+    return {"breakers": imis_services.breaker_stats(), "cache": imis_services.cache_stats()}
+
+
+@router.get("/retention/last-run")
+async def retention_last_run_endpoint(api_key: str = Depends(get_api_key)):
+    """Rows deleted and time taken per table by the most recent retention run."""
+    state = await scheduler.job_state("retention")
+    if state is None or state["last_result"] is None:
+        raise HTTPException(status_code=404, detail="No retention run yet")
+    return state["last_result"]
+
+
+@router.get("/scheduler/jobs")
+async def scheduler_jobs_endpoint(api_key: str = Depends(get_api_key)):
+    """Periodic jobs: lease holder, next and last run, outcome and run counts."""
+    return {"worker": scheduler.WORKER_ID, "jobs": await scheduler.job_states()}
+
+
+@router.get("/rules/version")
+def get_rules_version(api_key: str = Depends(get_api_key)):
+    """Version of the rules and catalogs currently used for validation."""
+    snapshot = rule_loader.get_snapshot()
     return {
-        "count": len(claims),
-        "results": claims
+        "rules_version": snapshot.rules_version,
+        "loaded_at": snapshot.loaded_at.isoformat(),
+        "catalog_source": snapshot.catalog_source,
+        "items_count": len(snapshot.items.entries),
+        "services_count": len(snapshot.services.entries),
+        "files": {
+            name: datetime.utcfromtimestamp(stamp[0] / 1e9).isoformat()
+            for name, stamp in zip(
+                (rule_loader.RULES_FILE, rule_loader.ITEMS_FILE, rule_loader.SERVICES_FILE), snapshot.stamps
+            )
+        },
     }
 
+
+@router.get("/claims/all", response_model=ClaimsPage, response_model_exclude_unset=True)
+async def get_all_claims(
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_raw: bool = Query(False, description="Also return items, item_code and the raw IMIS response"),
+    claim_status: Optional[str] = Query(None, alias="status"),
+    service_type: Optional[str] = Query(None),
+    patient_id: Optional[str] = Query(None),
+    date_from: Optional[date] = Query(None, description="Claims created on or after this day"),
+    date_to: Optional[date] = Query(None, description="Claims created on or before this day"),
+    format: Literal["json", "ndjson"] = Query("json", description="ndjson streams every matching claim"),
+):
+    """
+    Stored claims, newest claim code first. Pages are keyset-paginated:
+    pass next_cursor back as `cursor` until it is null.
+    """
+    filters = ClaimFilters(
+        patient_id=patient_id, status=claim_status, service_type=service_type, date_from=date_from, date_to=date_to
+    )
+    if format == "ndjson":
+        return StreamingResponse(export_claims_ndjson(filters, include_raw), media_type="application/x-ndjson")
+    return await fetch_claims_page(db, filters, limit=limit, cursor=cursor, include_raw=include_raw)
+
+
+@router.get(
+    "/claims/patient/{patient_uuid}",
+    response_model=PatientClaimsPage,
+    response_model_exclude_unset=True,
+)
+async def get_claims_by_patient(
+    patient_uuid: str,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    include_raw: bool = Query(False, description="Also return items, item_code and the raw IMIS response"),
+):
+    """A patient's claims, newest claim code first, keyset-paginated."""
+    page = await fetch_patient_claims_page(db, patient_uuid, limit=limit, cursor=cursor, include_raw=include_raw)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return page
+
+
+@router.get("/claims/{claim_code}/status")
+async def get_claim_status(
+    claim_code: str,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: str = Depends(get_api_key),
+):
+    """
+    Claim status and line adjudication as last read from IMIS (at submission
+    or by the status sync); answered from the database without calling IMIS.
+    """
+    claim = await fetch_claim_status(db, claim_code)
+    if claim is None:
+        raise HTTPException(status_code=404, detail="Claim not found")
+    return claim
+
 @router.get("/items")
 def list_items(
+    request: Request,
     api_key: str = Depends(get_api_key),
     q: Optional[str] = Query(None, min_length=2, description="Search term for medicine names"),
     limit: Optional[int] = Query(15, ge=1, le=100),
-) -> dict:
-    # Always work with raw data
-    all_items = get_all_items()  # This uses your cached _cached_meds_list
-
+    match_code: bool = Query(False, description="Also return the item whose code equals q"),
+) -> Response:
     if not q:
-        # Return full list as dict (FastAPI will convert to JSON)
-        return {"count": len(all_items), "medicines": all_items}
+        # Full catalog from pre-encoded bytes; 304 when the client's ETag is current
+        return get_items_payload().response(request)
 
-    # Search mode
-    query = q.strip().lower()
-    filtered = [
-        item for item in all_items
-        if query in item.get("name", "").lower()
-    ][:limit]
+    # Search mode (prefix-ranked, served from the prebuilt index)
+    filtered = search_items(q, limit, match_code)
 
-    return {"count": len(filtered), "medicines": filtered}
+    return JSONResponse({"count": len(filtered), "medicines": filtered})
 
 
 @router.get("/services")
 def list_services(
+    request: Request,
     api_key: str = Depends(get_api_key),
     q: Optional[str] = Query(None, min_length=2, description="Search term for service names"),
     limit: Optional[int] = Query(15, ge=1, le=100),
-) -> dict:
-    all_services = get_all_services()
-
+    match_code: bool = Query(False, description="Also return the service whose code equals q"),
+) -> Response:
     if not q:
-        return {"count": len(all_services), "packages": all_services}
+        return get_services_payload().response(request)
 
-    query = q.strip().lower()
-    filtered = [
-        service for service in all_services
-        if query in service.get("name", "").lower()
-    ][:limit]
+    filtered = search_services(q, limit, match_code)
 
-    return {"count": len(filtered), "packages": filtered}
+    return JSONResponse({"count": len(filtered), "packages": filtered})
 # @router.get("/items")
 # def list_items(    api_key: str = Depends(get_api_key)):
 #     return get_items_response()
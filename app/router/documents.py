@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from insurance_database import get_db, ClaimDocument, ImisResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from insurance_database import get_async_db, ClaimDocument, ImisResponse
 from pydantic import BaseModel
 from typing import List
 
@@ -15,25 +16,30 @@ class DocumentInput(BaseModel):
 async def add_document_links(
     claim_id: str,
     documents: List[DocumentInput],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    claim = db.query(ImisResponse).filter(ImisResponse.claim_id == claim_id).first()
-    if not claim:
+    claim = (await db.execute(
+        select(ImisResponse.id).where(ImisResponse.claim_code == claim_id).limit(1)
+    )).scalar_one_or_none()
+    if claim is None:
         raise HTTPException(status_code=404, detail="Claim not found")
 
-    saved_docs = []
-
-    for doc_data in documents:
-        doc = ClaimDocument(
+    docs = [
+        ClaimDocument(
             claim_id=claim_id,
             file_url=doc_data.file_url,
             original_filename=doc_data.original_filename,
             document_type=doc_data.document_type,
-            file_size=None 
+            file_size=None
         )
-        db.add(doc)
-        db.flush()
+        for doc_data in documents
+    ]
+    db.add_all(docs)
+    # One flush assigns every id
+    await db.flush()
 
+    saved_docs = []
+    for doc in docs:
         saved_docs.append({
             "document_id": doc.id,
             "file_url": doc.file_url,
@@ -41,7 +47,7 @@ async def add_document_links(
             "document_type": doc.document_type
         })
 
-    db.commit()
+    await db.commit()
 
     return {
         "message": "Document links stored successfully",
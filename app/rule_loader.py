@@ -1,27 +1,152 @@
+import asyncio
 import json
+import logging
 import os
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import cached_property
 from pathlib import Path
-from fastapi.responses import Response
 from threading import Lock
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+import config
+from services.rule_engine import CompiledRules, compile_rules
+from services.catalog_search import CatalogSearchIndex
+from services.catalog_payload import EncodedPayload
+from services.catalog_binary import CatalogFile, MergedCodes, build_catalog_file, file_digest
+from services import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: rebuilds are not serialised between workers
+    fcntl = None
+
+logger = logging.getLogger(__name__)
 
 # Path to JSON files
 DATA_PATH = Path(__file__).resolve().parent / "data"
 
-# Development mode flag
+RULES_FILE = "validation_rules.json"
+ITEMS_FILE = "items.json"
+SERVICES_FILE = "services.json"
+CATALOG_TABLES = {"items": (ITEMS_FILE, "medicines"), "services": (SERVICES_FILE, "packages")}
+
+
+def catalog_binary_path() -> Path:
+    return Path(config.CATALOG_BINARY_PATH) if config.CATALOG_BINARY_PATH else DATA_PATH / "catalog.bin"
+
+# Development mode flag: check the data files for changes on every access
 DEV_MODE = os.environ.get("DEV_MODE") == "1"
 
-# Module-level caches
-_cached_rules = None
-_cached_meds_list = None
-_cached_meds_map = None
-_cached_packages_list = None
-_cached_packages_map = None
-_cached_items_response = None
-_cached_services_response = None
 
-# Lock to make cache thread-safe
+@dataclass(frozen=True)
+class CatalogSection:
+    """
+    One catalog (items or services) with everything derived from it. Loaded
+    from catalog.bin, entries and by_code are lazy views over the mapped file
+    and `bodies` holds the full response body per encoding, compressed at
+    build time.
+    """
+    key: str
+    stamp: Tuple
+    entries: Sequence[dict] = field(repr=False)
+    by_code: Mapping[str, dict] = field(repr=False)
+    index: CatalogSearchIndex = field(repr=False)
+    bodies: Optional[Dict[str, bytes]] = field(default=None, repr=False)
+
+    @cached_property
+    def payload(self) -> EncodedPayload:
+        """Full-catalog response bodies; encoded by build_snapshot, off the request path."""
+        if self.bodies is not None:
+            return EncodedPayload.from_bodies(self.bodies, self.stamp, config.CATALOG_CACHE_CONTROL)
+        obj = {"count": len(self.entries), self.key: list(self.entries)}
+        return EncodedPayload.from_obj(obj, self.stamp, config.CATALOG_CACHE_CONTROL)
+
+    def warm(self) -> EncodedPayload:
+        """Builds the response payload now rather than on the first /items or /services request."""
+        return self.payload
+
+
+@dataclass(frozen=True)
+class RuleSnapshot:
+    """
+    Everything rule_loader serves, built together and published as a single
+    reference. Never mutated: a reload builds a new snapshot and swaps it in,
+    so readers see either the old or the new version as a whole.
+    """
+    rules_stamp: Tuple[int, int]
+    rules: Dict[str, Any] = field(repr=False)
+    compiled_rules: CompiledRules = field(repr=False)
+    items: CatalogSection = field(repr=False)
+    services: CatalogSection = field(repr=False)
+    codes: Mapping[str, dict] = field(repr=False)
+    catalog_source: str
+    loaded_at: datetime
+
+    @property
+    def rules_version(self) -> str:
+        return self.compiled_rules.rules_version
+
+    @property
+    def stamps(self) -> Tuple:
+        return (self.rules_stamp,) + self.items.stamp
+
+    def lookup_code(self, code: str) -> Optional[dict]:
+        return self.codes.get(str(code))
+
+
+# The published snapshot; replaced, never modified
+_snapshot: Optional[RuleSnapshot] = None
+# Last file versions that failed to load, so a broken file is only reported once
+_failed_stamps = None
+
+# Serializes loaders. Readers only take it for the very first load (double-checked
+# in get_snapshot); afterwards every read is a single reference load.
 _cache_lock = Lock()
 
+reload_checks = metrics.counter(
+    "rules_reload_checks_total", "Rule/catalog file checks by outcome (unchanged, reloaded, failed)", ("result",)
+)
+code_lookups = metrics.counter(
+    "catalog_code_lookups_total", "Claim line codes looked up in the catalog snapshot, by hit or miss", ("result",)
+)
+
+
+@metrics.collector("rules_snapshot_info", "gauge", "Rules version and catalog source of the published snapshot")
+def _snapshot_info_samples():
+    snapshot = _snapshot
+    if snapshot is not None:
+        yield {"rules_version": snapshot.rules_version, "catalog_source": snapshot.catalog_source}, 1
+
+
+@metrics.collector("rules_snapshot_loaded_timestamp_seconds", "gauge", "When the published snapshot was built")
+def _snapshot_loaded_samples():
+    snapshot = _snapshot
+    if snapshot is not None:
+        yield {}, snapshot.loaded_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _file_stamp(file_name, optional: bool = False):
+    """Changes whenever the data file is replaced or edited."""
+    path = file_name if isinstance(file_name, Path) else DATA_PATH / file_name
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        if optional:
+            return None
+        raise
+    return (st.st_mtime_ns, st.st_size)
+
+
+def current_stamps() -> Tuple:
+    """Rules, items.json, services.json and catalog.bin (None when not built)."""
+    return (
+        _file_stamp(RULES_FILE),
+        _file_stamp(ITEMS_FILE),
+        _file_stamp(SERVICES_FILE),
+        _file_stamp(catalog_binary_path(), optional=True),
+    )
+
 
 def load_json(file_name: str):
     file_path = DATA_PATH / file_name
@@ -29,82 +154,260 @@ def load_json(file_name: str):
         return json.load(f)
 
 
+def _load_catalog_json(file_name: str):
+    entries = load_json(file_name)
+    if not isinstance(entries, list) or not all(isinstance(e, dict) and "code" in e and "name" in e for e in entries):
+        raise ValueError(f"{file_name} must be a list of entries with code and name")
+    return entries
+
+
+def _catalog_sources() -> Dict[str, str]:
+    return {file_name: file_digest(DATA_PATH / file_name) for file_name, _ in CATALOG_TABLES.values()}
+
+
+def build_catalog_binary(path=None) -> Path:
+    """Compiles items.json and services.json into catalog.bin."""
+    tables = {name: (key, _load_catalog_json(file_name)) for name, (file_name, key) in CATALOG_TABLES.items()}
+    return build_catalog_file(path or catalog_binary_path(), tables, _catalog_sources())
+
+
+@contextmanager
+def _catalog_build_lock(path: Path):
+    """Exclusive lock on <catalog>.lock, shared by the workers of this host."""
+    with open(path.with_name(path.name + ".lock"), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def rebuild_catalog_if_stale() -> bool:
+    """
+    Rebuilds an existing catalog.bin that was built from older JSON
+    catalogs; a missing one stays missing, since the binary catalog is
+    opt-in (python -m build_catalog). The rebuild holds the host's catalog
+    lock, so of the workers sharing the file one rebuilds it and the others
+    find it current. Each worker's watcher then picks the new file up.
+    """
+    path = catalog_binary_path()
+    if not path.exists():
+        return False
+    with _catalog_build_lock(path):
+        try:
+            if CatalogFile(path).matches(_catalog_sources()):
+                return False
+        except (OSError, ValueError):
+            pass
+        build_catalog_binary(path)
+    logger.info("Rebuilt %s", path)
+    return True
+
+
+def _open_catalog_binary(stamp) -> Optional[CatalogFile]:
+    """The compiled catalog, if it exists and was built from the current JSON files."""
+    if stamp is None:
+        return None
+    path = catalog_binary_path()
+    try:
+        catalog_file = CatalogFile(path)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring %s: %s", path, e)
+        return None
+    if not catalog_file.matches(_catalog_sources()):
+        logger.warning("%s is older than the JSON catalogs; run python -m build_catalog", path)
+        return None
+    return catalog_file
+
+
+def _build_catalogs(stamp: Tuple) -> Tuple[CatalogSection, CatalogSection, Mapping[str, dict], str]:
+    catalog_file = _open_catalog_binary(stamp[-1])
+    if catalog_file is not None:
+        sections = {}
+        for name, (_, key) in CATALOG_TABLES.items():
+            table = catalog_file.tables[name]
+            entries = table.entries()
+            sections[name] = CatalogSection(
+                key=key,
+                stamp=stamp,
+                entries=entries,
+                by_code=table,
+                index=CatalogSearchIndex(entries, names=table.names, codes=table.codes, state=table.search_state()),
+                bodies=table.bodies(),
+            )
+        codes = MergedCodes(catalog_file.tables["items"], catalog_file.tables["services"])
+        return sections["items"], sections["services"], codes, "binary"
+
+    sections = {}
+    for name, (file_name, key) in CATALOG_TABLES.items():
+        entries = _load_catalog_json(file_name)
+        sections[name] = CatalogSection(
+            key=key,
+            stamp=stamp,
+            entries=entries,
+            by_code={str(e["code"]): e for e in entries},
+            index=CatalogSearchIndex(entries),
+        )
+    # Items win over services sharing a code, as in get_items() or get_services()
+    codes = {**sections["services"].by_code, **sections["items"].by_code}
+    return sections["items"], sections["services"], codes, "json"
+
+
+def build_snapshot(previous: Optional[RuleSnapshot] = None, stamps: Optional[Tuple] = None) -> RuleSnapshot:
+    """
+    Parses and validates the data files into a new snapshot, reusing the parts
+    of `previous` whose file has not changed. Raises if any file is invalid.
+    """
+    stamps = stamps or current_stamps()
+    rules_stamp, catalog_stamp = stamps[0], stamps[1:]
+
+    if previous is not None and previous.rules_stamp == rules_stamp:
+        rules, compiled = previous.rules, previous.compiled_rules
+    else:
+        rules = load_json(RULES_FILE)
+        compiled = compile_rules(rules)
+
+    if previous is not None and previous.items.stamp == catalog_stamp:
+        items, services, codes, source = previous.items, previous.services, previous.codes, previous.catalog_source
+    else:
+        items, services, codes, source = _build_catalogs(catalog_stamp)
+        # In the loader thread; catalog.bin sections only wrap their stored bodies
+        for section in (items, services):
+            section.warm()
+
+    return RuleSnapshot(
+        rules_stamp=rules_stamp,
+        rules=rules,
+        compiled_rules=compiled,
+        items=items,
+        services=services,
+        codes=codes,
+        catalog_source=source,
+        loaded_at=datetime.utcnow(),
+    )
+
+
+def reload_if_changed(force: bool = False) -> bool:
+    """
+    Rebuilds and publishes a new snapshot when any data file changed.
+    A file that fails to parse or validate keeps the current snapshot live.
+    """
+    global _snapshot, _failed_stamps
+    with _cache_lock:
+        stamps = current_stamps()
+        current = _snapshot
+        if not force and current is not None and current.stamps == stamps:
+            reload_checks.inc(result="unchanged")
+            return False
+        if not force and current is not None and stamps == _failed_stamps:
+            reload_checks.inc(result="unchanged")
+            return False
+        try:
+            snapshot = build_snapshot(None if force else current, stamps)
+        except Exception:
+            reload_checks.inc(result="failed")
+            if current is None:
+                raise
+            _failed_stamps = stamps
+            logger.exception("Rule/catalog reload failed, keeping rules_version %s", current.rules_version)
+            return False
+        _failed_stamps = None
+        _snapshot = snapshot
+    reload_checks.inc(result="reloaded")
+    logger.info("Loaded rules_version %s", snapshot.rules_version)
+    return True
+
+
+def get_snapshot() -> RuleSnapshot:
+    snapshot = _snapshot
+    if snapshot is None or DEV_MODE:
+        # reload_if_changed re-checks under the lock, so concurrent first
+        # callers build the snapshot once
+        reload_if_changed()
+        snapshot = _snapshot
+    return snapshot
+
+
+async def watch_for_changes(interval: float = None):
+    """
+    Polls the data files' mtime/size and swaps in a new snapshot when they
+    change. Parsing and index building run in a worker thread.
+    """
+    interval = config.RULES_RELOAD_INTERVAL if interval is None else interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(reload_if_changed)
+        except Exception:
+            logger.exception("Rule/catalog watcher failed")
+
+
+async def rebuild_stale_catalog(interval: float = None):
+    """
+    Runs rebuild_catalog_if_stale every `interval` seconds. catalog.bin is a
+    file on this host, so every worker runs this (not the cluster scheduler)
+    and the file lock picks the one that rebuilds.
+    """
+    interval = config.CATALOG_REBUILD_INTERVAL if interval is None else interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(rebuild_catalog_if_stale)
+        except Exception:
+            logger.exception("Catalog rebuild failed")
+
+
 def reset_cache():
     """Manually reset all caches."""
-    global _cached_rules, _cached_meds_list, _cached_meds_map
-    global _cached_packages_list, _cached_packages_map
-    global _cached_items_response, _cached_services_response
+    global _snapshot, _failed_stamps
     with _cache_lock:
-        _cached_rules = None
-        _cached_meds_list = None
-        _cached_meds_map = None
-        _cached_packages_list = None
-        _cached_packages_map = None
-        _cached_items_response = None
-        _cached_services_response = None
+        _snapshot = None
+        _failed_stamps = None
 
 
 def get_rules():
-    global _cached_rules
-    with _cache_lock:
-        if _cached_rules is None or DEV_MODE:
-            _cached_rules = load_json("validation_rules.json")
-        return _cached_rules
+    return get_snapshot().rules
+
+
+def get_compiled_rules():
+    """Typed rule set compiled once from validation_rules.json."""
+    return get_snapshot().compiled_rules
 
 
 def get_all_items():
-    global _cached_meds_list, _cached_meds_map
-    with _cache_lock:
-        if _cached_meds_list is None or DEV_MODE:
-            _cached_meds_list = load_json("items.json")
-            _cached_meds_map = {str(m["code"]): m for m in _cached_meds_list}
-        return _cached_meds_list
+    return get_snapshot().items.entries
 
 
 def get_items(item_code: str):
-    if _cached_meds_map is None or DEV_MODE:
-        get_all_items()  # initialize cache
-    return _cached_meds_map.get(str(item_code))
+    return get_snapshot().items.by_code.get(str(item_code))
+
+
+def search_items(query: str, limit: int = 15, match_code: bool = False):
+    """Ranked typeahead search over items.json names."""
+    return get_snapshot().items.index.search(query, limit, match_code)
 
 
 def get_all_services():
-    global _cached_packages_list, _cached_packages_map
-    with _cache_lock:
-        if _cached_packages_list is None or DEV_MODE:
-            _cached_packages_list = load_json("services.json")
-            _cached_packages_map = {str(p["code"]): p for p in _cached_packages_list}
-        return _cached_packages_list
+    return get_snapshot().services.entries
 
 
 def get_services(item_code: str):
-    if _cached_packages_map is None or DEV_MODE:
-        get_all_services()  # initialize cache
-    return _cached_packages_map.get(str(item_code))
+    return get_snapshot().services.by_code.get(str(item_code))
 
 
-def get_items_response():
-    global _cached_items_response
-    with _cache_lock:
-        if _cached_items_response is None or DEV_MODE:
-            data = get_all_items()
-            payload = {"count": len(data), "medicines": data}
-            _cached_items_response = Response(
-                content=json.dumps(payload),
-                media_type="application/json",
-                headers={"Cache-Control": "public, max-age=3600"},
-            )
-        return _cached_items_response
+def lookup_code(code: str):
+    """Catalog entry for a claim line code: the item if there is one, else the service."""
+    return get_snapshot().codes.get(str(code))
 
 
-def get_services_response():
-    global _cached_services_response
-    with _cache_lock:
-        if _cached_services_response is None or DEV_MODE:
-            data = get_all_services()
-            payload = {"count": len(data), "packages": data}
-            _cached_services_response = Response(
-                content=json.dumps(payload),
-                media_type="application/json",
-                headers={"Cache-Control": "public, max-age=3600"},
-            )
-        return _cached_services_response
+def search_services(query: str, limit: int = 15, match_code: bool = False):
+    """Ranked typeahead search over services.json names."""
+    return get_snapshot().services.index.search(query, limit, match_code)
+
+
+def get_items_payload() -> EncodedPayload:
+    """The full items catalog as pre-encoded bytes with ETags."""
+    return get_snapshot().items.payload
+
+
+def get_services_payload() -> EncodedPayload:
+    """Same as get_items_payload, for services.json."""
+    return get_snapshot().services.payload
@@ -0,0 +1,220 @@
+"""
+Prevalidation of many claims in one call: the database is read once per
+batch (patients, first OPD visits and usage ledger aggregates for every
+patient involved) and the rules are then applied per claim, in a worker
+process pool for large batches when BATCH_PROCESS_WORKERS is set.
+"""
+import asyncio
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from insurance_database import ImisResponse, PatientInformation
+from model import ClaimInput
+from rule_loader import RuleSnapshot, get_snapshot
+from services.local_validator import (
+    ClaimContext,
+    PreviousOpdVisit,
+    capped_windows,
+    claim_catalog,
+    evaluate_claim,
+    needs_non_covered_spend,
+)
+from services.usage_ledger import BULK_CHUNK, daily_spend_by_bucket, daily_units_by_item, fiscal_year_start
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: forking a process that runs an event loop and DB threads is unsafe
+        _pool = ProcessPoolExecutor(
+            max_workers=config.BATCH_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def load_patients(db: AsyncSession, patient_codes: List[str]) -> Dict[str, PatientInformation]:
+    patients = {}
+    for i in range(0, len(patient_codes), BULK_CHUNK):
+        stmt = (
+            select(PatientInformation)
+            .where(PatientInformation.patient_code.in_(patient_codes[i:i + BULK_CHUNK]))
+            .order_by(PatientInformation.id)
+        )
+        for patient in (await db.execute(stmt)).scalars():
+            patients.setdefault(patient.patient_code, patient)
+    return patients
+
+
+async def _load_first_opd_visits(db: AsyncSession, patient_codes: List[str]) -> Dict[str, PreviousOpdVisit]:
+    """The earliest counted OPD claim per patient, as the single-claim path reads it."""
+    visits = {}
+    for i in range(0, len(patient_codes), BULK_CHUNK):
+        ranked = (
+            select(
+                ImisResponse.patient_id,
+                ImisResponse.created_at,
+                ImisResponse.service_code,
+                ImisResponse.department,
+                func.row_number().over(
+                    partition_by=ImisResponse.patient_id, order_by=ImisResponse.created_at.asc()
+                ).label("rank"),
+            )
+            .where(ImisResponse.patient_id.in_(patient_codes[i:i + BULK_CHUNK]))
+            .where(ImisResponse.service_type == "OPD")
+            .where(ImisResponse.status.notin_(["rejected", "unknown"]))
+            .subquery()
+        )
+        stmt = select(ranked.c.patient_id, ranked.c.created_at, ranked.c.service_code, ranked.c.department).where(
+            ranked.c.rank == 1
+        )
+        for patient_id, created_at, service_code, department in (await db.execute(stmt)).all():
+            visits[patient_id] = PreviousOpdVisit(created_at.date(), service_code, department)
+    return visits
+
+
+async def load_claim_contexts(
+    db: AsyncSession, claims: List[ClaimInput], snapshot: RuleSnapshot
+) -> List[Any]:
+    """
+    ClaimContext per claim (or the HTTPException the single-claim path would
+    raise), using a fixed number of queries for the whole batch.
+    """
+    patients = await load_patients(db, sorted({c.patient_id for c in claims}))
+
+    contexts: List[Any] = [None] * len(claims)
+    pending: List[Tuple[int, ClaimInput, list]] = []
+    for i, claim in enumerate(claims):
+        patient = patients.get(claim.patient_id)
+        if patient is None:
+            contexts[i] = HTTPException(status_code=404, detail="Patient not found in insurance database")
+            continue
+        allowed_money = Decimal(str(patient.allowed_money or 0))
+        used_money = Decimal(str(patient.used_money or 0))
+        contexts[i] = ClaimContext(copayment=patient.copayment, allowed_money=allowed_money, used_money=used_money)
+        if allowed_money - used_money > 0:
+            pending.append((i, claim, claim_catalog(snapshot, claim)))
+    if not pending:
+        return contexts
+
+    opd_patients = sorted({claim.patient_id for _, claim, _ in pending if claim.service_type == "OPD"})
+    first_opd = await _load_first_opd_visits(db, opd_patients) if opd_patients else {}
+
+    # One ledger read covering every claim's capped windows
+    windows = {i: capped_windows(catalog) for i, _, catalog in pending}
+    window_codes = {code for by_window in windows.values() for codes in by_window.values() for code in codes}
+    units = {}
+    if window_codes:
+        starts = [
+            claim.visit_date - timedelta(days=max(windows[i]))
+            for i, claim, _ in pending if windows[i]
+        ]
+        units = await daily_units_by_item(
+            db,
+            {claim.patient_id for i, claim, _ in pending if windows[i]},
+            window_codes,
+            min(starts),
+            max(claim.visit_date for _, claim, _ in pending),
+        )
+
+    spend_claims = [
+        (i, claim) for i, claim, catalog in pending
+        if needs_non_covered_spend(snapshot.compiled_rules, catalog)
+    ]
+    spend = {}
+    if spend_claims:
+        spend = await daily_spend_by_bucket(
+            db,
+            {claim.patient_id for _, claim in spend_claims},
+            min(fiscal_year_start(claim.visit_date) for _, claim in spend_claims),
+            max(claim.visit_date for _, claim in spend_claims),
+        )
+    spend_needed = {i for i, _ in spend_claims}
+
+    for i, claim, _ in pending:
+        context = contexts[i]
+        if claim.service_type == "OPD":
+            context.last_opd_visit = first_opd.get(claim.patient_id)
+        for window_days, codes in windows[i].items():
+            start = claim.visit_date - timedelta(days=window_days)
+            for code in codes:
+                days = units.get((claim.patient_id, str(code)))
+                if days:
+                    context.window_usage[(code, window_days)] = sum(
+                        (qty for day, qty in days if start <= day <= claim.visit_date), Decimal("0")
+                    )
+        if i in spend_needed:
+            start = fiscal_year_start(claim.visit_date)
+            totals = defaultdict(lambda: Decimal("0"))
+            for bucket, day, amount in spend.get(claim.patient_id, ()):
+                if start <= day <= claim.visit_date:
+                    totals[bucket] += amount
+            context.non_covered_spent = dict(totals)
+    return contexts
+
+
+def _outcome(index: int, claim: ClaimInput, context, snapshot: RuleSnapshot = None) -> Dict[str, Any]:
+    outcome = {"index": index, "patient_id": claim.patient_id}
+    if isinstance(context, HTTPException):
+        outcome.update(status_code=context.status_code, detail=context.detail)
+        return outcome
+    try:
+        result = evaluate_claim(claim, context, snapshot)
+    except HTTPException as e:
+        outcome.update(status_code=e.status_code, detail=e.detail)
+        return outcome
+    outcome.update(status_code=200 if result["is_locally_valid"] else 422, result=result)
+    return outcome
+
+
+def _evaluate_chunk(chunk: List[Tuple[int, ClaimInput, Any]]) -> List[Dict[str, Any]]:
+    """Runs in a pool worker, against that process's own rule snapshot."""
+    snapshot = get_snapshot()
+    return [_outcome(index, claim, context, snapshot) for index, claim, context in chunk]
+
+
+async def prevalidate_batch(db: AsyncSession, claims: List[ClaimInput]) -> List[Dict[str, Any]]:
+    """Per-claim outcomes in input order: status_code plus the result or the error detail."""
+    snapshot = get_snapshot()
+    contexts = await load_claim_contexts(db, claims, snapshot)
+    outcomes: List[Optional[Dict[str, Any]]] = [None] * len(claims)
+    work = []
+    for i, (claim, context) in enumerate(zip(claims, contexts)):
+        if isinstance(context, HTTPException):
+            outcomes[i] = _outcome(i, claim, context)
+        else:
+            work.append((i, claim, context))
+
+    if config.BATCH_PROCESS_WORKERS > 0 and len(work) >= config.BATCH_PROCESS_MIN_CLAIMS:
+        loop = asyncio.get_running_loop()
+        pool = _get_pool()
+        size = max(1, -(-len(work) // (config.BATCH_PROCESS_WORKERS * 4)))
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(pool, _evaluate_chunk, work[i:i + size]) for i in range(0, len(work), size)
+        ))
+        evaluated = [outcome for chunk in chunks for outcome in chunk]
+    else:
+        # Pure CPU work: keep it off the event loop
+        evaluated = await asyncio.to_thread(
+            lambda: [_outcome(i, claim, context, snapshot) for i, claim, context in work]
+        )
+    for outcome in evaluated:
+        outcomes[outcome["index"]] = outcome
+    return outcomes
@@ -0,0 +1,289 @@
+"""
+Compiled catalog file (catalog.bin) shared by all workers through mmap.
+
+Layout: MAGIC, a little-endian u32 header length and a JSON header, then one
+fixed-size row per entry and a heap with the strings, the per-entry JSON and,
+per table, the full JSON document with its gzip/br bodies and the search
+index postings. Rows hold the hot columns (code, name, type, rate, capping,
+claimable) as offsets and numbers; codes and names are also stored as one
+NUL-joined column per table, so opening the file is two split() calls per
+table. A full entry dict is materialized from its JSON the first time it is
+requested. Everything a worker would otherwise derive at start-up
+(compression, postings) is done once here, by whoever builds the file.
+"""
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from services.catalog_payload import encode_bodies
+from services.catalog_search import CatalogSearchIndex
+
+MAGIC = b"HIBCAT\x00\x01"
+FORMAT_VERSION = 2
+
+# code, name, type (offset u32 + length u16 each), rate_npr f64, max_days i32,
+# max_per_visit i32, claimable u8, entry JSON (offset u32 + length u32)
+_ROW = struct.Struct("<IHIHIHdiiBII")
+_NO_INT = -1
+
+
+def dump_document(obj) -> bytes:
+    """Same bytes EncodedPayload.from_obj produces, so ETags match the JSON path."""
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def file_digest(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _as_int(value) -> int:
+    return value if isinstance(value, int) and not isinstance(value, bool) and value >= 0 else _NO_INT
+
+
+def _as_float(value) -> float:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else math.nan
+
+
+class _Heap:
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.size = 0
+
+    def add(self, data: bytes) -> Tuple[int, int]:
+        offset = self.size
+        self.parts.append(data)
+        self.size += len(data)
+        return offset, len(data)
+
+
+def build_catalog_file(out_path, tables: Dict[str, Tuple[str, List[dict]]], sources: Dict[str, str]) -> Path:
+    """
+    Writes catalog.bin. `tables` maps a table name to (document key, entries),
+    e.g. {"items": ("medicines", [...])}; `sources` holds the sha256 of each
+    JSON file the tables were built from. Written to a temp file and renamed
+    so workers that still map the old file keep a valid view.
+    """
+    out_path = Path(out_path)
+    heap = _Heap()
+    rows = bytearray()
+    header = {"format": FORMAT_VERSION, "sources": sources, "tables": {}}
+
+    for name, (key, entries) in tables.items():
+        first_row = len(rows) // _ROW.size
+        for entry in entries:
+            capping = entry.get("capping") if isinstance(entry.get("capping"), dict) else {}
+            code = heap.add(str(entry["code"]).encode("utf-8"))
+            label = heap.add(str(entry.get("name", "")).encode("utf-8"))
+            kind = heap.add(str(entry.get("type") or "").encode("utf-8"))
+            blob = heap.add(dump_document(entry))
+            rows += _ROW.pack(
+                code[0], code[1], label[0], label[1], kind[0], kind[1],
+                _as_float(entry.get("rate_npr")),
+                _as_int(capping.get("max_days")),
+                _as_int(capping.get("max_per_visit")),
+                1 if entry.get("claimable") else 0,
+                blob[0], blob[1],
+            )
+        bodies = encode_bodies(dump_document({"count": len(entries), key: entries}))
+        encoded = {encoding: list(heap.add(body)) for encoding, body in bodies.items()}
+        search = heap.add(dump_document(CatalogSearchIndex(entries).dump_state()))
+        codes = heap.add("\0".join(str(e["code"]) for e in entries).encode("utf-8"))
+        names = heap.add("\0".join(str(e.get("name", "")) for e in entries).encode("utf-8"))
+        header["tables"][name] = {
+            "first_row": first_row,
+            "rows": len(entries),
+            "bodies": encoded,
+            "search": list(search),
+            "codes": list(codes),
+            "names": list(names),
+        }
+
+    def encode_header(rows_offset: int) -> bytes:
+        header["rows_offset"] = rows_offset
+        header["heap_offset"] = rows_offset + len(rows)
+        return json.dumps(header, separators=(",", ":")).encode("utf-8")
+
+    # The header holds its own end offset; widen until the value is stable
+    prefix = len(MAGIC) + 4
+    raw = encode_header(0)
+    while prefix + len(raw) != header["rows_offset"]:
+        raw = encode_header(prefix + len(raw))
+
+    tmp_path = out_path.with_suffix(out_path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(raw)))
+        f.write(raw)
+        f.write(rows)
+        for part in heap.parts:
+            f.write(part)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+class CatalogFile:
+    """A memory-mapped catalog.bin. Tables are exposed as BinaryCatalog views."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a catalog file")
+        (header_len,) = struct.unpack_from("<I", self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header = json.loads(self._mm[start:start + header_len])
+        if self.header.get("format") != FORMAT_VERSION:
+            raise ValueError(f"{self.path} has format {self.header.get('format')}, expected {FORMAT_VERSION}")
+        self.sources: Dict[str, str] = self.header["sources"]
+        self._rows_offset = self.header["rows_offset"]
+        self._heap_offset = self.header["heap_offset"]
+        self.tables = {name: BinaryCatalog(self, name, meta) for name, meta in self.header["tables"].items()}
+
+    def row(self, index: int) -> tuple:
+        return _ROW.unpack_from(self._mm, self._rows_offset + index * _ROW.size)
+
+    def text(self, offset: int, length: int) -> str:
+        start = self._heap_offset + offset
+        return self._mm[start:start + length].decode("utf-8")
+
+    def blob(self, offset: int, length: int) -> memoryview:
+        start = self._heap_offset + offset
+        return memoryview(self._mm)[start:start + length]
+
+    def matches(self, sources: Dict[str, str]) -> bool:
+        return all(self.sources.get(name) == digest for name, digest in sources.items())
+
+
+class BinaryCatalog(Mapping):
+    """
+    code -> entry view over one table. Entries are decoded from the mapped
+    file on first access and kept, so repeated lookups return the same dict.
+    """
+
+    def __init__(self, catalog_file: CatalogFile, name: str, meta: dict):
+        self.file = catalog_file
+        self.name = name
+        self._first = meta["first_row"]
+        self._count = meta["rows"]
+        self._bodies = {encoding: tuple(span) for encoding, span in meta["bodies"].items()}
+        self._search = tuple(meta["search"])
+        self._entries: List[Optional[dict]] = [None] * self._count
+        self.codes: List[str] = self.file.text(*meta["codes"]).split("\0") if self._count else []
+        self.names: List[str] = self.file.text(*meta["names"]).split("\0") if self._count else []
+        if len(self.codes) != self._count or len(self.names) != self._count:
+            raise ValueError(f"{catalog_file.path}: {name} code/name columns do not match its rows")
+        self._by_code: Dict[str, int] = dict(zip(self.codes, range(self._count)))
+
+    def entry(self, i: int) -> dict:
+        entry = self._entries[i]
+        if entry is None:
+            blob_off, blob_len = self.file.row(self._first + i)[-2:]
+            entry = self._entries[i] = json.loads(bytes(self.file.blob(blob_off, blob_len)))
+        return entry
+
+    def position(self, code: str) -> Optional[int]:
+        return self._by_code.get(code)
+
+    def rate_npr(self, code: str) -> Optional[float]:
+        i = self._by_code.get(str(code))
+        if i is None:
+            return None
+        rate = self.file.row(self._first + i)[6]
+        return None if math.isnan(rate) else rate
+
+    def capping(self, code: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """(max_days, max_per_visit) when they are plain integers."""
+        i = self._by_code.get(str(code))
+        if i is None:
+            return None
+        max_days, max_per_visit = self.file.row(self._first + i)[7:9]
+        return (None if max_days == _NO_INT else max_days, None if max_per_visit == _NO_INT else max_per_visit)
+
+    def bodies(self) -> Dict[str, bytes]:
+        """The table's full {"count", key: [...]} JSON per Content-Encoding, encoded at build time."""
+        return {encoding: bytes(self.file.blob(*span)) for encoding, span in self._bodies.items()}
+
+    def search_state(self) -> dict:
+        """CatalogSearchIndex.dump_state() of this table, computed at build time."""
+        return json.loads(bytes(self.file.blob(*self._search)))
+
+    def entries(self) -> "LazyEntries":
+        return LazyEntries(self)
+
+    def get(self, code, default=None):
+        i = self._by_code.get(str(code))
+        return default if i is None else self.entry(i)
+
+    def __getitem__(self, code) -> dict:
+        i = self._by_code.get(str(code))
+        if i is None:
+            raise KeyError(code)
+        return self.entry(i)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._by_code)
+
+    def __len__(self) -> int:
+        return len(self._by_code)
+
+    def __contains__(self, code) -> bool:
+        return str(code) in self._by_code
+
+
+class LazyEntries(Sequence):
+    """Entries of a BinaryCatalog in file order, materialized on access."""
+
+    def __init__(self, catalog: BinaryCatalog):
+        self._catalog = catalog
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._catalog.entry(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._catalog.entry(i)
+
+    def __len__(self) -> int:
+        return len(self._catalog.codes)
+
+    # Concatenates like the lists the JSON catalogs load as (get_all_items() + get_all_services())
+    def __add__(self, other):
+        return [*self, *other]
+
+    def __radd__(self, other):
+        return [*other, *self]
+
+
+class MergedCodes(Mapping):
+    """One-probe code lookup across tables; earlier tables win on duplicate codes."""
+
+    def __init__(self, *catalogs: BinaryCatalog):
+        self._index: Dict[str, Tuple[BinaryCatalog, int]] = {}
+        for catalog in reversed(catalogs):
+            for code in catalog:
+                self._index[code] = (catalog, catalog.position(code))
+
+    def get(self, code, default=None):
+        hit = self._index.get(code)
+        return default if hit is None else hit[0].entry(hit[1])
+
+    def __getitem__(self, code) -> dict:
+        hit = self._index.get(code)
+        if hit is None:
+            raise KeyError(code)
+        return hit[0].entry(hit[1])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
@@ -0,0 +1,95 @@
+import gzip
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def _etags(header: str) -> set:
+    return {tag.strip().removeprefix("W/") for tag in (header or "").split(",") if tag.strip()}
+
+
+def encode_bodies(plain: bytes, known: Optional[Dict[str, bytes]] = None) -> Dict[str, bytes]:
+    """identity, gzip and (with brotli installed) br bodies of `plain`, reusing those already in `known`."""
+    known = known or {}
+    bodies = {"identity": plain}
+    bodies["gzip"] = known.get("gzip") or gzip.compress(plain, compresslevel=9, mtime=0)
+    if "br" in known or brotli is not None:
+        bodies["br"] = known.get("br") or brotli.compress(plain, quality=11)
+    return bodies
+
+
+@dataclass(frozen=True)
+class EncodedPayload:
+    """
+    A JSON document encoded once: plain, gzip and (when the brotli package
+    is installed) br bodies, each with its own strong ETag. `stamp` records
+    the source file version the bytes were built from.
+    """
+    stamp: Any
+    bodies: Dict[str, bytes] = field(repr=False)
+    etags: Dict[str, str]
+    cache_control: str
+
+    @classmethod
+    def from_obj(cls, obj, stamp=None, cache_control: str = "no-cache") -> "EncodedPayload":
+        plain = json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        return cls.from_json_bytes(plain, stamp, cache_control)
+
+    @classmethod
+    def from_json_bytes(cls, plain: bytes, stamp=None, cache_control: str = "no-cache") -> "EncodedPayload":
+        return cls.from_bodies(encode_bodies(plain), stamp, cache_control)
+
+    @classmethod
+    def from_bodies(cls, bodies: Dict[str, bytes], stamp=None, cache_control: str = "no-cache") -> "EncodedPayload":
+        """`bodies` as returned by encode_bodies (e.g. stored in catalog.bin); missing encodings are filled in."""
+        bodies = encode_bodies(bodies["identity"], bodies)
+        digest = hashlib.sha256(bodies["identity"]).hexdigest()[:32]
+        etags = {enc: f'"{digest}"' if enc == "identity" else f'"{digest}-{enc}"' for enc in bodies}
+        return cls(stamp=stamp, bodies=bodies, etags=etags, cache_control=cache_control)
+
+    def negotiate(self, accept_encoding: str) -> Tuple[str, bytes]:
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.bodies and (encoding in accepted or "*" in accepted):
+                return encoding, self.bodies[encoding]
+        return "identity", self.bodies["identity"]
+
+    def response(self, request: Request) -> Response:
+        encoding, body = self.negotiate(request.headers.get("accept-encoding", ""))
+        headers = {
+            "ETag": self.etags[encoding],
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = _etags(request.headers.get("if-none-match", ""))
+        if "*" in if_none_match or if_none_match & set(self.etags.values()):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,135 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, Iterator, List, Sequence
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _SPACES_RE.sub(" ", (text or "").lower()).strip()
+
+
+def _grams(text: str, n: int) -> set:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class CatalogSearchIndex:
+    """
+    Typeahead index over an items.json / services.json list.
+
+    Names are normalized once. A query matches every entry whose normalized
+    name contains it (the same result set as the old linear scan), ranked:
+    name prefix, word prefix, then any other substring; with match_code an
+    entry whose code equals the query comes first. Prefix tiers are answered
+    by bisecting sorted keys; substrings walk the shortest bigram/trigram
+    posting list and stop as soon as `limit` entries matched.
+    """
+
+    def __init__(self, entries: Sequence[dict], names: Sequence[str] = None, codes: Sequence[str] = None,
+                 state: dict = None):
+        """
+        `names`/`codes` spare reading them from the entries (lazily materialized
+        catalogs); `state` is a dump_state() of an index over the same entries,
+        stored in catalog.bin so workers skip building the postings.
+        """
+        self.entries = entries
+        if names is None:
+            names = [e.get("name", "") for e in entries]
+        if codes is None:
+            codes = [e.get("code", "") for e in entries]
+        self._codes: Dict[str, int] = {}
+        for idx, code in enumerate(codes):
+            self._codes.setdefault(str(code).lower(), idx)
+        if state is None:
+            state = self._build([normalize(n) for n in names])
+        self._names: List[str] = state["names"]
+        self._name_ids: List[int] = state["name_ids"]
+        self._name_keys = [self._names[i] for i in self._name_ids]
+        self._token_keys: List[str] = state["token_keys"]
+        self._token_ids: List[int] = state["token_ids"]
+        self._postings: Dict[str, List[int]] = state["postings"]
+        if len(self._names) != len(entries):
+            raise ValueError("search index state does not match the catalog entries")
+
+    @staticmethod
+    def _build(names: List[str]) -> dict:
+        names_sorted = []
+        tokens_sorted = []
+        postings = defaultdict(list)
+        for idx, name in enumerate(names):
+            names_sorted.append((name, idx))
+            for token in set(_TOKEN_RE.findall(name)):
+                tokens_sorted.append((token, idx))
+            for gram in _grams(name, 2) | _grams(name, 3):
+                postings[gram].append(idx)
+        names_sorted.sort()
+        tokens_sorted.sort()
+        return {
+            "names": names,
+            "name_ids": [i for _, i in names_sorted],
+            "token_keys": [t for t, _ in tokens_sorted],
+            "token_ids": [i for _, i in tokens_sorted],
+            "postings": dict(postings),
+        }
+
+    def dump_state(self) -> dict:
+        """JSON-serializable form of the derived index, accepted back as `state`."""
+        return {
+            "names": self._names,
+            "name_ids": self._name_ids,
+            "token_keys": self._token_keys,
+            "token_ids": self._token_ids,
+            "postings": self._postings,
+        }
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_by_code(self, code: str):
+        idx = self._codes.get(str(code).strip().lower())
+        return None if idx is None else self.entries[idx]
+
+    def search(self, query: str, limit: int = 15, match_code: bool = False) -> List[dict]:
+        query = normalize(query)
+        if not query or limit <= 0:
+            return []
+        found: List[int] = []
+        seen = set()
+        for idx in self._candidates(query, match_code):
+            if idx not in seen:
+                seen.add(idx)
+                found.append(idx)
+                if len(found) >= limit:
+                    break
+        return [self.entries[i] for i in found]
+
+    def _candidates(self, query: str, match_code: bool) -> Iterator[int]:
+        if match_code and query in self._codes:
+            yield self._codes[query]
+        yield from self._prefix(self._name_keys, self._name_ids, query)
+        if " " not in query:
+            yield from self._prefix(self._token_keys, self._token_ids, query)
+        yield from self._substring(query)
+
+    @staticmethod
+    def _prefix(keys: List[str], ids: List[int], query: str) -> Iterator[int]:
+        pos = bisect_left(keys, query)
+        while pos < len(keys) and keys[pos].startswith(query):
+            yield ids[pos]
+            pos += 1
+
+    def _substring(self, query: str) -> Iterator[int]:
+        if len(query) < 2:
+            candidates: Sequence[int] = range(len(self._names))
+        else:
+            n = 2 if len(query) == 2 else 3
+            lists = [self._postings.get(g) for g in _grams(query, n)]
+            if not all(lists):
+                return
+            candidates = min(lists, key=len)
+        names = self._names
+        for idx in candidates:
+            if query in names[idx]:
+                yield idx
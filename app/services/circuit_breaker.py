@@ -0,0 +1,167 @@
+"""
+Circuit breakers for outbound IMIS calls, one per operation.
+
+A breaker looks at its last IMIS_BREAKER_WINDOW calls. It opens when at
+least IMIS_BREAKER_MIN_CALLS were made and either the failure rate
+(exceptions, 429 and 5xx answers) or the slow call rate reaches its
+threshold. While open, calls fail at once with CircuitOpenError. After
+IMIS_BREAKER_OPEN_SECONDS a few probe calls are let through (half-open):
+enough successes close it again, any failure reopens it.
+
+Each breaker also tracks the latency of successful calls and derives the
+read timeout from it: the p99 times IMIS_TIMEOUT_P99_FACTOR, kept between
+IMIS_TIMEOUT_MIN and the operation's configured timeout. Breakers created
+with adaptive_timeout=False always use the configured timeout.
+"""
+import math
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling IMIS while the operation's breaker is open."""
+
+    def __init__(self, operation: str, retry_after: float):
+        self.operation = operation
+        self.retry_after = retry_after
+        super().__init__(f"IMIS {operation} calls are suspended after repeated failures; retry in {math.ceil(retry_after)}s")
+
+
+def percentile(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        max_timeout: float,
+        window: int = None,
+        min_calls: int = None,
+        failure_rate: float = None,
+        slow_call_seconds: float = None,
+        slow_call_rate: float = None,
+        open_seconds: float = None,
+        half_open_probes: int = None,
+        adaptive_timeout: bool = True,
+    ):
+        self.name = name
+        self.max_timeout = max_timeout
+        self.adaptive_timeout = adaptive_timeout
+        self.min_calls = config.IMIS_BREAKER_MIN_CALLS if min_calls is None else min_calls
+        self.failure_rate = config.IMIS_BREAKER_FAILURE_RATE if failure_rate is None else failure_rate
+        self.slow_call_seconds = config.IMIS_BREAKER_SLOW_CALL_SECONDS if slow_call_seconds is None else slow_call_seconds
+        self.slow_call_rate = config.IMIS_BREAKER_SLOW_CALL_RATE if slow_call_rate is None else slow_call_rate
+        self.open_seconds = config.IMIS_BREAKER_OPEN_SECONDS if open_seconds is None else open_seconds
+        self.half_open_probes = max(1, config.IMIS_BREAKER_HALF_OPEN_PROBES if half_open_probes is None else half_open_probes)
+
+        # (failed, slow) per recent call
+        self._outcomes = deque(maxlen=config.IMIS_BREAKER_WINDOW if window is None else window)
+        self._latencies = deque(maxlen=config.IMIS_TIMEOUT_SAMPLES)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.counters = {"calls": 0, "successes": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "opened": 0}
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self._opened_at = now
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.counters["opened"] += 1
+
+    def before_call(self):
+        """Raises CircuitOpenError unless a call may go to IMIS now."""
+        now = time.monotonic()
+        if self.state == OPEN:
+            remaining = self._opened_at + self.open_seconds - now
+            if remaining > 0:
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(self.name, remaining)
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probes_in_flight >= self.half_open_probes:
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(self.name, self.open_seconds)
+            self._probes_in_flight += 1
+        self.counters["calls"] += 1
+
+    def record(self, success: bool, latency: float):
+        slow = latency >= self.slow_call_seconds
+        self.counters["successes" if success else "failures"] += 1
+        if slow:
+            self.counters["slow_calls"] += 1
+        if success:
+            self._latencies.append(latency)
+
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            if not success or slow:
+                self._open(now)
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_probes:
+                self.state = CLOSED
+                self._outcomes.clear()
+            return
+        if self.state == OPEN:
+            # A call started before the breaker opened
+            return
+
+        self._outcomes.append((not success, slow))
+        calls = len(self._outcomes)
+        if calls < self.min_calls:
+            return
+        failures = sum(1 for failed, _ in self._outcomes if failed)
+        slow_calls = sum(1 for _, was_slow in self._outcomes if was_slow)
+        if failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate:
+            self._open(now)
+
+    def cancelled(self):
+        """The call was abandoned by its caller; it says nothing about IMIS."""
+        if self.state == HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def timeout(self) -> float:
+        """Read timeout for the next call, derived from recent successful latencies."""
+        if (
+            not (config.IMIS_ADAPTIVE_TIMEOUTS and self.adaptive_timeout)
+            or len(self._latencies) < config.IMIS_TIMEOUT_MIN_SAMPLES
+        ):
+            return self.max_timeout
+        p99 = percentile(self._latencies, 0.99)
+        return min(self.max_timeout, max(config.IMIS_TIMEOUT_MIN, p99 * config.IMIS_TIMEOUT_P99_FACTOR))
+
+    def reset(self):
+        self.state = CLOSED
+        self._outcomes.clear()
+        self._latencies.clear()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    def stats(self) -> Dict:
+        calls = len(self._outcomes)
+        failures = sum(1 for failed, _ in self._outcomes if failed)
+        return {
+            "state": self.state,
+            "window_calls": calls,
+            "window_failure_rate": round(failures / calls, 3) if calls else 0.0,
+            "timeout_seconds": round(self.timeout(), 3),
+            "latency_p50": percentile(self._latencies, 0.5),
+            "latency_p99": percentile(self._latencies, 0.99),
+            "retry_after": max(0.0, round(self._opened_at + self.open_seconds - time.monotonic(), 1))
+            if self.state == OPEN else None,
+            **self.counters,
+        }
@@ -0,0 +1,69 @@
+from decimal import Decimal
+from typing import List
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from insurance_database import ClaimLine, ImisResponse
+
+
+def build_claim_lines(imis_record: ImisResponse) -> List[ClaimLine]:
+    """
+    Normalized lines for a stored claim: the submitted `item_code` list, in
+    FHIR sequence order, joined with the adjudication `items` from IMIS.
+    """
+    adjudication = {}
+    for adj in imis_record.items or []:
+        seq = adj.get("sequence_id")
+        if seq is not None and adj.get("status"):
+            adjudication.setdefault(int(seq), adj.get("status"))
+
+    lines = []
+    for sequence, line in enumerate(imis_record.item_code or [], start=1):
+        if not line.get("item_code"):
+            continue
+        lines.append(ClaimLine(
+            imis_response_id=imis_record.id,
+            sequence=sequence,
+            item_code=str(line["item_code"]),
+            name=line.get("name"),
+            qty=int(Decimal(str(line.get("qty", 0) or 0))),
+            cost=Decimal(str(line.get("cost", line.get("rate", 0)) or 0)),
+            category=line.get("category"),
+            type=line.get("type"),
+            adjudication_status=adjudication.get(sequence),
+        ))
+    return lines
+
+
+async def record_claim_lines(db: AsyncSession, imis_record: ImisResponse) -> List[ClaimLine]:
+    """Adds the normalized lines of a freshly stored claim; the caller commits."""
+    if imis_record.id is None:
+        await db.flush()
+    lines = build_claim_lines(imis_record)
+    db.add_all(lines)
+    return lines
+
+
+def backfill_claim_lines(db: Session, batch_size: int = 500) -> int:
+    """Creates claim_lines for stored claims that only have the JSON columns."""
+    has_lines = db.query(ClaimLine.id).filter(ClaimLine.imis_response_id == ImisResponse.id).exists()
+    created = 0
+    last_id = 0
+    while True:
+        claims = (
+            db.query(ImisResponse)
+            .filter(ImisResponse.id > last_id)
+            .filter(~has_lines)
+            .order_by(ImisResponse.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not claims:
+            return created
+        for claim in claims:
+            lines = build_claim_lines(claim)
+            db.add_all(lines)
+            created += len(lines)
+        last_id = claims[-1].id
+        db.commit()
@@ -0,0 +1,346 @@
+"""
+Durable claim submission. /submit_claim/async stores the claim in the
+claim_outbox table and answers immediately; run_worker (started in the
+lifespan) sends due rows to IMIS and retries timeouts, 429 and 5xx answers
+with exponential backoff and jitter until OUTBOX_GIVE_UP_HOURS after the
+claim was queued; calls the open circuit breaker turned away are not
+counted as attempts. Every attempt of a row carries the same ACSN, and an
+attempt that may have reached IMIS is first looked up by that ACSN so a
+retry never files the claim twice.
+
+The submitter's IMIS password is kept only until the row is final, and only
+encrypted with OUTBOX_CREDENTIALS_KEY, which never goes into the database.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from insurance_database import AsyncSessionLocal, ClaimOutbox, PatientInformation
+from model import ClaimInput
+from services import imis_services
+from services.circuit_breaker import CircuitOpenError
+from services.claim_submission import (
+    build_claim_payload,
+    claim_identifier,
+    claim_response_from_claim,
+    claim_total,
+    parse_claim_response,
+    store_claims,
+)
+from services.patient_eligibility import mark_needs_refresh
+
+logger = logging.getLogger(__name__)
+
+FINAL_STATUSES = ("succeeded", "failed", "dead")
+RETRY_STATUS_CODES = {408, 425, 429}
+# Claims read per ACSN search; IMIS may return near matches before the exact one
+ACSN_LOOKUP_PAGE_SIZE = 10
+
+# Set by enqueue so the worker in this process picks new rows up without waiting a poll interval
+_wakeup = asyncio.Event()
+
+
+def idempotency_key(claim: ClaimInput, key: Optional[str] = None) -> str:
+    """
+    The caller's Idempotency-Key, else one derived from the whole claim body
+    (credentials aside): claim_code is optional, so patient, visit and
+    service type alone would merge different claims and swallow corrected
+    resubmissions. Only a byte-for-byte repeat of the claim is deduplicated.
+    """
+    if key:
+        return hashlib.sha256(f"key:{key}".encode()).hexdigest()
+    body = json.dumps(claim.model_dump(mode="json", exclude={"username", "password"}), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"claim:{body}".encode()).hexdigest()
+
+
+def credentials_configured() -> bool:
+    return bool(config.OUTBOX_CREDENTIALS_KEY)
+
+
+@lru_cache(maxsize=1)
+def _fernet(key: str) -> Fernet:
+    return Fernet(key)
+
+
+def seal_password(password: str) -> str:
+    return _fernet(config.OUTBOX_CREDENTIALS_KEY).encrypt(password.encode()).decode()
+
+
+def _credentials(entry: ClaimOutbox) -> Tuple[str, str]:
+    """The submitter's username and password; InvalidToken when the key cannot read the password."""
+    if not entry.password:
+        raise InvalidToken
+    return entry.username, _fernet(config.OUTBOX_CREDENTIALS_KEY).decrypt(entry.password.encode()).decode()
+
+
+def backoff_delay(attempts: int) -> float:
+    """Exponential backoff with jitter in [delay/2, delay]."""
+    delay = min(config.OUTBOX_BACKOFF_MAX, config.OUTBOX_BACKOFF_BASE * 2 ** max(0, attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def describe(entry: ClaimOutbox) -> Dict[str, Any]:
+    return {
+        "id": entry.id,
+        "acsn": entry.acsn,
+        "patient_id": entry.patient_id,
+        "claim_code": entry.claim_code,
+        "status": entry.status,
+        "attempts": entry.attempts,
+        "next_attempt_at": entry.next_attempt_at.isoformat() if entry.status not in FINAL_STATUSES else None,
+        "last_status_code": entry.last_status_code,
+        "last_error": entry.last_error,
+        "imis_response_id": entry.imis_response_id,
+        "created_at": entry.created_at.isoformat() if entry.created_at else None,
+        "completed_at": entry.completed_at.isoformat() if entry.completed_at else None,
+    }
+
+
+async def _by_key(db: AsyncSession, ikey: str) -> Optional[ClaimOutbox]:
+    return (await db.execute(select(ClaimOutbox).where(ClaimOutbox.idempotency_key == ikey))).scalars().first()
+
+
+async def enqueue(
+    db: AsyncSession, claim: ClaimInput, patient: PatientInformation, key: Optional[str] = None
+) -> tuple:
+    """
+    (entry, created). A claim already in the outbox is returned as is while
+    it is pending or succeeded; a failed or dead one is queued again under
+    its original ACSN. Of two identical requests racing to insert the row,
+    the second gets the first one's entry.
+    """
+    ikey = idempotency_key(claim, key)
+    entry = await _by_key(db, ikey)
+    if entry is not None and entry.status not in ("failed", "dead"):
+        return entry, False
+
+    acsn = entry.acsn if entry is not None else uuid.uuid4().hex
+    now = datetime.utcnow()
+    values = dict(
+        patient_id=claim.patient_id,
+        claim_code=claim.claim_code,
+        claim=claim.model_dump(mode="json", exclude={"username", "password"}),
+        payload=build_claim_payload(claim, patient.patient_uuid, acsn),
+        username=claim.username,
+        password=seal_password(claim.password),
+        status="pending",
+        attempts=0,
+        # a claim queued again gets a fresh OUTBOX_GIVE_UP_HOURS
+        created_at=now,
+        next_attempt_at=now,
+        locked_until=None,
+        # IMIS may hold the claim from the earlier round; check before resending
+        needs_lookup=entry is not None,
+        last_status_code=None,
+        last_error=None,
+        completed_at=None,
+    )
+    if entry is None:
+        entry = ClaimOutbox(idempotency_key=ikey, acsn=acsn, **values)
+        db.add(entry)
+    else:
+        for name, value in values.items():
+            setattr(entry, name, value)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        existing = await _by_key(db, ikey)
+        if existing is None:
+            raise
+        return existing, False
+    _wakeup.set()
+    return entry, True
+
+
+async def get_entry(db: AsyncSession, entry_id: int) -> Optional[ClaimOutbox]:
+    return await db.get(ClaimOutbox, entry_id)
+
+
+async def queue_stats(db: AsyncSession) -> Dict[str, Any]:
+    rows = (await db.execute(
+        select(ClaimOutbox.status, func.count(), func.min(ClaimOutbox.created_at)).group_by(ClaimOutbox.status)
+    )).all()
+    counts = {status: count for status, count, _ in rows}
+    oldest = min((created for status, _, created in rows if status in ("pending", "in_flight")), default=None)
+    return {"counts": counts, "oldest_unsent_at": oldest.isoformat() if oldest else None}
+
+
+async def _claim_due(limit: int) -> List[int]:
+    """
+    Leases up to `limit` due rows to this worker. A row left in_flight by a
+    worker that died is taken over once its lease expires.
+    """
+    now = datetime.utcnow()
+    lease = now + timedelta(seconds=config.IMIS_CLAIM_TIMEOUT + config.IMIS_CONNECT_TIMEOUT + 30)
+    due = or_(
+        and_(ClaimOutbox.status == "pending", ClaimOutbox.next_attempt_at <= now),
+        and_(ClaimOutbox.status == "in_flight", ClaimOutbox.locked_until < now),
+    )
+    claimed = []
+    async with AsyncSessionLocal() as db:
+        candidates = (await db.execute(
+            select(ClaimOutbox.id, ClaimOutbox.status).where(due).order_by(ClaimOutbox.next_attempt_at).limit(limit)
+        )).all()
+        for entry_id, status in candidates:
+            values = {"status": "in_flight", "locked_until": lease}
+            if status == "in_flight":
+                values["needs_lookup"] = True
+            # Conditional update: another worker that leased the row first wins
+            result = await db.execute(
+                update(ClaimOutbox).where(ClaimOutbox.id == entry_id).where(due).values(**values)
+            )
+            if result.rowcount == 1:
+                claimed.append(entry_id)
+        await db.commit()
+    return claimed
+
+
+async def _lookup_existing(entry: ClaimOutbox, client: httpx.AsyncClient) -> Optional[str]:
+    """
+    The ClaimResponse of the claim IMIS holds under this ACSN, as JSON text,
+    if any. Only a claim whose own ACSN identifier matches counts: IMIS may
+    match the identifier search loosely.
+    """
+    username, password = _credentials(entry)
+    found = await imis_services.get_all_claims(
+        username, password, page_size=ACSN_LOOKUP_PAGE_SIZE, identifier=entry.acsn, client=client
+    )
+    if not found.get("success"):
+        raise RuntimeError(f"ACSN lookup failed: {found.get('status') or found.get('error')}")
+    entries = (found.get("data") or {}).get("entry") or []
+    claim = next(
+        (e.get("resource") or {} for e in entries if claim_identifier(e.get("resource") or {}, "ACSN") == entry.acsn),
+        None,
+    )
+    if claim is None:
+        return None
+
+    # A Claim has no outcome; the adjudication is in its ClaimResponse
+    answer = await imis_services.get_claim_response(claim.get("id"), username, password, client=client)
+    if answer.get("success"):
+        return json.dumps(answer.get("data") or {})
+    if answer.get("status") == 404:
+        return json.dumps(claim_response_from_claim(claim))
+    raise RuntimeError(f"ClaimResponse lookup failed: {answer.get('status') or answer.get('error')}")
+
+
+async def _send(entry: ClaimOutbox, client: httpx.AsyncClient) -> Dict[str, Any]:
+    """
+    One delivery attempt: {"outcome": succeeded|failed|retry, ...}. "sent"
+    tells whether IMIS may have received the claim even though no answer came.
+    """
+    try:
+        username, password = _credentials(entry)
+    except InvalidToken:
+        return {"outcome": "failed", "error": "Stored IMIS credentials cannot be decrypted; was OUTBOX_CREDENTIALS_KEY changed?"}
+    try:
+        if entry.needs_lookup:
+            existing = await _lookup_existing(entry, client)
+            if existing is not None:
+                return {"outcome": "succeeded", "status": 200, "response": existing}
+        result = await imis_services.submit_claim(entry.payload, username, password, client=client)
+    except CircuitOpenError as exc:
+        return {"outcome": "retry", "error": str(exc), "sent": False, "retry_after": exc.retry_after, "rejected": True}
+    except (httpx.ConnectError, httpx.ConnectTimeout) as exc:
+        return {"outcome": "retry", "error": f"{type(exc).__name__}: {exc}", "sent": entry.needs_lookup}
+    except Exception as exc:
+        return {"outcome": "retry", "error": f"{type(exc).__name__}: {exc}", "sent": True}
+
+    status = result.get("status")
+    if result.get("success"):
+        return {"outcome": "succeeded", "status": status, "response": result.get("response")}
+    error = (result.get("response") or "")[:2000]
+    if status in RETRY_STATUS_CODES or (status or 0) >= 500:
+        return {"outcome": "retry", "status": status, "error": error, "sent": False}
+    return {"outcome": "failed", "status": status, "error": error}
+
+
+def _finish(entry: ClaimOutbox, status: str, now: datetime):
+    entry.status = status
+    entry.completed_at = now
+    entry.locked_until = None
+    entry.username = None
+    entry.password = None
+
+
+async def _deliver(entry_id: int, client: httpx.AsyncClient):
+    async with AsyncSessionLocal() as db:
+        entry = await db.get(ClaimOutbox, entry_id)
+        if entry is None or entry.status != "in_flight":
+            return
+        # No transaction is held open while IMIS answers
+        await db.commit()
+
+        result = await _send(entry, client)
+        now = datetime.utcnow()
+        if not result.get("rejected"):
+            entry.attempts += 1
+        entry.last_status_code = result.get("status")
+        entry.last_error = result.get("error")
+
+        if result["outcome"] == "succeeded":
+            claim = ClaimInput.model_validate({**entry.claim, "username": "", "password": ""})
+            parsed = parse_claim_response(result.get("response"))
+            (record,) = await store_claims(db, [(claim, parsed)])
+            entry.imis_response_id = record.id
+            entry.needs_lookup = False
+            _finish(entry, "succeeded", now)
+            await mark_needs_refresh(db, entry.patient_id, claim_total(claim))
+        elif result["outcome"] == "failed":
+            _finish(entry, "failed", now)
+        elif now - entry.created_at >= timedelta(hours=config.OUTBOX_GIVE_UP_HOURS):
+            _finish(entry, "dead", now)
+        else:
+            entry.status = "pending"
+            entry.locked_until = None
+            entry.needs_lookup = entry.needs_lookup or result.get("sent", False)
+            delay = max(backoff_delay(entry.attempts), result.get("retry_after", 0))
+            entry.next_attempt_at = now + timedelta(seconds=delay)
+        await db.commit()
+
+    if result["outcome"] != "succeeded":
+        logger.warning(
+            "Outbox claim %s (ACSN %s) attempt %d: %s %s",
+            entry.id, entry.acsn, entry.attempts, entry.status, entry.last_error,
+        )
+
+
+async def drain_once(client: Optional[httpx.AsyncClient] = None) -> int:
+    """Sends one batch of due rows; returns how many were attempted."""
+    client = client or imis_services.get_imis_client()
+    entry_ids = await _claim_due(config.OUTBOX_BATCH_SIZE)
+    results = await asyncio.gather(*(_deliver(entry_id, client) for entry_id in entry_ids), return_exceptions=True)
+    for entry_id, result in zip(entry_ids, results):
+        if isinstance(result, Exception):
+            # The lease expires and the row is retried (after an ACSN lookup)
+            logger.error("Outbox claim %s delivery failed", entry_id, exc_info=result)
+    return len(entry_ids)
+
+
+async def run_worker(interval: float = None):
+    interval = config.OUTBOX_POLL_INTERVAL if interval is None else interval
+    while True:
+        _wakeup.clear()
+        try:
+            if await drain_once():
+                continue
+        except Exception:
+            logger.exception("Claim outbox worker failed")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,207 @@
+"""
+Read side of the stored IMIS claims: keyset-paginated pages and an NDJSON
+export, newest claim code first. Only the summary columns are read unless
+the raw IMIS JSON is asked for.
+"""
+import base64
+import json
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from insurance_database import AsyncSessionLocal, ClaimLine, ImisResponse, PatientInformation
+
+SUMMARY_COLUMNS = (
+    ImisResponse.id,
+    ImisResponse.patient_id,
+    ImisResponse.claim_code,
+    ImisResponse.status,
+    ImisResponse.created_at,
+    ImisResponse.fetched_at,
+    ImisResponse.service_type,
+    ImisResponse.service_code,
+    ImisResponse.department,
+)
+RAW_COLUMNS = (
+    ImisResponse.items,
+    ImisResponse.item_code,
+    ImisResponse.raw_response,
+)
+
+EXPORT_PAGE_SIZE = 500
+
+
+@dataclass
+class ClaimFilters:
+    patient_id: Optional[str] = None
+    status: Optional[str] = None
+    service_type: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+
+    def apply(self, stmt):
+        if self.patient_id:
+            stmt = stmt.where(ImisResponse.patient_id == self.patient_id)
+        if self.status:
+            stmt = stmt.where(ImisResponse.status == self.status)
+        if self.service_type:
+            stmt = stmt.where(ImisResponse.service_type == self.service_type)
+        if self.date_from:
+            stmt = stmt.where(ImisResponse.created_at >= datetime.combine(self.date_from, time.min))
+        if self.date_to:
+            stmt = stmt.where(ImisResponse.created_at <= datetime.combine(self.date_to, time.max))
+        return stmt
+
+
+def encode_cursor(claim_code: str, claim_id: int) -> str:
+    raw = json.dumps([claim_code, claim_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        claim_code, claim_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(claim_code), int(claim_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _after(after: Tuple[str, int]):
+    claim_code, claim_id = after
+    return or_(
+        ImisResponse.claim_code < claim_code,
+        and_(ImisResponse.claim_code == claim_code, ImisResponse.id < claim_id),
+    )
+
+
+def _claims_query(filters: ClaimFilters, include_raw: bool, after: Optional[Tuple[str, int]], limit: int):
+    stmt = filters.apply(select(*SUMMARY_COLUMNS, *(RAW_COLUMNS if include_raw else ())))
+    if after is not None:
+        stmt = stmt.where(_after(after))
+    return stmt.order_by(ImisResponse.claim_code.desc(), ImisResponse.id.desc()).limit(limit)
+
+
+def _page(rows, limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    results = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = results[-1]
+        next_cursor = encode_cursor(last["claim_code"], last["id"])
+    return results, next_cursor
+
+
+async def fetch_claims_page(
+    db: AsyncSession,
+    filters: ClaimFilters,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    include_raw: bool = False,
+) -> Dict[str, Any]:
+    """One page plus the cursor of the next one (None on the last page)."""
+    after = decode_cursor(cursor) if cursor else None
+    rows = (await db.execute(_claims_query(filters, include_raw, after, limit + 1))).mappings().all()
+    results, next_cursor = _page(rows, limit)
+    return {"count": len(results), "results": results, "next_cursor": next_cursor}
+
+
+async def fetch_patient_claims_page(
+    db: AsyncSession,
+    patient_uuid: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    include_raw: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """
+    A page of one patient's claims, found by patient UUID, in a single
+    query: the patient row is outer-joined to its claims so an unknown
+    patient (None) is told apart from one without claims.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    first_patient = (
+        select(func.min(PatientInformation.id))
+        .where(PatientInformation.patient_uuid == patient_uuid)
+        .scalar_subquery()
+    )
+    on = ImisResponse.patient_id == PatientInformation.patient_code
+    if after is not None:
+        on = and_(on, _after(after))
+    stmt = (
+        select(
+            PatientInformation.patient_code.label("patient_code"),
+            *(c.label(f"claim_{c.key}") for c in SUMMARY_COLUMNS + (RAW_COLUMNS if include_raw else ())),
+        )
+        .select_from(PatientInformation)
+        .outerjoin(ImisResponse, on)
+        .where(PatientInformation.id == first_patient)
+        .order_by(ImisResponse.claim_code.desc(), ImisResponse.id.desc())
+        .limit(limit + 1)
+    )
+    rows = (await db.execute(stmt)).mappings().all()
+    if not rows:
+        return None
+    claims = [
+        {key[len("claim_"):]: value for key, value in row.items() if key.startswith("claim_")}
+        for row in rows if row["claim_id"] is not None
+    ]
+    results, next_cursor = _page(claims, limit)
+    return {
+        "patient_code": rows[0]["patient_code"],
+        "patient_uuid": patient_uuid,
+        "count": len(results),
+        "results": results,
+        "next_cursor": next_cursor,
+    }
+
+
+async def fetch_claim_status(db: AsyncSession, claim_code: str) -> Optional[Dict[str, Any]]:
+    """Stored status and line adjudication of the latest claim with this code (None if unknown)."""
+    claim = (await db.execute(
+        select(ImisResponse.id, ImisResponse.patient_id, ImisResponse.status, ImisResponse.fetched_at)
+        .where(ImisResponse.claim_code == claim_code)
+        .order_by(ImisResponse.id.desc())
+        .limit(1)
+    )).first()
+    if claim is None:
+        return None
+    lines = (await db.execute(
+        select(ClaimLine.sequence, ClaimLine.item_code, ClaimLine.adjudication_status)
+        .where(ClaimLine.imis_response_id == claim.id)
+        .order_by(ClaimLine.sequence)
+    )).mappings().all()
+    return {
+        "claim_code": claim_code,
+        "patient_id": claim.patient_id,
+        "status": claim.status,
+        "checked_at": claim.fetched_at,
+        "lines": [dict(line) for line in lines],
+    }
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+async def export_claims_ndjson(filters: ClaimFilters, include_raw: bool = False) -> AsyncIterator[str]:
+    """
+    Every matching claim as one JSON line, read page by page so memory stays
+    flat however large the table is. Uses its own session, so the stream
+    does not depend on the request's dependencies staying open.
+    """
+    after = None
+    async with AsyncSessionLocal() as db:
+        while True:
+            rows = (await db.execute(_claims_query(filters, include_raw, after, EXPORT_PAGE_SIZE))).mappings().all()
+            if not rows:
+                return
+            # End the read transaction between pages rather than holding it for the whole export
+            await db.commit()
+            yield "".join(json.dumps(dict(row), default=_json_default) + "\n" for row in rows)
+            if len(rows) < EXPORT_PAGE_SIZE:
+                return
+            after = (rows[-1]["claim_code"], rows[-1]["id"])
@@ -0,0 +1,226 @@
+"""
+Claim status sync. ImisResponse.status is whatever IMIS answered at submit
+time; this re-reads claims still in a pending status from IMIS and stores
+the new status and per-item adjudication, so status lookups are answered
+from the database.
+
+Claims are taken oldest-checked first (the status/fetched_at index), in
+pages, and each claim at most once per CLAIM_SYNC_MIN_AGE, including
+claims whose lookup failed. The adjudication is read from the claim's
+ClaimResponse, by the IMIS id of the stored response with If-Modified-Since
+when it has one; otherwise the claim is searched by its claim code, which
+is only unique per facility, so a hit must carry that MR code and belong to
+the patient. Lookups run with bounded concurrency under the service
+account; each page is written back in one transaction.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from sqlalchemy import and_, bindparam, or_, select, update
+
+import config
+from insurance_database import AsyncSessionLocal, ClaimLine, ImisResponse, PatientInformation
+from services import imis_services
+from services.circuit_breaker import CircuitOpenError
+from services.claim_submission import claim_identifier, parse_claim_resource
+from services.patient_eligibility import mark_needs_refresh
+
+logger = logging.getLogger(__name__)
+
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+NOT_FOUND = "not_found"
+FAILED = "failed"
+
+# Claims read per claim code search; other facilities may use the same code
+CODE_LOOKUP_PAGE_SIZE = 20
+
+_update_lines = (
+    update(ClaimLine.__table__)
+    .where(
+        ClaimLine.__table__.c.imis_response_id == bindparam("claim_id"),
+        ClaimLine.__table__.c.sequence == bindparam("line_sequence"),
+    )
+    .values(adjudication_status=bindparam("adjudication"))
+)
+
+
+def _pending_page(cutoff: datetime, after: Optional[Tuple[datetime, int]], limit: int):
+    patient_uuid = (
+        select(PatientInformation.patient_uuid)
+        .where(PatientInformation.patient_code == ImisResponse.patient_id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    stmt = (
+        select(
+            ImisResponse.id,
+            ImisResponse.patient_id,
+            ImisResponse.claim_code,
+            ImisResponse.status,
+            ImisResponse.items,
+            ImisResponse.fetched_at,
+            ImisResponse.raw_response["id"].as_string().label("imis_id"),
+            patient_uuid.label("patient_uuid"),
+        )
+        .where(
+            ImisResponse.status.in_(config.CLAIM_SYNC_PENDING_STATUSES),
+            ImisResponse.fetched_at < cutoff,
+        )
+        .order_by(ImisResponse.fetched_at, ImisResponse.id)
+        .limit(limit)
+    )
+    if after is not None:
+        fetched_at, claim_id = after
+        stmt = stmt.where(or_(
+            ImisResponse.fetched_at > fetched_at,
+            and_(ImisResponse.fetched_at == fetched_at, ImisResponse.id > claim_id),
+        ))
+    return stmt
+
+
+def _is_patients_claim(resource: Dict[str, Any], row) -> bool:
+    if claim_identifier(resource, "MR") != row.claim_code:
+        return False
+    reference = (resource.get("patient") or {}).get("reference") or ""
+    return bool(row.patient_uuid) and reference.rsplit("/", 1)[-1] == row.patient_uuid
+
+
+async def _claim_response(claim_id: str, row, client: httpx.AsyncClient, if_modified_since=None):
+    """(outcome, ClaimResponse when IMIS returned one)."""
+    found = await imis_services.get_claim_response(
+        claim_id, config.IMIS_SYNC_USERNAME, config.IMIS_SYNC_PASSWORD,
+        client=client, if_modified_since=if_modified_since,
+    )
+    if found.get("not_modified"):
+        return UNCHANGED, None
+    if not found.get("success"):
+        return (NOT_FOUND if found.get("status") == 404 else FAILED), None
+    resource = found.get("data") or {}
+    if resource.get("resourceType") != "ClaimResponse":
+        logger.warning("Status sync of claim %s got a %s, not a ClaimResponse", row.claim_code, resource.get("resourceType"))
+        return FAILED, None
+    return UPDATED, resource
+
+
+async def _lookup(row, client: httpx.AsyncClient) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """(outcome, IMIS ClaimResponse when IMIS returned one)."""
+    if row.imis_id:
+        return await _claim_response(row.imis_id, row, client, if_modified_since=row.fetched_at)
+
+    if not row.claim_code or row.claim_code == "UNKNOWN_CLAIM_CODE":
+        return NOT_FOUND, None
+    found = await imis_services.get_all_claims(
+        config.IMIS_SYNC_USERNAME, config.IMIS_SYNC_PASSWORD,
+        page_size=CODE_LOOKUP_PAGE_SIZE, identifier=row.claim_code, client=client,
+    )
+    if not found.get("success"):
+        return FAILED, None
+    entries = (found.get("data") or {}).get("entry") or []
+    claim = next((e["resource"] for e in entries if _is_patients_claim(e.get("resource") or {}, row)), None)
+    if claim is None:
+        return NOT_FOUND, None
+    return await _claim_response(claim.get("id"), row, client)
+
+
+async def _check(row, client: httpx.AsyncClient, semaphore: asyncio.Semaphore) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """(outcome, parsed claim when the stored one must change)."""
+    async with semaphore:
+        outcome, resource = await _lookup(row, client)
+    if outcome != UPDATED:
+        return outcome, None
+    parsed = parse_claim_resource(resource)
+    # An answer without an outcome says nothing about adjudication
+    if parsed["status"] == "unknown" or (parsed["status"] == row.status and parsed["items"] == (row.items or [])):
+        return UNCHANGED, None
+    return UPDATED, parsed
+
+
+def _line_updates(claim_id: int, items) -> list:
+    """Adjudication per claim line, first status per sequence as in build_claim_lines."""
+    adjudication = {}
+    for item in items:
+        if item.get("sequence_id") is not None and item.get("status"):
+            adjudication.setdefault(int(item["sequence_id"]), item["status"])
+    return [
+        {"claim_id": claim_id, "line_sequence": sequence, "adjudication": status}
+        for sequence, status in adjudication.items()
+    ]
+
+
+async def _store_page(checked: list, updated: list, patients: set, now: datetime):
+    async with AsyncSessionLocal() as db:
+        if checked:
+            await db.execute(update(ImisResponse).where(ImisResponse.id.in_(checked)).values(fetched_at=now))
+        if updated:
+            await db.execute(update(ImisResponse), [
+                {
+                    "id": claim_id,
+                    "status": parsed["status"],
+                    "items": parsed["items"],
+                    "raw_response": parsed["imis_json"],
+                    "fetched_at": now,
+                }
+                for claim_id, parsed in updated
+            ])
+            lines = [line for claim_id, parsed in updated for line in _line_updates(claim_id, parsed["items"])]
+            if lines:
+                await db.execute(_update_lines, lines)
+        # Adjudication changes what the patient has used
+        for patient_id in patients:
+            await mark_needs_refresh(db, patient_id)
+        await db.commit()
+
+
+async def sync_pending_claims(client: httpx.AsyncClient = None) -> Dict[str, Any]:
+    """One pass over the pending claims; counts per outcome and the time taken."""
+    client = client or imis_services.get_imis_client()
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=config.CLAIM_SYNC_MIN_AGE)
+    semaphore = asyncio.Semaphore(max(1, config.CLAIM_SYNC_CONCURRENCY))
+    report = {"checked": 0, UPDATED: 0, UNCHANGED: 0, NOT_FOUND: 0, FAILED: 0, "stopped": None}
+    after = None
+
+    while report["checked"] < config.CLAIM_SYNC_MAX_CLAIMS:
+        limit = min(config.CLAIM_SYNC_PAGE_SIZE, config.CLAIM_SYNC_MAX_CLAIMS - report["checked"])
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(_pending_page(cutoff, after, limit))).all()
+        if not rows:
+            break
+        after = (rows[-1].fetched_at, rows[-1].id)
+
+        results = await asyncio.gather(*(_check(row, client, semaphore) for row in rows), return_exceptions=True)
+        checked, updated, patients = [], [], set()
+        for row, result in zip(rows, results):
+            if isinstance(result, CircuitOpenError):
+                report["stopped"] = str(result)
+                continue
+            if isinstance(result, Exception):
+                logger.warning("Status sync of claim %s failed: %s", row.claim_code, result)
+                result = (FAILED, None)
+            outcome, parsed = result
+            report["checked"] += 1
+            report[outcome] += 1
+            if outcome == UPDATED:
+                updated.append((row.id, parsed))
+                patients.add(row.patient_id)
+            else:
+                # Failed lookups wait their turn too, or a set of claims that
+                # always fails (e.g. 403) would be re-polled first on every run
+                checked.append(row.id)
+
+        await _store_page(checked, updated, patients, datetime.utcnow())
+        if report["stopped"] or len(rows) < limit:
+            break
+
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(
+        "Claim status sync: %d checked, %d updated, %d unchanged, %d not found, %d failed in %.2fs",
+        report["checked"], report[UPDATED], report[UNCHANGED], report[NOT_FOUND], report[FAILED], report["seconds"],
+    )
+    return report
@@ -0,0 +1,313 @@
+"""
+Claim submission to IMIS: the FHIR Claim payload, parsing of the IMIS reply
+into an ImisResponse row, and bulk submission of many claims with a cap on
+claims in flight. Outcomes are reported as each claim completes; the rows
+of a bulk batch are stored together in one transaction at the end.
+"""
+import asyncio
+import json
+import logging
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from insurance_database import AsyncSessionLocal, ImisResponse, PatientInformation
+from model import ClaimInput
+from services import imis_services
+from services.circuit_breaker import CircuitOpenError
+from services.claim_lines import record_claim_lines
+from services.patient_eligibility import mark_needs_refresh
+from services.usage_ledger import record_claim_usage
+
+logger = logging.getLogger(__name__)
+
+IDENTIFIER_SYSTEM = "https://hl7.org/fhir/valueset-identifier-type.html"
+CARE_TYPE_MAP = {"OPD": "O", "IPD": "I", "ER": "O", "Referral": "O"}
+SERVICE_TYPE_MAP = {"OPD": "O", "ER": "E", "IPD": "O", "Referral": "R"}
+
+# Bulk jobs outlive their request when the client disconnects; keep them referenced
+_bulk_jobs: set = set()
+
+
+def build_claim_payload(claim: ClaimInput, patient_uuid: str, acsn: Optional[str] = None) -> Dict[str, Any]:
+    """FHIR Claim for IMIS. `acsn` is the accession identifier (random when not given)."""
+    icd_codes = json.loads(claim.icd_codes) if isinstance(claim.icd_codes, str) else claim.icd_codes
+    return {
+        "resourceType": "Claim",
+        "billablePeriod": {
+            "start": claim.visit_date.isoformat(),
+            "end": claim.visit_date.isoformat()
+        },
+        "created": datetime.utcnow().isoformat(),
+        "patient": {"reference": f"Patient/{patient_uuid}"},
+        "identifier": [
+            {
+                "type": {"coding": [{"code": "ACSN", "system": IDENTIFIER_SYSTEM}]},
+                "use": "usual",
+                "value": acsn or uuid.uuid4().hex
+            },
+            {
+                "type": {"coding": [{"code": "MR", "system": IDENTIFIER_SYSTEM}]},
+                "use": "usual",
+                "value": claim.claim_code
+            }
+        ],
+        "item": [
+            {
+                "sequence": i + 1,
+                "category": {"text": item.category},
+                "quantity": {"value": item.quantity},
+                "service": {"text": item.item_code},
+                "unitPrice": {"value": item.cost},
+            }
+            for i, item in enumerate(claim.claimable_items)
+        ],
+        "total": {"value": sum(round(item.cost * item.quantity, 2) for item in claim.claimable_items)},
+        # care type shall be I and O
+        "careType": CARE_TYPE_MAP.get(claim.service_type),
+        "enterer": {"reference": f"Practitioner/{claim.enterer_reference}"},
+        "facility": {"reference": f"Location/{claim.facility_reference}"},
+        "diagnosis": [
+            {"sequence": i + 1,
+             "type": [{"coding": [{"code": "icd_0"}], "text": "icd_0"}],
+             "diagnosisCodeableConcept": {"coding": [{"code": code}]}}
+            for i, code in enumerate(icd_codes or [])
+        ],
+        "nmc": ",".join(claim.doctor_nmc) if isinstance(claim.doctor_nmc, list) else claim.doctor_nmc,
+        # visit type shall be O, R and E only (Others, Referral and Emergency)
+        "type": {"text": SERVICE_TYPE_MAP.get(claim.service_type, "E")},
+    }
+
+
+def parse_claim_response(response_text: Optional[str]) -> Dict[str, Any]:
+    """
+    claim_code (the MR identifier), status, created_at and per-item
+    adjudication from an IMIS ClaimResponse body.
+    """
+    imis_json_str = (response_text or "").strip()
+    try:
+        imis_json = json.loads(imis_json_str) if imis_json_str else {}
+    except json.JSONDecodeError:
+        logging.error(f"IMIS returned invalid JSON: {imis_json_str!r}")
+        imis_json = {}
+    return parse_claim_resource(imis_json)
+
+
+def claim_identifier(resource: Dict[str, Any], code: str) -> Optional[str]:
+    """Value of a Claim/ClaimResponse identifier by type code ("ACSN", "MR")."""
+    for ident in resource.get("identifier") or []:
+        codings = (ident.get("type") or {}).get("coding") or []
+        if any(c.get("code") == code for c in codings):
+            return ident.get("value")
+    return None
+
+
+def claim_response_from_claim(claim: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Stand-in ClaimResponse for a claim IMIS holds but has not answered with
+    one yet. The claim is taken as entered, a pending status, so the status
+    sync replaces it with the real outcome.
+    """
+    return {
+        "resourceType": "ClaimResponse",
+        "id": claim.get("id"),
+        "identifier": claim.get("identifier") or [],
+        "created": claim.get("created"),
+        "outcome": {"text": "entered"},
+        "item": [],
+        "addItem": [],
+    }
+
+
+def parse_claim_resource(imis_json: Dict[str, Any]) -> Dict[str, Any]:
+    """parse_claim_response for an already decoded ClaimResponse."""
+    claim_code = claim_identifier(imis_json, "MR") or "UNKNOWN_CLAIM_CODE"
+
+    created_date_str = imis_json.get("created")
+
+    seq_to_code = {}
+    for add_item in imis_json.get("addItem", []):
+        seq_list = add_item.get("sequenceLinkId", [])
+        service_list = add_item.get("service", {}).get("coding", [])
+        code = service_list[0].get("code") if service_list else None
+        for seq in seq_list:
+            seq_to_code[seq] = code
+
+    items_info = []
+    for item in imis_json.get("item", []):
+        seq_id = item.get("sequenceLinkId")
+        service_code = seq_to_code.get(seq_id, None)
+        for adj in item.get("adjudication", []):
+            items_info.append({
+                "sequence_id": seq_id,
+                "item_code": service_code,
+                "status": adj.get("reason", {}).get("text")
+            })
+
+    return {
+        "imis_json": imis_json,
+        "claim_code": claim_code,
+        "status": imis_json.get("outcome", {}).get("text", "unknown"),
+        "created_at": datetime.fromisoformat(created_date_str) if created_date_str else datetime.utcnow(),
+        "items": items_info,
+    }
+
+
+def claim_total(claim: ClaimInput) -> Decimal:
+    """Amount claimed, as in the payload's total."""
+    return Decimal(str(sum(round(item.cost * item.quantity, 2) for item in claim.claimable_items)))
+
+
+def claimed_items(claim: ClaimInput) -> List[Dict[str, Any]]:
+    return [
+        {
+            "item_code": item.item_code,
+            "name": item.name,
+            "qty": item.quantity,
+            "cost": item.cost,
+            "category": item.category,
+            "type": item.type
+        }
+        for item in claim.claimable_items
+    ]
+
+
+def build_imis_record(claim: ClaimInput, parsed: Dict[str, Any]) -> ImisResponse:
+    return ImisResponse(
+        patient_id=claim.patient_id,
+        claim_code=parsed["claim_code"],
+        status=parsed["status"],
+        created_at=parsed["created_at"],
+        items=parsed["items"],
+        raw_response=parsed["imis_json"],
+        fetched_at=datetime.utcnow(),
+        service_type=claim.service_type,
+        service_code=claim.service_code,
+        item_code=claimed_items(claim),
+        department=claim.department,
+    )
+
+
+async def store_claims(db: AsyncSession, submitted: List[tuple]) -> List[ImisResponse]:
+    """
+    Adds the ImisResponse rows, claim lines and usage ledger rows for
+    (claim, parsed response) pairs with a single flush. The caller commits.
+    """
+    records = [build_imis_record(claim, parsed) for claim, parsed in submitted]
+    db.add_all(records)
+    await db.flush()
+    for (claim, _), record in zip(submitted, records):
+        await record_claim_lines(db, record)
+        await record_claim_usage(db, record, claim.visit_date)
+    return records
+
+
+async def _submit_one(
+    index: int,
+    claim: ClaimInput,
+    patient: Optional[PatientInformation],
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+) -> tuple:
+    """(outcome, parsed response or None when nothing is to be stored)."""
+    outcome = {"index": index, "patient_id": claim.patient_id, "claim_code": claim.claim_code}
+    if patient is None:
+        outcome.update(status_code=500, success=False, detail="Claim has no linked patient")
+        return outcome, None
+
+    payload = build_claim_payload(claim, patient.patient_uuid)
+    async with semaphore:
+        try:
+            imis_response = await imis_services.submit_claim(payload, claim.username, claim.password, client=client)
+        except CircuitOpenError as exc:
+            outcome.update(status_code=503, success=False, detail=str(exc))
+            return outcome, None
+        except Exception as exc:
+            logging.error(f"IMIS submission failed for claim {claim.claim_code}: {exc}")
+            outcome.update(status_code=500, success=False, detail=f"IMIS submission failed: {str(exc)}")
+            return outcome, None
+
+    parsed = parse_claim_response(imis_response.get("response"))
+    outcome.update(
+        status_code=imis_response.get("status"),
+        success=bool(imis_response.get("success")),
+        imis_claim_code=parsed["claim_code"],
+        status=parsed["status"],
+        created_at=parsed["created_at"].isoformat(),
+        items=parsed["items"],
+    )
+    return outcome, parsed
+
+
+async def _run_bulk(
+    claims: List[ClaimInput],
+    patients: Dict[str, PatientInformation],
+    client: httpx.AsyncClient,
+    emit: Callable[[Dict[str, Any]], Awaitable[None]],
+):
+    semaphore = asyncio.Semaphore(max(1, config.IMIS_BULK_CONCURRENCY))
+    tasks = [
+        asyncio.create_task(_submit_one(i, claim, patients.get(claim.patient_id), client, semaphore))
+        for i, claim in enumerate(claims)
+    ]
+    submitted, accepted = [], []
+    succeeded = failed = 0
+    for next_done in asyncio.as_completed(tasks):
+        outcome, parsed = await next_done
+        if outcome["success"]:
+            succeeded += 1
+            accepted.append(claims[outcome["index"]])
+        else:
+            failed += 1
+        if parsed is not None:
+            submitted.append((claims[outcome["index"]], parsed))
+        await emit({"type": "result", **outcome})
+
+    summary = {"type": "summary", "count": len(claims), "succeeded": succeeded, "failed": failed, "stored": 0}
+    if submitted:
+        try:
+            async with AsyncSessionLocal() as db:
+                await store_claims(db, submitted)
+                for claim in accepted:
+                    await mark_needs_refresh(db, claim.patient_id, claim_total(claim))
+                await db.commit()
+            summary["stored"] = len(submitted)
+        except Exception as exc:
+            # IMIS already holds these claims; log enough to reconcile them by hand
+            logger.exception(
+                "Storing %d bulk-submitted claims failed: %s",
+                len(submitted), [parsed["claim_code"] for _, parsed in submitted],
+            )
+            summary["store_error"] = str(exc)
+    await emit(summary)
+
+
+async def stream_bulk_submission(
+    claims: List[ClaimInput],
+    patients: Dict[str, PatientInformation],
+    client: httpx.AsyncClient,
+):
+    """
+    Submits the claims and yields one NDJSON line per claim as IMIS answers,
+    then a summary line once the batch is stored. The submission runs as its
+    own task, so a client that disconnects does not cancel claims already
+    sent to IMIS or the transaction recording them.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    job = asyncio.create_task(_run_bulk(claims, patients, client, queue.put))
+    _bulk_jobs.add(job)
+    job.add_done_callback(_bulk_jobs.discard)
+    job.add_done_callback(lambda _: queue.put_nowait(None))
+    while True:
+        line = await queue.get()
+        if line is None:
+            break
+        yield json.dumps(line, default=str) + "\n"
+    if not job.cancelled() and job.exception() is not None:
+        logger.error("Bulk claim submission failed", exc_info=job.exception())
+        yield json.dumps({"type": "error", "detail": str(job.exception())}) + "\n"
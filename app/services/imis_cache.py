@@ -0,0 +1,122 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class _LoadCancelled(Exception):
+    """Set on a shared load whose leading request was cancelled."""
+
+
+class TTLCache:
+    """
+    In-process LRU cache with per-entry TTL and single-flight loading.
+
+    Concurrent get_or_load() calls for the same missing key share one
+    loader call instead of each hitting IMIS.
+    """
+
+    def __init__(self, name: str, ttl: float, maxsize: int):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        cacheable: Callable[[Any], bool] = lambda value: True,
+    ):
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except _LoadCancelled:
+                # The request that started the load was cancelled, not this one: load again
+                return await self.get_or_load(key, loader, cacheable)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.set_exception(_LoadCancelled())
+            future.exception()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Retrieve it so a loader error nobody else awaited is not logged as unhandled
+            future.exception()
+            raise
+        else:
+            if cacheable(value):
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, key: Hashable):
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]):
+        for key in [k for k in self._entries if predicate(k)]:
+            del self._entries[key]
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "name": self.name,
+            "ttl_seconds": self.ttl,
+            "maxsize": self.maxsize,
+            "size": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
@@ -1,12 +1,123 @@
 import base64
+import hashlib
+import importlib.util
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from urllib.parse import urlsplit
 import httpx
 from dotenv import load_dotenv
+import config
+from services.imis_cache import TTLCache
+from services.rate_limit import RateLimiter
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from services import metrics
 
 load_dotenv()
 
 IMIS_BASE_URL = "http://imislegacy.hib.gov.np/api/api_fhir"
 IMIS_LOGIN_URL = "https://imis.hib.gov.np"
 
+# App-scoped client, opened in the FastAPI lifespan and shared by every call
+_client: httpx.AsyncClient | None = None
+
+# Successful Patient / Eligibility responses, keyed by (identifier, IMIS user, credential digest)
+patient_cache = TTLCache("patient", config.IMIS_PATIENT_CACHE_TTL, config.IMIS_CACHE_MAXSIZE)
+eligibility_cache = TTLCache("eligibility", config.IMIS_ELIGIBILITY_CACHE_TTL, config.IMIS_CACHE_MAXSIZE)
+
+# Claim submissions per IMIS host, shared by /submit_claim and bulk submission
+_submit_limiters: dict[str, RateLimiter] = {}
+
+
+def submit_rate_limiter(url: str) -> RateLimiter:
+    host = urlsplit(url).netloc
+    limiter = _submit_limiters.get(host)
+    if limiter is None:
+        limiter = _submit_limiters[host] = RateLimiter(config.IMIS_SUBMIT_RATE_LIMIT, config.IMIS_SUBMIT_RATE_BURST)
+    return limiter
+
+
+# One breaker per IMIS operation; the configured timeouts are the ceilings for the adaptive ones.
+# POST /Claim is not idempotent, so a submission is never cut short of IMIS_CLAIM_TIMEOUT.
+breakers = {
+    "patient": CircuitBreaker("patient", config.IMIS_PATIENT_TIMEOUT),
+    "eligibility": CircuitBreaker("eligibility", config.IMIS_ELIGIBILITY_TIMEOUT),
+    "claim": CircuitBreaker("claim", config.IMIS_CLAIM_TIMEOUT, adaptive_timeout=False),
+    "claim_query": CircuitBreaker("claim_query", config.IMIS_CLAIM_QUERY_TIMEOUT),
+}
+
+
+def _operation_timeout(read_timeout: float) -> httpx.Timeout:
+    return httpx.Timeout(read_timeout, connect=config.IMIS_CONNECT_TIMEOUT)
+
+
+async def _request(operation: str, client: httpx.AsyncClient, method: str, url: str,
+                   limiter: RateLimiter | None = None, **kwargs) -> httpx.Response:
+    """
+    Sends one IMIS request through the operation's circuit breaker, with the
+    breaker's current timeout. Raises CircuitOpenError while it is open.
+    """
+    breaker = breakers[operation]
+    breaker.before_call()
+    started = time.perf_counter()
+    try:
+        if limiter is not None:
+            await limiter.acquire()
+            started = time.perf_counter()
+        response = await client.request(method, url, timeout=_operation_timeout(breaker.timeout()), **kwargs)
+    except Exception as exc:
+        latency = time.perf_counter() - started
+        breaker.record(False, latency)
+        metrics.imis_request_duration.observe(
+            latency, operation=operation, status="timeout" if isinstance(exc, httpx.TimeoutException) else "error"
+        )
+        raise
+    except BaseException:
+        # Cancelled by the caller: says nothing about IMIS, but frees a half-open probe slot
+        breaker.cancelled()
+        raise
+    latency = time.perf_counter() - started
+    breaker.record(response.status_code < 500 and response.status_code != 429, latency)
+    metrics.imis_request_duration.observe(latency, operation=operation, status=response.status_code)
+    return response
+
+
+def create_imis_client() -> httpx.AsyncClient:
+    """
+    Builds a pooled keep-alive client for IMIS.
+    HTTP/2 is only enabled when the optional `h2` package is installed.
+    """
+    limits = httpx.Limits(
+        max_connections=config.IMIS_MAX_CONNECTIONS,
+        max_keepalive_connections=config.IMIS_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.IMIS_KEEPALIVE_EXPIRY,
+    )
+    http2 = config.IMIS_HTTP2 and importlib.util.find_spec("h2") is not None
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=_operation_timeout(config.IMIS_CLAIM_QUERY_TIMEOUT),
+        http2=http2,
+    )
+
+
+async def close_imis_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_imis_client() -> httpx.AsyncClient:
+    """
+    Returns the shared client. The lifespan opens it on startup; callers
+    outside the app (scripts, ad-hoc jobs) get it created lazily.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_imis_client()
+    return _client
+
+
 def get_auth_header(username: str, password: str):
     token = base64.b64encode(f"{username}:{password}".encode()).decode()
     headers = {"Authorization": f"Basic {token}"}
@@ -15,63 +126,160 @@ def get_auth_header(username: str, password: str):
     return headers
 
 
-async def  get_patient_info(patient_identifier: str ,username:str, password:str):
+def credentials_digest(username: str, password: str) -> str:
+    return hashlib.sha256(f"{username}:{password}".encode()).hexdigest()
+
+
+def _cache_key(patient_identifier: str, username: str, password: str):
+    # The password digest keeps a cached response from being served to wrong credentials
+    return (str(patient_identifier), username, credentials_digest(username, password))
+
+
+def _succeeded(result: dict) -> bool:
+    return bool(result.get("success"))
+
+
+def invalidate_eligibility(patient_identifier: str):
+    """Drops cached eligibility for an insuree, e.g. after a claim changes used_money."""
+    eligibility_cache.invalidate_where(lambda key: key[0] == str(patient_identifier))
+
+
+def cache_stats() -> dict:
+    return {"patient": patient_cache.stats(), "eligibility": eligibility_cache.stats()}
+
+
+def breaker_stats() -> dict:
+    return {name: breaker.stats() for name, breaker in breakers.items()}
+
+
+@metrics.collector("imis_breaker_state", "gauge", "1 for the current state of each IMIS circuit breaker")
+def _breaker_state_samples():
+    for name, breaker in breakers.items():
+        for state in ("closed", "open", "half_open"):
+            yield {"operation": name, "state": state}, 1 if breaker.state == state else 0
+
+
+@metrics.collector("imis_breaker_events_total", "counter", "Calls, outcomes, rejections and openings per IMIS circuit breaker")
+def _breaker_event_samples():
+    for name, breaker in breakers.items():
+        for event, count in breaker.counters.items():
+            yield {"operation": name, "event": event}, count
+
+
+@metrics.collector("imis_timeout_seconds", "gauge", "Read timeout currently applied per IMIS operation")
+def _breaker_timeout_samples():
+    for name, breaker in breakers.items():
+        yield {"operation": name}, breaker.timeout()
+
+
+@metrics.collector("imis_cache_lookups_total", "counter", "IMIS response cache lookups by result")
+def _cache_lookup_samples():
+    for cache in (patient_cache, eligibility_cache):
+        for result in ("hits", "misses", "coalesced"):
+            yield {"cache": cache.name, "result": result}, getattr(cache, result)
+
+
+@metrics.collector("imis_cache_hit_ratio", "gauge", "Share of IMIS cache lookups answered without calling IMIS")
+def _cache_ratio_samples():
+    for cache in (patient_cache, eligibility_cache):
+        yield {"cache": cache.name}, cache.stats()["hit_ratio"]
+
+
+@metrics.collector("imis_cache_entries", "gauge", "Entries held per IMIS response cache")
+def _cache_size_samples():
+    for cache in (patient_cache, eligibility_cache):
+        yield {"cache": cache.name}, cache.stats()["size"]
+
+
+async def get_patient_info(patient_identifier: str, username: str, password: str, client: httpx.AsyncClient | None = None, use_cache: bool = True):
+    if not use_cache:
+        return await _fetch_patient_info(patient_identifier, username, password, client)
+    return await patient_cache.get_or_load(
+        _cache_key(patient_identifier, username, password),
+        lambda: _fetch_patient_info(patient_identifier, username, password, client),
+        cacheable=_succeeded,
+    )
+
+
+async def  _fetch_patient_info(patient_identifier: str ,username:str, password:str, client: httpx.AsyncClient | None = None):
     
     url = f"{IMIS_BASE_URL}/Patient/?identifier={patient_identifier}"
     headers = get_auth_header(username,password)
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        response = await client.get(url, headers=headers)
-        if response.status_code == 200:
-            return {"success": True, "data": response.json()}
-        print(f"[IMIS] Failed to get patient info ({response.status_code}): {response.text}")
-        return {"success": False, "status": response.status_code, "data": None}
+    client = client or get_imis_client()
+    response = await _request("patient", client, "GET", url, headers=headers)
+    if response.status_code == 200:
+        return {"success": True, "data": response.json()}
+    print(f"[IMIS] Failed to get patient info ({response.status_code}): {response.text}")
+    return {"success": False, "status": response.status_code, "data": None}
 
 
 
 
-async def check_eligibility(patient_identifier: str,username:str,password:str):
-    patient_data = await get_patient_info(patient_identifier,username,password)
-    if not patient_data["success"] or not patient_data["data"].get("entry"):
+async def check_eligibility(patient_identifier: str,username:str,password:str, client: httpx.AsyncClient | None = None, patient_bundle: dict | None = None, use_cache: bool = True):
+    """
+    Eligibility for an insuree. Pass the Patient bundle already fetched with
+    get_patient_info() as `patient_bundle` to skip the duplicate Patient lookup.
+    """
+    client = client or get_imis_client()
+    if patient_bundle is None:
+        patient_data = await get_patient_info(patient_identifier,username,password,client=client,use_cache=use_cache)
+        if not patient_data["success"]:
+            return {"success": False, "reason": "Patient not found"}
+        patient_bundle = patient_data["data"]
+    if not (patient_bundle or {}).get("entry"):
         return {"success": False, "reason": "Patient not found"}
 
-    patient_uuid = patient_data["data"]["entry"][0]["resource"]["identifier"]
+    if not use_cache:
+        return await request_eligibility(patient_identifier, username, password, client=client)
+    return await eligibility_cache.get_or_load(
+        _cache_key(patient_identifier, username, password),
+        lambda: request_eligibility(patient_identifier, username, password, client=client),
+        cacheable=_succeeded,
+    )
+
 
+async def request_eligibility(patient_identifier: str, username:str, password:str, client: httpx.AsyncClient | None = None):
+    """
+    Raw EligibilityRequest for an insuree that is already known to exist in IMIS.
+    """
     url = f"{IMIS_BASE_URL}/EligibilityRequest/"
     headers = get_auth_header(username,password)
     body = {
         "resourceType": "EligibilityRequest",
-        "patient": {"reference": f"Patient/{740500036}"},
+        "patient": {"reference": f"Patient/{patient_identifier}"},
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, headers=headers, json=body)
-        if response.status_code in [200, 201]:
-            return {"success": True, "data": response.json()}
-        print(f"[IMIS] Eligibility check failed ({response.status_code}): {response.text}")
-        return {"success": False, "status": response.status_code, "data": None}
+    client = client or get_imis_client()
+    response = await _request("eligibility", client, "POST", url, headers=headers, json=body)
+    if response.status_code in [200, 201]:
+        return {"success": True, "data": response.json()}
+    print(f"[IMIS] Eligibility check failed ({response.status_code}): {response.text}")
+    return {"success": False, "status": response.status_code, "data": None}
 
 
-async def submit_claim(payload: dict,username:str,password:str):
+async def submit_claim(payload: dict,username:str,password:str, client: httpx.AsyncClient | None = None):
     url = f"{IMIS_BASE_URL}/Claim/"
     headers = get_auth_header(username,password)
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(url, headers=headers, json=payload)
-        return {
-            "success": response.status_code in [200, 201],
-            "status": response.status_code,
-            "response": response.text
-        }
+    client = client or get_imis_client()
+    response = await _request("claim", client, "POST", url, limiter=submit_rate_limiter(url), headers=headers, json=payload)
+    return {
+        "success": response.status_code in [200, 201],
+        "status": response.status_code,
+        "response": response.text
+    }
 
 
 async def get_all_claims(username:str,password:str,
     page: int = 1,
     page_size: int = 50,
     status: str | None = None,
-    patient_identifier: str | None = None
+    patient_identifier: str | None = None,
+    client: httpx.AsyncClient | None = None,
+    identifier: str | None = None
 ) -> dict:
     """
     Fetch paginated list of claims from IMIS.
-    Supports filtering by status and patient.
+    Supports filtering by status, patient and claim identifier (e.g. the ACSN).
     """
     params = {
         "_count": page_size,
@@ -81,41 +289,71 @@ async def get_all_claims(username:str,password:str,
         params["status"] = status
     if patient_identifier:
         params["patient.identifier"] = patient_identifier
+    if identifier:
+        params["identifier"] = identifier
 
     url = f"{IMIS_BASE_URL}/Claim/"
     headers = get_auth_header(username,password)
+    client = client or get_imis_client()
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, headers=headers, params=params)
-            if response.status_code == 200:
-                return {"success": True, "data": response.json()}
-            print(f"[IMIS] Failed to get claims ({response.status_code}): {response.text}")
-            return {"success": False, "status": response.status_code, "error": response.text}
-        except Exception as e:
-            print(f"[IMIS] get_all_claims error: {e}")
-            return {"success": False, "error": str(e)}
+    try:
+        response = await _request("claim_query", client, "GET", url, headers=headers, params=params)
+        if response.status_code == 200:
+            return {"success": True, "data": response.json()}
+        print(f"[IMIS] Failed to get claims ({response.status_code}): {response.text}")
+        return {"success": False, "status": response.status_code, "error": response.text}
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"[IMIS] get_all_claims error: {e}")
+        return {"success": False, "error": str(e)}
 
 
-async def get_claim_by_uuid(claim_uuid: str,username:str,password:str) -> dict:
+async def _get_resource(resource_type: str, resource_id: str, username: str, password: str,
+    client: httpx.AsyncClient | None, if_modified_since: datetime | None
+) -> dict:
+    url = f"{IMIS_BASE_URL}/{resource_type}/{resource_id}"
+    headers = get_auth_header(username,password)
+    if if_modified_since is not None:
+        headers["If-Modified-Since"] = format_datetime(if_modified_since.replace(tzinfo=timezone.utc), usegmt=True)
+    client = client or get_imis_client()
+
+    try:
+        response = await _request("claim_query", client, "GET", url, headers=headers)
+        if response.status_code == 304:
+            return {"success": True, "not_modified": True}
+        if response.status_code == 200:
+            return {"success": True, "data": response.json()}
+        if response.status_code == 404:
+            return {"success": False, "status": 404, "error": f"{resource_type} not found in IMIS"}
+        print(f"[IMIS] Failed to get {resource_type} {resource_id} ({response.status_code}): {response.text}")
+        return {"success": False, "status": response.status_code, "error": response.text}
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"[IMIS] get {resource_type} error: {e}")
+        return {"success": False, "error": str(e)}
+
+
+async def get_claim_by_uuid(claim_uuid: str,username:str,password:str, client: httpx.AsyncClient | None = None,
+    if_modified_since: datetime | None = None
+) -> dict:
     """
-    Fetch a single claim from IMIS by its UUID.
+    Fetch a single claim from IMIS by its UUID. With `if_modified_since` the
+    request is conditional and an unchanged claim comes back as
+    {"success": True, "not_modified": True} without a body.
     """
-    url = f"{IMIS_BASE_URL}/Claim/{claim_uuid}"
-    headers = get_auth_header(username,password)
+    return await _get_resource("Claim", claim_uuid, username, password, client, if_modified_since)
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                return {"success": True, "data": response.json()}
-            if response.status_code == 404:
-                return {"success": False, "status": 404, "error": "Claim not found in IMIS"}
-            print(f"[IMIS] Failed to get claim {claim_uuid} ({response.status_code}): {response.text}")
-            return {"success": False, "status": response.status_code, "error": response.text}
-        except Exception as e:
-            print(f"[IMIS] get_claim_by_uuid error: {e}")
-            return {"success": False, "error": str(e)}
+
+async def get_claim_response(claim_uuid: str,username:str,password:str, client: httpx.AsyncClient | None = None,
+    if_modified_since: datetime | None = None
+) -> dict:
+    """
+    The ClaimResponse (outcome and per-item adjudication) of a claim, by the
+    claim's UUID; conditional like get_claim_by_uuid.
+    """
+    return await _get_resource("ClaimResponse", claim_uuid, username, password, client, if_modified_since)
         
         
 def extract_copayment(bundle: dict):
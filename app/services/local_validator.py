@@ -1,73 +1,167 @@
-from datetime import timedelta
-from typing import Dict, Any, List
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Dict, Any, List, Optional, Tuple
 from decimal import Decimal
 from model import ClaimInput
-from rule_loader import get_rules, get_items, get_services
-from sqlalchemy.orm import Session
+from rule_loader import RuleSnapshot, code_lookups, get_snapshot
+from services.rule_engine import CompiledRules
+from services.usage_ledger import fiscal_year_start, spend_by_bucket, units_by_item
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from insurance_database import PatientInformation, ImisResponse
 from collections import defaultdict
 from fastapi import HTTPException
 from decimal import InvalidOperation
 
 
-def _get_previous_claims_for_patient(db: Session, patient_imis_id: str) -> List[ImisResponse]:
-    return (
-        db.query(ImisResponse)
-        .join(PatientInformation)
-        .filter(PatientInformation.patient_code == patient_imis_id)
-        .filter(ImisResponse.status.notin_(["rejected", "unknown"]))
-        .order_by(ImisResponse.fetched_at.desc())
-        .all()
-    )
-
-
-def prevalidate_claim(
+@dataclass(frozen=True)
+class PreviousOpdVisit:
+    visit_day: date
+    service_code: Optional[str]
+    department: Optional[str]
+
+
+@dataclass
+class ClaimContext:
+    """
+    Everything prevalidation reads from the database for one claim. Loaded
+    per claim by load_claim_context or in bulk by services.batch_prevalidation;
+    evaluate_claim only reads this, so it can run in another process.
+    """
+    copayment: Any
+    allowed_money: Decimal
+    used_money: Decimal
+    last_opd_visit: Optional[PreviousOpdVisit] = None
+    window_usage: Dict[Tuple[str, int], Decimal] = field(default_factory=dict)
+    non_covered_spent: Dict[str, Decimal] = field(default_factory=dict)
+
+
+def claim_catalog(snapshot: RuleSnapshot, claim: ClaimInput) -> List[Tuple[Any, Optional[Dict]]]:
+    catalog = [(item, snapshot.lookup_code(item.item_code)) for item in claim.claimable_items]
+    found = sum(1 for _, entry in catalog if entry is not None)
+    code_lookups.inc(found, result="hit")
+    code_lookups.inc(len(catalog) - found, result="miss")
+    return catalog
+
+
+def capped_windows(catalog: List[Tuple[Any, Optional[Dict]]]) -> Dict[int, set]:
+    """Item codes with a per-window unit cap, grouped by window length in days."""
+    codes_by_window = defaultdict(set)
+    for item, data in catalog:
+        capping = (data or {}).get("capping", {})
+        if capping.get("max_per_visit") and capping.get("max_days"):
+            codes_by_window[capping["max_days"]].add(item.item_code)
+    return codes_by_window
+
+
+def needs_non_covered_spend(rules: CompiledRules, catalog: List[Tuple[Any, Optional[Dict]]]) -> bool:
+    """Whether any known line hits a non-covered entry with an annual threshold."""
+    for item, data in catalog:
+        if data and any(
+            not nc.claimable and nc.annual_cost_threshold_npr
+            for nc in rules.match_non_covered(item.name.lower())
+        ):
+            return True
+    return False
+
+
+async def _window_usage(db: AsyncSession, claim: ClaimInput, catalog: List[Tuple[Any, Dict]]) -> Dict[Tuple[str, int], Decimal]:
+    """
+    Units already used inside each time-capped item's window, read from the
+    usage ledger with one grouped query per distinct window length.
+    """
+    usage = {}
+    for window_days, codes in capped_windows(catalog).items():
+        start_date = claim.visit_date - timedelta(days=window_days)
+        for code, qty in (await units_by_item(db, claim.patient_id, codes, start_date, claim.visit_date)).items():
+            usage[(code, window_days)] = qty
+    return usage
+
+
+async def load_claim_context(
     claim: ClaimInput,
-    db: Session,
+    db: AsyncSession,
+    snapshot: RuleSnapshot,
     allowed_money: Decimal = None,
     used_money: Decimal = None
-) -> Dict[str, Any]:
-    rules = get_rules()
-    global_warnings: List[str] = []
-    items_output: List[Dict] = []
-    total_approved_local = Decimal("0")
-    total_copay = Decimal("0")
-
+) -> ClaimContext:
     # Patient lookup
-    patient = db.query(PatientInformation).filter(PatientInformation.patient_code == claim.patient_id).first()
+    patient = (await db.execute(
+        select(PatientInformation).where(PatientInformation.patient_code == claim.patient_id).limit(1)
+    )).scalars().first()
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found in insurance database")
 
     if allowed_money is None or used_money is None:
         allowed_money = Decimal(str(patient.allowed_money or 0))
         used_money = Decimal(str(patient.used_money or 0))
+    context = ClaimContext(copayment=patient.copayment, allowed_money=allowed_money, used_money=used_money)
+    if allowed_money - used_money <= 0:
+        return context
+
+    if claim.service_type == "OPD":
+        last_opd_claim = (await db.execute(
+            select(ImisResponse)
+            .where(ImisResponse.patient_id == claim.patient_id)
+            .where(ImisResponse.service_type == "OPD")
+            .where(ImisResponse.status.notin_(["rejected", "unknown"]))
+            .order_by(ImisResponse.created_at.asc())
+            .limit(1)
+        )).scalars().first()
+        if last_opd_claim:
+            context.last_opd_visit = PreviousOpdVisit(
+                last_opd_claim.created_at.date(), last_opd_claim.service_code, last_opd_claim.department
+            )
+
+    catalog = claim_catalog(snapshot, claim)
+    context.window_usage = await _window_usage(db, claim, catalog)
+    if needs_non_covered_spend(snapshot.compiled_rules, catalog):
+        context.non_covered_spent = await spend_by_bucket(
+            db, claim.patient_id, fiscal_year_start(claim.visit_date), claim.visit_date
+        )
+    return context
+
+
+async def prevalidate_claim(
+    claim: ClaimInput,
+    db: AsyncSession,
+    allowed_money: Decimal = None,
+    used_money: Decimal = None
+) -> Dict[str, Any]:
+    # One snapshot per claim: rules and catalog stay consistent across a hot reload
+    snapshot = get_snapshot()
+    context = await load_claim_context(claim, db, snapshot, allowed_money, used_money)
+    return evaluate_claim(claim, context, snapshot)
+
+
+def evaluate_claim(claim: ClaimInput, context: ClaimContext, snapshot: RuleSnapshot = None) -> Dict[str, Any]:
+    """Applies the validation rules to one claim. No I/O: all history comes from `context`."""
+    snapshot = snapshot or get_snapshot()
+    rules = snapshot.compiled_rules
+    global_warnings: List[str] = []
+    items_output: List[Dict] = []
+    total_approved_local = Decimal("0")
+    total_copay = Decimal("0")
 
+    allowed_money = context.allowed_money
+    used_money = context.used_money
     available_money = allowed_money - used_money
     if available_money <= 0:
         raise HTTPException(status_code=400, detail="This patient has no remaining balance")
 
     category = claim.service_type
-    cat_rules = rules["claim_categories"].get(category, {}).get("rules", {})
-    previous_claims = _get_previous_claims_for_patient(db, claim.patient_id)
+    cat_rules = rules.category(category)
 
     # OPD Rules
     if category == "OPD":
-        ticket_days = cat_rules.get("ticket_valid_days", 7)
-        require_same_day_submit = cat_rules.get("submit_daily_after_service", True)
-        require_referral = cat_rules.get("require_referral_for_inter_department", True)
-
-        last_opd_claim = (
-            db.query(ImisResponse)
-            .filter(ImisResponse.patient_id == claim.patient_id)
-            .filter(ImisResponse.service_type == "OPD")
-            .filter(ImisResponse.status.notin_(["rejected", "unknown"]))
-            .order_by(ImisResponse.created_at.asc())
-            .first()
-        )
+        ticket_days = cat_rules.ticket_valid_days
+        require_same_day_submit = cat_rules.submit_daily_after_service
+        require_referral = cat_rules.require_referral_for_inter_department
 
-        if last_opd_claim:
-            days_diff = (claim.visit_date - last_opd_claim.created_at.date()).days
+        last_opd_claim = context.last_opd_visit
 
+        if last_opd_claim:
+            days_diff = (claim.visit_date - last_opd_claim.visit_day).days
             if 0 <= days_diff < ticket_days and claim.service_code != last_opd_claim.service_code:
                 global_warnings.append(
                     "Previous OPD ticket still valid. No new ticket needed for a different service. Claim code must remain the same."
@@ -89,20 +183,36 @@ def prevalidate_claim(
 
     # ER/IPD Rules
     if category in ("ER", "IPD"):
-        submit_at_discharge = cat_rules.get("submit_at_discharge", True)
+        submit_at_discharge = cat_rules.submit_at_discharge
         if submit_at_discharge and getattr(claim, "claim_time", None) != "discharge":
             global_warnings.append(f"{category} claims must be submitted at discharge.")
 
+    # Copayment is a patient attribute, parse it once for the whole claim
+    raw_copay = context.copayment
+    copay_warning = None
+    if raw_copay is None:
+        copayment_decimal = Decimal("0")
+    else:
+        cleaned = str(raw_copay).replace("%", "").strip()
+        if not cleaned.replace(".", "", 1).replace("-", "", 1).isdigit():
+            copay_warning = f"Invalid copayment value: {raw_copay}"
+            copayment_decimal = Decimal("0")
+        else:
+            value = Decimal(cleaned)
+            copayment_decimal = value if value <= 1 else value / 100
+
     # Item Processing
     surgery_disease_count = defaultdict(int)
     medical_disease_count = defaultdict(int)
+    disease_key = tuple(claim.icd_codes) if claim.icd_codes else ("UNKNOWN",)
+    non_covered_spent = context.non_covered_spent  # fiscal-year spend per bucket
 
-    for item in claim.claimable_items:
-        item_warnings: List[str] = []
+    catalog = claim_catalog(snapshot, claim)
+    window_usage = context.window_usage
 
-        med = get_items(item.item_code)
-        pkg = get_services(item.item_code)
-        data = med or pkg
+    for item, data in catalog:
+        item_warnings: List[str] = []
+        item_name_lower = item.name.lower()
 
         # Default fallback values
         approved_rate = Decimal(str(item.cost))
@@ -139,21 +249,16 @@ def prevalidate_claim(
 
             # === All further rules only if item exists ===
             # Non-covered items
-            for nc in rules["non_covered_services"]["items"]:
-                if nc["name"].lower() in item.name.lower() and not nc["claimable"]:
-                    threshold = nc.get("annual_cost_threshold_npr")
+            for nc in rules.match_non_covered(item_name_lower):
+                if not nc.claimable:
+                    threshold = nc.annual_cost_threshold_npr
                     if threshold:
-                        prev_spent = sum(
-                            Decimal(str(x.get("qty", 0))) * Decimal(str(x.get("rate", 0)))
-                            for prev_claim in previous_claims
-                            for x in (prev_claim.item_code or [])
-                            if nc["name"].lower() in x.get("name", "").lower()
-                        )
+                        prev_spent = non_covered_spent.get(nc.name, Decimal("0"))
                         if prev_spent + raw_amount > threshold:
-                            item_warnings.append(f"{nc['name']} exceeds annual limit of NPR {threshold}.")
-                            approved_amount = max(Decimal("0"), Decimal(threshold) - prev_spent)
+                            item_warnings.append(f"{nc.name} exceeds annual limit of NPR {threshold}.")
+                            approved_amount = max(Decimal("0"), threshold - prev_spent)
                     else:
-                        item_warnings.append(f"{nc['name']} is not covered.")
+                        item_warnings.append(f"{nc.name} is not covered.")
                         approved_amount = Decimal("0")
 
             # Quantity per visit cap
@@ -170,15 +275,7 @@ def prevalidate_claim(
             max_units_in_window = capping.get("max_per_visit")
             window_days = capping.get("max_days")
             if max_units_in_window and window_days:
-                visit_date = claim.visit_date
-                start_date = visit_date - timedelta(days=window_days)
-                used_qty = Decimal("0")
-                for prev_claim in previous_claims:
-                    prev_date = prev_claim.fetched_at.date()
-                    if start_date <= prev_date <= visit_date:
-                        for x in (prev_claim.item_code or []):
-                            if x.get("item_code") == item.item_code:
-                                used_qty += Decimal(str(x.get("qty", 0)))
+                used_qty = window_usage.get((item.item_code, window_days), Decimal("0"))
                 available_qty = Decimal(str(max_units_in_window)) - used_qty
                 if available_qty <= 0:
                     item_warnings.append(f"No remaining units for {item.item_code} in {window_days}-day window.")
@@ -190,13 +287,10 @@ def prevalidate_claim(
                     approved_amount = approved_rate * qty
 
             # Surgery / Medical Management percentage
-            disease_key = tuple(claim.icd_codes) if claim.icd_codes else ("UNKNOWN",)
-
             if data.get("type") == "surgery":
                 surgery_disease_count[disease_key] += 1
                 order = surgery_disease_count[disease_key]
-                pct = rules["general_rules"]["surgery"]["claim_percentage"]
-                multiplier = Decimal(str(pct["first_disease"] if order == 1 else pct.get("second_disease", 50))) / 100
+                multiplier = rules.surgery.multiplier(order)
                 approved_amount = raw_amount * multiplier
                 if multiplier < 1:
                     item_warnings.append(f"Surgery #{order}: {int(multiplier * 100)}% claimable.")
@@ -204,15 +298,14 @@ def prevalidate_claim(
             elif data.get("type") == "medical_management":
                 medical_disease_count[disease_key] += 1
                 order = medical_disease_count[disease_key]
-                pct = rules["general_rules"]["medical_management"]["claim_percentage"]
-                multiplier = Decimal(str(pct["first_disease"] if order == 1 else pct.get("second_disease", 50))) / 100
+                multiplier = rules.medical_management.multiplier(order)
                 approved_amount = raw_amount * multiplier
                 if multiplier < 1:
                     item_warnings.append(f"Medical management #{order}: {int(multiplier * 100)}% claimable.")
 
             # Bed charge cap
-            if "bed" in item.name.lower():
-                max_bed = Decimal(str(rules["general_rules"]["max_bed_charge_per_day"]))
+            if "bed" in item_name_lower:
+                max_bed = rules.max_bed_charge_per_day
                 if approved_amount > max_bed:
                     item_warnings.append(f"Bed charge capped at NPR {max_bed}/day.")
                     approved_amount = max_bed
@@ -221,18 +314,8 @@ def prevalidate_claim(
             claimable = approved_amount > 0
 
         # === Copayment (applied even to unknown items if approved > 0) ===
-        raw_copay = patient.copayment
-        if raw_copay is None:
-            copayment_decimal = Decimal("0")
-        else:
-            cleaned = str(raw_copay).replace("%", "").strip()
-            if not cleaned.replace(".", "", 1).replace("-", "", 1).isdigit():
-                item_warnings.append(f"Invalid copayment value: {raw_copay}")
-                copayment_decimal = Decimal("0")
-            else:
-                value = Decimal(cleaned)
-                copayment_decimal = value if value <= 1 else value / 100
-
+        if copay_warning:
+            item_warnings.append(copay_warning)
         copay_amount = approved_amount * copayment_decimal
 
         # Final item result
@@ -263,7 +346,7 @@ def prevalidate_claim(
         "total_approved_local": float(total_approved_local.quantize(Decimal("0.01"))),
         "total_copay": float(total_copay.quantize(Decimal("0.01"))),
         "net_claimable": float(net_claimable.quantize(Decimal("0.01"))),
-        "applied_rules_version": rules["rules_version"],
+        "applied_rules_version": rules.rules_version,
         "allowed_money": float(allowed_money),
         "used_money": float(used_money),
         "available_money": float(available_money),
@@ -0,0 +1,256 @@
+"""
+In-process metrics in the Prometheus text format, served by GET /metrics.
+
+Counters and histograms are updated where things happen (HTTP middleware,
+IMIS calls, DB cursor events, rule reloads); values that already live
+elsewhere (circuit breakers, IMIS caches, the rule snapshot) are read by
+collectors at scrape time. Each worker process keeps its own numbers, so
+every worker is scraped as its own target.
+"""
+import asyncio
+import logging
+import math
+import time
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Starlette appends "; charset=utf-8"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UPSTREAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+INF_BUCKET = 'le="+Inf"'
+
+# (labels, value) samples of one metric family
+Samples = Iterable[Tuple[Dict[str, str], float]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in values)
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, INF_BUCKET)} {_number(state[-1])}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(state[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {_number(state[-1])}")
+        return lines
+
+
+class Collector:
+    """A metric family read at scrape time: `collect` returns (labels, value) samples."""
+
+    def __init__(self, name: str, kind: str, documentation: str, collect: Callable[[], Samples]):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.collect():
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+        return lines
+
+
+_registry: List = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return register(Counter(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return register(Histogram(name, documentation, labelnames, buckets))
+
+
+def collector(name: str, kind: str, documentation: str):
+    """Decorator registering a scrape-time collector."""
+    def wrap(collect: Callable[[], Samples]):
+        register(Collector(name, kind, documentation, collect))
+        return collect
+    return wrap
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            logger.exception("Rendering metric %s failed", metric.name)
+    return "\n".join(lines) + "\n"
+
+
+http_request_duration = histogram(
+    "http_request_duration_seconds",
+    "Time from request to the end of the response body, per route template",
+    ("method", "route", "status"),
+)
+imis_request_duration = histogram(
+    "imis_request_duration_seconds",
+    "IMIS call latency per operation and HTTP status (error when no response arrived)",
+    ("operation", "status"),
+    UPSTREAM_BUCKETS,
+)
+db_query_duration = histogram(
+    "db_query_duration_seconds",
+    "Statement execution time per engine and statement kind",
+    ("engine", "statement"),
+    DB_BUCKETS,
+)
+event_loop_lag = histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke a sleeping task",
+    (),
+    LAG_BUCKETS,
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request up to its last body chunk, so
+    streamed responses are measured in full. Requests are labelled with the
+    route template ("/api/claims/patient/{patient_uuid}"), never the raw path.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=getattr(route, "path", None) or "unmatched",
+                status=status["code"],
+            )
+
+
+def _statement_kind(statement: str) -> str:
+    words = statement.lstrip().split(None, 1)
+    kind = words[0].lower() if words else ""
+    return kind if kind in ("select", "insert", "update", "delete", "pragma", "with") else "other"
+
+
+def instrument_engine(sync_engine, label: str):
+    """Times statements on a (sync) Engine; for an AsyncEngine pass its .sync_engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("metrics_started")
+        if started:
+            db_query_duration.observe(time.perf_counter() - started.pop(), engine=label, statement=_statement_kind(statement))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("metrics_started"):
+            conn.info["metrics_started"].pop()
+
+
+async def sample_event_loop_lag(interval: float = None):
+    """Sleeps `interval` seconds in a loop and records how much later than asked it woke up."""
+    interval = config.METRICS_LOOP_LAG_INTERVAL if interval is None else interval
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - started - interval))
@@ -0,0 +1,262 @@
+"""
+Patient and eligibility data for /patient/full-info, with a
+stale-while-revalidate mode: a stored PatientInformation row that is not too
+old is answered at once (flagged with its age) while a background task
+refreshes it from IMIS, and the last known good row is served when IMIS
+cannot be reached. A stored row is only ever served to the credentials IMIS
+last accepted for it; credentials IMIS rejects lose it. A row whose balance
+a submitted or adjudicated claim changed is refreshed before it is served.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from insurance_database import AsyncSessionLocal, PatientInformation
+from services import imis_services
+from services.circuit_breaker import CircuitOpenError
+from services.imis_parser import parse_eligibility_response
+
+logger = logging.getLogger(__name__)
+
+# Background refreshes in flight, one per patient
+_refreshing: Dict[str, asyncio.Task] = {}
+
+
+REJECTED_CREDENTIALS = (401, 403)
+
+
+class ImisUnavailable(Exception):
+    """IMIS could not answer; `error` is what to raise when nothing is stored."""
+
+    def __init__(self, error: HTTPException, reason: str = None):
+        self.error = error
+        super().__init__(reason or error.detail)
+
+
+async def fetch_from_imis(patient_identifier: str, username: str, password: str, client: httpx.AsyncClient) -> Dict[str, Any]:
+    """
+    Patient bundle and eligibility from IMIS. Raises HTTPException for an
+    answer that settles the request (patient unknown, credentials rejected)
+    and ImisUnavailable when IMIS is down, slow or failing.
+    """
+    try:
+        patient_info = await imis_services.get_patient_info(patient_identifier, username, password, client=client)
+    except (CircuitOpenError, httpx.HTTPError) as exc:
+        raise ImisUnavailable(HTTPException(status_code=503, detail=f"IMIS unavailable: {exc}")) from exc
+    if patient_info.get("status") in REJECTED_CREDENTIALS:
+        raise HTTPException(status_code=patient_info["status"], detail="IMIS rejected the credentials")
+    data = patient_info.get("data") or {}
+    entries = data.get("entry") or []
+    if not (patient_info.get("success") and len(entries) > 0):
+        error = HTTPException(status_code=404, detail="Patient not found in IMIS")
+        if (patient_info.get("status") or 0) >= 500:
+            raise ImisUnavailable(error, f"IMIS patient lookup failed ({patient_info.get('status')})")
+        raise error
+
+    try:
+        eligibility_raw = await imis_services.check_eligibility(
+            patient_identifier, username, password, client=client, patient_bundle=data
+        )
+    except (CircuitOpenError, httpx.HTTPError) as exc:
+        raise ImisUnavailable(HTTPException(status_code=503, detail=f"IMIS unavailable: {exc}")) from exc
+    if eligibility_raw.get("status") in REJECTED_CREDENTIALS:
+        raise HTTPException(status_code=eligibility_raw["status"], detail="IMIS rejected the credentials")
+    if not eligibility_raw.get("success"):
+        error = HTTPException(status_code=eligibility_raw.get("status", 500),
+                              detail="Eligibility request failed in IMIS")
+        if error.status_code >= 500:
+            raise ImisUnavailable(error, f"IMIS eligibility request failed ({error.status_code})")
+        raise error
+    return {"patient": data, "eligibility": eligibility_raw}
+
+
+async def load_patient(db: AsyncSession, patient_identifier: str) -> Optional[PatientInformation]:
+    return (await db.execute(
+        select(PatientInformation).filter_by(patient_code=patient_identifier).limit(1)
+    )).scalars().first()
+
+
+async def store_patient(
+    db: AsyncSession, patient_identifier: str, fetched: Dict[str, Any], credentials_digest: str
+) -> PatientInformation:
+    """
+    Creates or updates the patient's row from a fetch_from_imis result made
+    with the given credentials and commits.
+    """
+    data = fetched["patient"]
+    eligibility_raw = fetched["eligibility"]
+    resource = data["entry"][0]["resource"]
+    copayment = imis_services.extract_copayment(data)
+    parsed = parse_eligibility_response(eligibility_raw) or {}
+    birth_date_str = resource.get("birthDate")
+    values = dict(
+        patient_uuid=resource.get("id"),
+        name=" ".join(resource.get("name", [{}])[0].get("given", [])),
+        birth_date=datetime.strptime(birth_date_str, "%Y-%m-%d").date() if birth_date_str else None,
+        gender=resource.get("gender"),
+        copayment=copayment,
+        allowed_money=Decimal(str(parsed.get("allowed_money") or "0")),
+        used_money=Decimal(str(parsed.get("used_money") or "0")),
+        category=parsed.get("category"),
+        policy_id=parsed.get("policy_id"),
+        policy_expiry=parsed.get("policy_expiry"),
+        imis_full_response=data,
+        eligibility_raw=eligibility_raw,
+        eligibility_fetched_at=datetime.utcnow(),
+        credentials_digest=credentials_digest,
+        needs_refresh=False,
+    )
+
+    record = await load_patient(db, patient_identifier)
+    if not record:
+        record = PatientInformation(patient_code=patient_identifier, **values)
+        db.add(record)
+    else:
+        for name, value in values.items():
+            setattr(record, name, value)
+    try:
+        await db.commit()
+        await db.refresh(record)
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Failed to save patient eligibility: {str(e)}")
+    return record
+
+
+async def forget_credentials(db: AsyncSession, patient_identifier: str, credentials_digest: str):
+    """IMIS rejected these credentials: the stored row is no longer served to them."""
+    await db.execute(
+        update(PatientInformation)
+        .where(
+            PatientInformation.patient_code == patient_identifier,
+            PatientInformation.credentials_digest == credentials_digest,
+        )
+        .values(credentials_digest=None)
+    )
+    await db.commit()
+
+
+async def mark_needs_refresh(db: AsyncSession, patient_identifier: str, claimed: Decimal = Decimal("0")):
+    """
+    A claim IMIS accepted or adjudicated changed what the patient has used.
+    The stored used_money carries the claimed amount until the next refresh,
+    so prevalidation does not approve against the old balance, and
+    /patient/full-info asks IMIS instead of serving the row. The caller commits.
+    """
+    imis_services.invalidate_eligibility(patient_identifier)
+    await db.execute(
+        update(PatientInformation)
+        .where(PatientInformation.patient_code == patient_identifier)
+        .values(used_money=PatientInformation.used_money + claimed, needs_refresh=True)
+    )
+
+
+def record_age(record: PatientInformation) -> float:
+    """Seconds since the row's eligibility was fetched (rows stored before the column existed use created_at)."""
+    fetched_at = record.eligibility_fetched_at or record.created_at
+    if fetched_at is None:
+        return float("inf")
+    return max(0.0, (datetime.utcnow() - fetched_at).total_seconds())
+
+
+async def _refresh(patient_identifier: str, username: str, password: str):
+    digest = imis_services.credentials_digest(username, password)
+    try:
+        fetched = await fetch_from_imis(patient_identifier, username, password, imis_services.get_imis_client())
+        async with AsyncSessionLocal() as db:
+            await store_patient(db, patient_identifier, fetched, digest)
+    except HTTPException as exc:
+        if exc.status_code in REJECTED_CREDENTIALS:
+            async with AsyncSessionLocal() as db:
+                await forget_credentials(db, patient_identifier, digest)
+        logger.warning("Background eligibility refresh for %s rejected: %s", patient_identifier, exc.detail)
+    except ImisUnavailable as exc:
+        logger.warning("Background eligibility refresh for %s skipped: %s", patient_identifier, exc)
+    except Exception:
+        logger.exception("Background eligibility refresh for %s failed", patient_identifier)
+
+
+def schedule_refresh(patient_identifier: str, username: str, password: str) -> bool:
+    """Starts a background refresh unless one is already running for the patient."""
+    if patient_identifier in _refreshing:
+        return False
+    task = asyncio.create_task(_refresh(patient_identifier, username, password))
+    _refreshing[patient_identifier] = task
+    task.add_done_callback(lambda _: _refreshing.pop(patient_identifier, None))
+    return True
+
+
+def describe_patient(record: PatientInformation, source: str, revalidating: bool = False, error: str = None) -> Dict[str, Any]:
+    age = record_age(record)
+    body = {
+        "patient_code": record.patient_code,
+        "uuid": record.patient_uuid,
+        "name": record.name,
+        "birthDate": record.birth_date,
+        "gender": record.gender,
+        "copayment": str(record.copayment),
+        "allowed_money": str(record.allowed_money),
+        "used_money": str(record.used_money),
+        "category": record.category,
+        "policy_id": record.policy_id,
+        "policy_expiry": record.policy_expiry,
+        "imis": record.imis_full_response,
+        "eligibility": record.eligibility_raw,
+        "freshness": {
+            "source": source,
+            "fetched_at": (record.eligibility_fetched_at or record.created_at).isoformat()
+            if (record.eligibility_fetched_at or record.created_at) else None,
+            "age_seconds": round(age, 1) if age != float("inf") else None,
+            "stale": source == "stored" and age > config.ELIGIBILITY_FRESH_SECONDS,
+            "revalidating": revalidating,
+        },
+    }
+    if error:
+        body["freshness"]["imis_error"] = error
+    return body
+
+
+async def get_patient_full_info(
+    db: AsyncSession,
+    patient_identifier: str,
+    username: str,
+    password: str,
+    client: httpx.AsyncClient,
+    force_refresh: bool = False,
+) -> Dict[str, Any]:
+    digest = imis_services.credentials_digest(username, password)
+    record = None
+    if config.ELIGIBILITY_STALE_WHILE_REVALIDATE or config.ELIGIBILITY_OUTAGE_MAX_AGE > 0:
+        record = await load_patient(db, patient_identifier)
+        # Only credentials IMIS accepted for this row may read it without asking IMIS
+        if record is not None and record.credentials_digest != digest:
+            record = None
+
+    if record is not None and config.ELIGIBILITY_STALE_WHILE_REVALIDATE and not force_refresh and not record.needs_refresh:
+        age = record_age(record)
+        if age <= config.ELIGIBILITY_MAX_STALE_SECONDS:
+            revalidating = age > config.ELIGIBILITY_FRESH_SECONDS and (
+                schedule_refresh(patient_identifier, username, password) or patient_identifier in _refreshing
+            )
+            return describe_patient(record, "stored", revalidating=revalidating)
+
+    try:
+        fetched = await fetch_from_imis(patient_identifier, username, password, client)
+    except ImisUnavailable as exc:
+        if record is not None and record_age(record) <= config.ELIGIBILITY_OUTAGE_MAX_AGE:
+            return describe_patient(record, "stored", error=str(exc))
+        raise exc.error
+    except HTTPException as exc:
+        if record is not None and exc.status_code in REJECTED_CREDENTIALS:
+            await forget_credentials(db, patient_identifier, digest)
+        raise
+    record = await store_patient(db, patient_identifier, fetched, digest)
+    return describe_patient(record, "imis")
@@ -0,0 +1,74 @@
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+
+class AhoCorasick:
+    """
+    Multi-pattern substring matcher.
+
+    Built once from a list of patterns; find() scans a text in a single pass
+    and returns the indices of every pattern it contains, in pattern order.
+    Below `direct_threshold` patterns, plain C-level `in` checks beat a
+    Python-level automaton walk, so those sets are scanned directly. Results
+    are memoized per text because claim histories repeat the same names.
+    """
+
+    def __init__(self, patterns: Iterable[str], direct_threshold: int = 16, memo_size: int = 4096):
+        self.patterns: Tuple[str, ...] = tuple(patterns)
+        self._direct = len(self.patterns) < direct_threshold
+        self._memo: Dict[str, Tuple[int, ...]] = {}
+        self._memo_size = memo_size
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+
+        for index, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = nxt
+            self._out[state] += (index,)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> Tuple[int, ...]:
+        found = self._memo.get(text)
+        if found is None:
+            if self._direct:
+                found = tuple(i for i, p in enumerate(self.patterns) if p and p in text)
+            else:
+                found = self._scan(text)
+            if len(self._memo) >= self._memo_size:
+                self._memo.clear()
+            self._memo[text] = found
+        return found
+
+    def _scan(self, text: str) -> Tuple[int, ...]:
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return tuple(sorted(found))
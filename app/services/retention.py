@@ -0,0 +1,125 @@
+"""
+Data retention: one policy per table, each deleting rows older than its
+cutoff in bounded chunks (one short transaction per chunk, oldest rows
+first, by an indexed timestamp). Child rows go through the database's
+ON DELETE rules, so claim lines and ledger rows never outlive their claim.
+
+run_once is blocking; the lifespan task runs it in a worker thread.
+"""
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import delete, exists, select
+
+import config
+from insurance_database import ClaimDocument, ClaimOutbox, ImisResponse, PatientInformation, engine
+from services.claim_outbox import FINAL_STATUSES
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    name: str
+    model: Any
+    age_column: Any
+    max_age: timedelta
+    # Extra conditions a row must meet to be deleted, e.g. "no claims left"
+    conditions: Callable[[], List[Any]] = field(default=lambda: [])
+
+
+def policies() -> List[RetentionPolicy]:
+    """
+    Enabled policies in run order. Claim history goes before patients so a
+    patient whose last claim just expired is pruned in the same run.
+    """
+    candidates = [
+        (config.RETENTION_CLAIM_DAYS, lambda days: RetentionPolicy(
+            "claim_history", ImisResponse, ImisResponse.fetched_at, timedelta(days=days),
+        )),
+        (config.RETENTION_OUTBOX_DAYS, lambda days: RetentionPolicy(
+            "claim_outbox", ClaimOutbox, ClaimOutbox.completed_at, timedelta(days=days),
+            lambda: [ClaimOutbox.status.in_(FINAL_STATUSES)],
+        )),
+        (config.RETENTION_DOCUMENT_DAYS, lambda days: RetentionPolicy(
+            "documents", ClaimDocument, ClaimDocument.created_at, timedelta(days=days),
+        )),
+        (config.RETENTION_PATIENT_HOURS / 24, lambda days: RetentionPolicy(
+            "patients", PatientInformation, PatientInformation.created_at, timedelta(days=days),
+            # A patient is the parent of its claim history and of queued claims; keep it while either exists
+            lambda: [
+                ~exists().where(ImisResponse.patient_id == PatientInformation.patient_code),
+                ~exists().where(
+                    ClaimOutbox.patient_id == PatientInformation.patient_code,
+                    ClaimOutbox.status.notin_(FINAL_STATUSES),
+                ),
+            ],
+        )),
+    ]
+    return [make(age) for age, make in candidates if age > 0]
+
+
+def _delete_chunk(bind, policy: RetentionPolicy, cutoff: datetime, chunk_size: int) -> int:
+    pk = policy.model.__table__.c.id
+    with bind.begin() as conn:
+        ids = conn.execute(
+            select(pk)
+            .where(policy.age_column < cutoff, *policy.conditions())
+            .order_by(policy.age_column)
+            .limit(chunk_size)
+        ).scalars().all()
+        if ids:
+            conn.execute(delete(policy.model.__table__).where(pk.in_(ids)))
+    return len(ids)
+
+
+def apply_policy(bind, policy: RetentionPolicy, now: datetime = None) -> Dict[str, Any]:
+    now = now or datetime.utcnow()
+    cutoff = now - policy.max_age
+    started = time.perf_counter()
+    deleted = chunks = 0
+    while chunks < config.RETENTION_MAX_CHUNKS:
+        count = _delete_chunk(bind, policy, cutoff, config.RETENTION_CHUNK_SIZE)
+        if count:
+            deleted += count
+            chunks += 1
+        if count < config.RETENTION_CHUNK_SIZE:
+            break
+        # Let request transactions get at the database between chunks
+        time.sleep(config.RETENTION_CHUNK_PAUSE)
+    return {
+        "deleted": deleted,
+        "chunks": chunks,
+        "seconds": round(time.perf_counter() - started, 3),
+        "cutoff": cutoff.isoformat(),
+        # more rows are due than one run may delete; the next run continues
+        "incomplete": chunks >= config.RETENTION_MAX_CHUNKS,
+    }
+
+
+def run_once(bind=None) -> Dict[str, Any]:
+    """Applies every enabled policy and returns rows deleted and time taken per table."""
+    bind = bind or engine
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    tables = {}
+    for policy in policies():
+        try:
+            tables[policy.name] = apply_policy(bind, policy, started_at)
+        except Exception as exc:
+            logger.exception("Retention policy %s failed", policy.name)
+            tables[policy.name] = {"error": str(exc)}
+    report = {
+        "started_at": started_at.isoformat(),
+        "seconds": round(time.perf_counter() - started, 3),
+        "tables": tables,
+    }
+    logger.info(
+        "Retention run: %s in %.2fs",
+        ", ".join(f"{name}={result.get('deleted', 'error')}" for name, result in tables.items()) or "no policies",
+        report["seconds"],
+    )
+    return report
@@ -0,0 +1,112 @@
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+from services.pattern_matcher import AhoCorasick
+
+
+def _decimal(value, default=None) -> Optional[Decimal]:
+    if value is None:
+        return default
+    return Decimal(str(value))
+
+
+@dataclass(frozen=True)
+class CategoryRules:
+    """Per claim category (OPD / IPD / ER ...) switches with the validator defaults."""
+    ticket_valid_days: int = 7
+    submit_daily_after_service: bool = True
+    require_referral_for_inter_department: bool = True
+    submit_at_discharge: bool = True
+
+
+@dataclass(frozen=True)
+class ClaimPercentage:
+    """Share of the amount claimable for the first and any later disease, as multipliers."""
+    first_disease: Decimal
+    second_disease: Decimal
+
+    def multiplier(self, order: int) -> Decimal:
+        return self.first_disease if order == 1 else self.second_disease
+
+
+@dataclass(frozen=True)
+class NonCoveredRule:
+    name: str
+    name_lower: str
+    type: Optional[str]
+    claimable: bool
+    annual_cost_threshold_npr: Optional[Decimal]
+
+
+@dataclass(frozen=True)
+class CompiledRules:
+    rules_version: str
+    categories: Dict[str, CategoryRules]
+    surgery: ClaimPercentage
+    medical_management: ClaimPercentage
+    max_bed_charge_per_day: Decimal
+    non_covered: Tuple[NonCoveredRule, ...]
+    non_covered_matcher: AhoCorasick = field(repr=False, compare=False)
+    raw: Dict[str, Any] = field(repr=False, compare=False)
+
+    def category(self, name: str) -> CategoryRules:
+        return self.categories.get(name) or _DEFAULT_CATEGORY
+
+    def match_non_covered(self, name_lower: str) -> List[NonCoveredRule]:
+        """Non-covered entries whose name occurs in an (already lowercased) item name."""
+        return [self.non_covered[i] for i in self.non_covered_matcher.find(name_lower)]
+
+
+_DEFAULT_CATEGORY = CategoryRules()
+
+
+def _compile_category(rules: dict) -> CategoryRules:
+    require_referral = rules.get(
+        "require_referral_for_inter_department",
+        rules.get("require_referral_for_interdepartmental_consultation", True),
+    )
+    return CategoryRules(
+        ticket_valid_days=rules.get("ticket_valid_days", 7),
+        submit_daily_after_service=rules.get("submit_daily_after_service", True),
+        require_referral_for_inter_department=require_referral,
+        submit_at_discharge=rules.get("submit_at_discharge", True),
+    )
+
+
+def _compile_percentage(section: dict) -> ClaimPercentage:
+    pct = section["claim_percentage"]
+    return ClaimPercentage(
+        first_disease=_decimal(pct["first_disease"]) / 100,
+        second_disease=_decimal(pct.get("second_disease", 50)) / 100,
+    )
+
+
+def compile_rules(rules: dict) -> CompiledRules:
+    """
+    Turns validation_rules.json into typed, pre-converted structures so the
+    validator never walks nested dicts or parses numbers per claim line.
+    """
+    general = rules["general_rules"]
+    non_covered = tuple(
+        NonCoveredRule(
+            name=nc["name"],
+            name_lower=nc["name"].lower(),
+            type=nc.get("type"),
+            claimable=bool(nc["claimable"]),
+            annual_cost_threshold_npr=_decimal(nc.get("annual_cost_threshold_npr") or None),
+        )
+        for nc in rules["non_covered_services"]["items"]
+    )
+    return CompiledRules(
+        rules_version=rules["rules_version"],
+        categories={
+            name: _compile_category(section.get("rules", {}))
+            for name, section in rules["claim_categories"].items()
+        },
+        surgery=_compile_percentage(general["surgery"]),
+        medical_management=_compile_percentage(general["medical_management"]),
+        max_bed_charge_per_day=_decimal(general["max_bed_charge_per_day"]),
+        non_covered=non_covered,
+        non_covered_matcher=AhoCorasick(nc.name_lower for nc in non_covered),
+        raw=rules,
+    )
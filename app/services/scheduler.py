@@ -0,0 +1,199 @@
+"""
+Periodic jobs that run once per cluster rather than once per worker. Every
+worker polls each job; the one whose conditional UPDATE takes the job's
+lease in scheduled_jobs runs it, renews the lease while it runs and then
+moves next_run_at one interval ahead, so the other workers find nothing due.
+A lease held by a worker that died expires and the job is taken over.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+import config
+from insurance_database import AsyncSessionLocal, ScheduledJob
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+@dataclass(frozen=True)
+class Job:
+    name: str
+    run: Callable[[], Awaitable[Any]]
+    interval: float
+
+
+# Runs seen by this worker, per job
+stats: Dict[str, Dict[str, Any]] = {}
+
+
+def _stats(name: str) -> Dict[str, Any]:
+    return stats.setdefault(name, {
+        "runs": 0, "failures": 0, "not_due": 0,
+        "last_run_at": None, "last_duration": None,
+    })
+
+
+async def _ensure_row(name: str):
+    async with AsyncSessionLocal() as db:
+        if await db.get(ScheduledJob, name) is not None:
+            return
+        db.add(ScheduledJob(name=name, next_run_at=datetime.utcnow()))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # another worker created it first
+            await db.rollback()
+
+
+async def _acquire(job: Job) -> Optional[datetime]:
+    """Takes the job's lease if the job is due and nobody holds it; the run's start time on success."""
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(ScheduledJob)
+            .where(
+                ScheduledJob.name == job.name,
+                ScheduledJob.next_run_at <= now,
+                or_(ScheduledJob.lease_until.is_(None), ScheduledJob.lease_until < now),
+            )
+            .values(
+                owner=WORKER_ID,
+                lease_until=now + timedelta(seconds=config.SCHEDULER_LEASE_SECONDS),
+                last_started_at=now,
+            )
+        )
+        await db.commit()
+    return now if result.rowcount == 1 else None
+
+
+async def _renew_lease(name: str):
+    while True:
+        await asyncio.sleep(config.SCHEDULER_LEASE_SECONDS / 3)
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(ScheduledJob)
+                    .where(ScheduledJob.name == name, ScheduledJob.owner == WORKER_ID)
+                    .values(lease_until=datetime.utcnow() + timedelta(seconds=config.SCHEDULER_LEASE_SECONDS))
+                )
+                await db.commit()
+        except Exception:
+            logger.exception("Renewing the lease of job %s failed", name)
+
+
+async def _finish(job: Job, started_at: datetime, duration: float, error: Optional[str], result: Any):
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(ScheduledJob)
+            .where(ScheduledJob.name == job.name, ScheduledJob.owner == WORKER_ID)
+            .values(
+                owner=None,
+                lease_until=None,
+                next_run_at=max(now, started_at + timedelta(seconds=job.interval)),
+                last_finished_at=now,
+                last_status="failed" if error else "succeeded",
+                last_duration=round(duration, 3),
+                last_error=error,
+                last_result=result,
+                runs=ScheduledJob.runs + 1,
+                failures=ScheduledJob.failures + (1 if error else 0),
+            )
+        )
+        await db.commit()
+
+
+async def run_if_due(job: Job) -> bool:
+    """Runs the job if this worker gets its lease; False when it was not due or ran elsewhere."""
+    job_stats = _stats(job.name)
+    started_at = await _acquire(job)
+    if started_at is None:
+        job_stats["not_due"] += 1
+        return False
+
+    heartbeat = asyncio.create_task(_renew_lease(job.name))
+    started = time.perf_counter()
+    error = result = None
+    try:
+        result = await job.run()
+    except Exception as exc:
+        logger.exception("Scheduled job %s failed", job.name)
+        error = str(exc) or type(exc).__name__
+    finally:
+        heartbeat.cancel()
+    duration = time.perf_counter() - started
+
+    job_stats["runs"] += 1
+    job_stats["failures"] += 1 if error else 0
+    job_stats["last_run_at"] = started_at.isoformat()
+    job_stats["last_duration"] = round(duration, 3)
+    logger.info("Scheduled job %s %s in %.2fs", job.name, "failed" if error else "finished", duration)
+    await _finish(job, started_at, duration, error, result)
+    return True
+
+
+async def _job_loop(job: Job):
+    poll = min(job.interval, config.SCHEDULER_POLL_INTERVAL)
+    await asyncio.sleep(random.uniform(0, config.SCHEDULER_JITTER))
+    await _ensure_row(job.name)
+    while True:
+        try:
+            await run_if_due(job)
+        except Exception:
+            if asyncio.current_task().cancelling():
+                # Shutdown interrupted a DB call and the driver's cleanup raised
+                raise asyncio.CancelledError
+            logger.exception("Scheduler check of job %s failed", job.name)
+        await asyncio.sleep(poll + random.uniform(0, config.SCHEDULER_JITTER))
+
+
+async def run(jobs: List[Job]):
+    """Polls every enabled job (interval > 0) until cancelled."""
+    loops = [asyncio.create_task(_job_loop(job)) for job in jobs if job.interval > 0]
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        for loop in loops:
+            loop.cancel()
+
+
+def _describe(row: ScheduledJob) -> Dict[str, Any]:
+    return {
+        "name": row.name,
+        "owner": row.owner,
+        "running": row.lease_until is not None and row.lease_until > datetime.utcnow(),
+        "next_run_at": row.next_run_at.isoformat() if row.next_run_at else None,
+        "last_started_at": row.last_started_at.isoformat() if row.last_started_at else None,
+        "last_finished_at": row.last_finished_at.isoformat() if row.last_finished_at else None,
+        "last_status": row.last_status,
+        "last_duration": row.last_duration,
+        "last_error": row.last_error,
+        "last_result": row.last_result,
+        "runs": row.runs,
+        "failures": row.failures,
+        "this_worker": stats.get(row.name),
+    }
+
+
+async def job_state(name: str) -> Optional[Dict[str, Any]]:
+    async with AsyncSessionLocal() as db:
+        row = await db.get(ScheduledJob, name)
+    return _describe(row) if row is not None else None
+
+
+async def job_states() -> List[Dict[str, Any]]:
+    """Cluster-wide state of every job from scheduled_jobs, with this worker's counters."""
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(select(ScheduledJob).order_by(ScheduledJob.name))).scalars().all()
+    return [_describe(row) for row in rows]
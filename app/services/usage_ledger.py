@@ -0,0 +1,207 @@
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import config
+from insurance_database import ImisResponse, PatientUsageLedger
+from rule_loader import get_compiled_rules
+from services.rule_engine import CompiledRules
+
+# Claims in these states never consumed any of the patient's limits
+EXCLUDED_STATUSES = ("rejected", "unknown")
+# Patients per IN (...) list in bulk queries, well under SQLite's bound-parameter limit
+BULK_CHUNK = 500
+
+
+def fiscal_year_start(day: date) -> date:
+    start = date(day.year, config.FISCAL_YEAR_START_MONTH, config.FISCAL_YEAR_START_DAY)
+    if day < start:
+        start = start.replace(year=day.year - 1)
+    return start
+
+
+def non_covered_buckets(rules: CompiledRules, item_name: str) -> List[str]:
+    """
+    Every non-claimable non-covered entry matching the item name, in rule
+    order; the evaluator checks the annual limit of each one.
+    """
+    buckets = []
+    for nc in rules.match_non_covered((item_name or "").lower()):
+        if not nc.claimable and nc.name not in buckets:
+            buckets.append(nc.name)
+    return buckets
+
+
+def _ledger_rows(rules: CompiledRules, imis_record: ImisResponse, lines: Iterable[dict], service_date: date) -> List[PatientUsageLedger]:
+    rows = []
+    for line in lines:
+        if not line.get("item_code"):
+            continue
+        qty = int(Decimal(str(line.get("qty", 0) or 0)))
+        cost = Decimal(str(line.get("cost", line.get("rate", 0)) or 0))
+        buckets = non_covered_buckets(rules, line.get("name", "")) or [None]
+        for i, bucket in enumerate(buckets):
+            rows.append(PatientUsageLedger(
+                patient_code=imis_record.patient_id,
+                imis_response_id=imis_record.id,
+                item_code=str(line["item_code"]),
+                service_date=service_date,
+                # further buckets carry the spend only, so units are counted once
+                qty=qty if i == 0 else 0,
+                amount=qty * cost,
+                non_covered=bucket,
+            ))
+    return rows
+
+
+async def record_claim_usage(db: AsyncSession, imis_record: ImisResponse, service_date: date) -> List[PatientUsageLedger]:
+    """
+    Adds ledger rows for a freshly stored ImisResponse (flushes to get its id).
+    The caller owns the transaction.
+    """
+    if imis_record.id is None:
+        await db.flush()
+    rows = _ledger_rows(get_compiled_rules(), imis_record, imis_record.item_code or [], service_date)
+    db.add_all(rows)
+    return rows
+
+
+def _counted(stmt, patient_code: str):
+    return (
+        stmt.join(ImisResponse, ImisResponse.id == PatientUsageLedger.imis_response_id)
+        .where(PatientUsageLedger.patient_code == patient_code)
+        .where(ImisResponse.status.notin_(EXCLUDED_STATUSES))
+    )
+
+
+async def units_by_item(db: AsyncSession, patient_code: str, item_codes: Iterable[str], start: date, end: date) -> Dict[str, Decimal]:
+    """Units of each item used by the patient between start and end (inclusive)."""
+    codes = list({str(c) for c in item_codes})
+    if not codes:
+        return {}
+    stmt = (
+        _counted(select(PatientUsageLedger.item_code, func.sum(PatientUsageLedger.qty)), patient_code)
+        .where(PatientUsageLedger.item_code.in_(codes))
+        .where(PatientUsageLedger.service_date.between(start, end))
+        .group_by(PatientUsageLedger.item_code)
+    )
+    rows = (await db.execute(stmt)).all()
+    return {code: Decimal(str(total or 0)) for code, total in rows}
+
+
+async def units_in_window(db: AsyncSession, patient_code: str, item_code: str, start: date, end: date) -> Decimal:
+    return (await units_by_item(db, patient_code, [item_code], start, end)).get(str(item_code), Decimal("0"))
+
+
+async def spend_by_bucket(db: AsyncSession, patient_code: str, start: date, end: date) -> Dict[str, Decimal]:
+    """Amount spent per non-covered bucket between start and end (inclusive)."""
+    stmt = (
+        _counted(select(PatientUsageLedger.non_covered, func.sum(PatientUsageLedger.amount)), patient_code)
+        .where(PatientUsageLedger.non_covered.isnot(None))
+        .where(PatientUsageLedger.service_date.between(start, end))
+        .group_by(PatientUsageLedger.non_covered)
+    )
+    rows = (await db.execute(stmt)).all()
+    return {bucket: Decimal(str(total or 0)) for bucket, total in rows}
+
+
+async def spend_in_period(db: AsyncSession, patient_code: str, bucket: str, start: date, end: date) -> Decimal:
+    return (await spend_by_bucket(db, patient_code, start, end)).get(bucket, Decimal("0"))
+
+
+def _counted_many(stmt, patient_codes: List[str]):
+    return (
+        stmt.join(ImisResponse, ImisResponse.id == PatientUsageLedger.imis_response_id)
+        .where(PatientUsageLedger.patient_code.in_(patient_codes))
+        .where(ImisResponse.status.notin_(EXCLUDED_STATUSES))
+    )
+
+
+async def daily_units_by_item(
+    db: AsyncSession, patient_codes: Iterable[str], item_codes: Iterable[str], start: date, end: date
+) -> Dict[Tuple[str, str], List[Tuple[date, Decimal]]]:
+    """
+    Units per (patient, item) and service day between start and end, for many
+    patients at once; callers sum the days inside each claim's own window.
+    """
+    patients, codes = sorted(set(patient_codes)), list({str(c) for c in item_codes})
+    usage = defaultdict(list)
+    if not codes:
+        return usage
+    for i in range(0, len(patients), BULK_CHUNK):
+        stmt = (
+            _counted_many(
+                select(
+                    PatientUsageLedger.patient_code, PatientUsageLedger.item_code,
+                    PatientUsageLedger.service_date, func.sum(PatientUsageLedger.qty),
+                ),
+                patients[i:i + BULK_CHUNK],
+            )
+            .where(PatientUsageLedger.item_code.in_(codes))
+            .where(PatientUsageLedger.service_date.between(start, end))
+            .group_by(PatientUsageLedger.patient_code, PatientUsageLedger.item_code, PatientUsageLedger.service_date)
+        )
+        for patient, code, day, total in (await db.execute(stmt)).all():
+            usage[(patient, code)].append((day, Decimal(str(total or 0))))
+    return usage
+
+
+async def daily_spend_by_bucket(
+    db: AsyncSession, patient_codes: Iterable[str], start: date, end: date
+) -> Dict[str, List[Tuple[str, date, Decimal]]]:
+    """Non-covered spend per patient as (bucket, service day, amount) rows between start and end."""
+    patients = sorted(set(patient_codes))
+    spend = defaultdict(list)
+    for i in range(0, len(patients), BULK_CHUNK):
+        stmt = (
+            _counted_many(
+                select(
+                    PatientUsageLedger.patient_code, PatientUsageLedger.non_covered,
+                    PatientUsageLedger.service_date, func.sum(PatientUsageLedger.amount),
+                ),
+                patients[i:i + BULK_CHUNK],
+            )
+            .where(PatientUsageLedger.non_covered.isnot(None))
+            .where(PatientUsageLedger.service_date.between(start, end))
+            .group_by(PatientUsageLedger.patient_code, PatientUsageLedger.non_covered, PatientUsageLedger.service_date)
+        )
+        for patient, bucket, day, total in (await db.execute(stmt)).all():
+            spend[patient].append((bucket, day, Decimal(str(total or 0))))
+    return spend
+
+
+def backfill_usage_ledger(db: Session, batch_size: int = 500) -> int:
+    """
+    Builds ledger rows for stored claims that predate the ledger, from the
+    JSON item lists. Their visit date was never stored, so fetched_at is used.
+    """
+    rules = get_compiled_rules()
+    has_rows = db.query(PatientUsageLedger.id).filter(PatientUsageLedger.imis_response_id == ImisResponse.id).exists()
+    created = 0
+    last_id = 0
+    while True:
+        claims = (
+            db.query(ImisResponse)
+            .filter(ImisResponse.id > last_id)
+            .filter(~has_rows)
+            .order_by(ImisResponse.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not claims:
+            return created
+        for claim in claims:
+            stamp = claim.fetched_at or claim.created_at
+            if stamp is None:
+                continue
+            rows = _ledger_rows(rules, claim, claim.item_code or [], stamp.date())
+            db.add_all(rows)
+            created += len(rows)
+        last_id = claims[-1].id
+        db.commit()
+
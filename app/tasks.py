@@ -1,21 +1,23 @@
 import asyncio
-from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
-from insurance_database import SessionLocal,PatientInformation
+import config
+from services import retention
+from services.claim_status_sync import sync_pending_claims
+from services.scheduler import Job
 
-async def prune_old_patients():
-    while True:
-        db = SessionLocal()
-        try:
-            cutoff = datetime.utcnow() - timedelta(hours=24)
-            db.query(PatientInformation)\
-              .filter(PatientInformation.created_at < cutoff)\
-              .delete(synchronize_session=False)
-            db.commit()
-        except Exception:
-            db.rollback()
-            raise
-        finally:
-            db.close()
 
-        await asyncio.sleep(3600)
+async def run_retention():
+    """
+    Applies the retention policies (patients, claim history, documents,
+    claim outbox). The deletes are blocking and run in a worker thread, in
+    bounded chunks.
+    """
+    return await asyncio.to_thread(retention.run_once)
+
+
+# Periodic jobs, each run once per cluster by services.scheduler. Per-host work
+# (rebuilding catalog.bin) runs in every worker instead, from the lifespan.
+JOBS = [
+    Job("retention", run_retention, config.RETENTION_INTERVAL),
+    # needs the IMIS service account
+    Job("claim_status_sync", sync_pending_claims, config.CLAIM_SYNC_INTERVAL if config.IMIS_SYNC_USERNAME else 0),
+]
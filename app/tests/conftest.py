@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The app imports modules from its own directory and creates tables on import;
+# point it at a throwaway database before anything is imported.
+APP_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(APP_DIR))
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(tempfile.mkdtemp()) / 'test.db'}"
+os.environ.setdefault("MY_API_KEYS", "test")
+os.environ.setdefault("OUTBOX_CREDENTIALS_KEY", "GJ2WkJ0E9v1dQH3x0yW3U8hC0x8t7kM6n8s1vV3qk2Y=")
@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import httpx
+
+from insurance_database import AsyncSessionLocal, ClaimOutbox, PatientInformation
+from model import ClaimInput
+from services import claim_outbox, imis_services
+
+ACSN = "a" * 32
+
+
+def _claim(acsn, claim_id, mr="MR1"):
+    return {
+        "resourceType": "Claim",
+        "id": claim_id,
+        "identifier": [
+            {"type": {"coding": [{"code": "ACSN"}]}, "value": acsn},
+            {"type": {"coding": [{"code": "MR"}]}, "value": mr},
+        ],
+        "created": "2026-10-18",
+    }
+
+
+def _lookup(handler):
+    entry = ClaimOutbox(acsn=ACSN, username="u", password=claim_outbox.seal_password("p"))
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return asyncio.run(claim_outbox._lookup_existing(entry, client))
+
+
+def test_lookup_ignores_a_different_claim():
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        return httpx.Response(200, json={"entry": [{"resource": _claim("b" * 32, "other-claim")}]})
+
+    assert _lookup(handler) is None
+    assert requests == ["/api/api_fhir/Claim/"]
+
+
+def test_lookup_returns_the_claim_response_of_the_matching_claim():
+    response = {
+        "resourceType": "ClaimResponse",
+        "id": "claim-uuid",
+        "identifier": [{"type": {"coding": [{"code": "MR"}]}, "value": "MR1"}],
+        "created": "2026-10-18",
+        "outcome": {"text": "entered"},
+    }
+
+    def handler(request):
+        if request.url.path.endswith("/Claim/"):
+            return httpx.Response(200, json={"entry": [
+                {"resource": _claim("b" * 32, "other-claim")},
+                {"resource": _claim(ACSN, "claim-uuid")},
+            ]})
+        assert request.url.path.endswith("/ClaimResponse/claim-uuid")
+        return httpx.Response(200, json=response)
+
+    assert json.loads(_lookup(handler)) == response
+
+
+def test_lookup_without_claim_response_stores_a_pending_status():
+    def handler(request):
+        if request.url.path.endswith("/Claim/"):
+            return httpx.Response(200, json={"entry": [{"resource": _claim(ACSN, "claim-uuid")}]})
+        return httpx.Response(404)
+
+    stored = json.loads(_lookup(handler))
+    assert stored["id"] == "claim-uuid"
+    assert stored["outcome"]["text"] == "entered"
+
+
+def test_password_is_stored_encrypted():
+    sealed = claim_outbox.seal_password("secret")
+    assert "secret" not in sealed
+    assert claim_outbox._credentials(ClaimOutbox(username="u", password=sealed)) == ("u", "secret")
+
+
+def test_racing_identical_requests_share_one_entry(monkeypatch):
+    claim = ClaimInput(
+        username="u", password="p", patient_id="RACE1", visit_date="2026-10-18", service_type="OPD",
+        diagnosis={}, icd_codes=["A00"], claimable_items=[], hospital_type="government",
+        claim_time="same_day", claim_code=None, department=None,
+    )
+    patient = PatientInformation(patient_code="RACE1", patient_uuid="patient-uuid")
+    by_key = claim_outbox._by_key
+    calls = []
+
+    async def racing_by_key(db, ikey):
+        # The second request looked the key up before the first one committed
+        calls.append(ikey)
+        return None if len(calls) == 1 else await by_key(db, ikey)
+
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            first, first_created = await claim_outbox.enqueue(db, claim, patient)
+        monkeypatch.setattr(claim_outbox, "_by_key", racing_by_key)
+        async with AsyncSessionLocal() as db:
+            second, second_created = await claim_outbox.enqueue(db, claim, patient)
+        return first.id, first_created, second.id, second_created
+
+    first_id, first_created, second_id, second_created = asyncio.run(scenario())
+    assert first_created and not second_created
+    assert first_id == second_id
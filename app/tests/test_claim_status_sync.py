@@ -0,0 +1,124 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import httpx
+
+from insurance_database import AsyncSessionLocal, ImisResponse, PatientInformation
+from services import claim_status_sync
+from services.claim_status_sync import FAILED, NOT_FOUND, UPDATED
+
+# ClaimResponse as IMIS returns it (trimmed to the fields the sync reads, plus a few around them)
+CLAIM_RESPONSE = {
+    "resourceType": "ClaimResponse",
+    "id": "claim-uuid",
+    "identifier": [
+        {"type": {"coding": [{"system": "https://openimis.github.io/openimis_fhir_r4_ig/CodeSystem/openimis-identifiers", "code": "UUID"}]},
+         "value": "claim-uuid"},
+        {"type": {"coding": [{"system": "https://hl7.org/fhir/valueset-identifier-type.html", "code": "MR"}]},
+         "value": "MR1"},
+    ],
+    "created": "2026-10-10",
+    "request": {"reference": "Claim/claim-uuid"},
+    "outcome": {"coding": [{"code": "16"}], "text": "valuated"},
+    "totalBenefit": {"value": 600.0},
+    "addItem": [
+        {"sequenceLinkId": [1], "service": {"coding": [{"code": "LAB01"}]}, "fee": {"value": 300.0}},
+        {"sequenceLinkId": [2], "service": {"coding": [{"code": "MED02"}]}, "fee": {"value": 50.0}},
+    ],
+    "item": [
+        {"sequenceLinkId": 1, "adjudication": [
+            {"category": {"coding": [{"code": "general"}], "text": "general"},
+             "reason": {"coding": [{"code": "0"}], "text": "accepted"}, "amount": {"value": 600.0}},
+        ]},
+        {"sequenceLinkId": 2, "adjudication": [
+            {"category": {"coding": [{"code": "general"}], "text": "general"},
+             "reason": {"coding": [{"code": "1"}], "text": "rejected"}, "amount": {"value": 0.0}},
+        ]},
+    ],
+}
+
+
+def _claim(claim_id, mr, patient_uuid):
+    return {
+        "resourceType": "Claim",
+        "id": claim_id,
+        "identifier": [{"type": {"coding": [{"code": "MR"}]}, "value": mr}],
+        "patient": {"reference": f"Patient/{patient_uuid}"},
+    }
+
+
+def _row(**values):
+    row = dict(id=1, patient_id="P1", claim_code="MR1", status="entered", items=[],
+               fetched_at=datetime.utcnow(), imis_id=None, patient_uuid="patient-uuid")
+    row.update(values)
+    return SimpleNamespace(**row)
+
+
+def _check(row, handler):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return asyncio.run(claim_status_sync._check(row, client, asyncio.Semaphore(1)))
+
+
+def test_stored_imis_id_reads_the_claim_response():
+    def handler(request):
+        assert request.url.path.endswith("/ClaimResponse/claim-uuid")
+        return httpx.Response(200, json=CLAIM_RESPONSE)
+
+    outcome, parsed = _check(_row(imis_id="claim-uuid"), handler)
+    assert outcome == UPDATED
+    assert parsed["status"] == "valuated"
+    assert [(i["sequence_id"], i["item_code"], i["status"]) for i in parsed["items"]] == [
+        (1, "LAB01", "accepted"), (2, "MED02", "rejected"),
+    ]
+
+
+def test_a_claim_instead_of_a_claim_response_is_a_failure():
+    def handler(request):
+        return httpx.Response(200, json=_claim("claim-uuid", "MR1", "patient-uuid"))
+
+    assert _check(_row(imis_id="claim-uuid"), handler) == (FAILED, None)
+
+
+def test_claim_code_search_skips_other_facilities_claims():
+    def handler(request):
+        if request.url.path.endswith("/Claim/"):
+            return httpx.Response(200, json={"entry": [
+                {"resource": _claim("someone-else", "MR1", "other-patient")},
+                {"resource": _claim("claim-uuid", "MR1", "patient-uuid")},
+            ]})
+        assert request.url.path.endswith("/ClaimResponse/claim-uuid")
+        return httpx.Response(200, json=CLAIM_RESPONSE)
+
+    outcome, parsed = _check(_row(), handler)
+    assert outcome == UPDATED and parsed["status"] == "valuated"
+
+
+def test_claim_code_search_without_a_match_is_not_found():
+    def handler(request):
+        return httpx.Response(200, json={"entry": [
+            {"resource": _claim("someone-else", "MR1", "other-patient")},
+            {"resource": _claim("near-match", "MR10", "patient-uuid")},
+        ]})
+
+    assert _check(_row(), handler) == (NOT_FOUND, None)
+
+
+def test_failed_lookups_are_not_polled_again_at_once():
+    old = datetime.utcnow() - timedelta(days=1)
+
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            db.add(PatientInformation(patient_code="SYNC1", patient_uuid="patient-uuid"))
+            db.add(ImisResponse(patient_id="SYNC1", claim_code="MR1", status="entered", fetched_at=old,
+                                raw_response={"id": "claim-uuid"}))
+            await db.commit()
+        client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(403)))
+        report = await claim_status_sync.sync_pending_claims(client)
+        async with AsyncSessionLocal() as db:
+            claim = (await db.execute(ImisResponse.__table__.select().where(ImisResponse.patient_id == "SYNC1"))).first()
+        return report, claim
+
+    report, claim = asyncio.run(scenario())
+    assert report[FAILED] == 1
+    assert claim.fetched_at > old
@@ -0,0 +1,29 @@
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+
+from services.rule_engine import NonCoveredRule
+from services.usage_ledger import _ledger_rows
+
+
+def _rule(name, claimable=False, threshold=None):
+    return NonCoveredRule(name=name, name_lower=name.lower(), type=None, claimable=claimable,
+                          annual_cost_threshold_npr=threshold)
+
+
+def test_a_line_in_two_buckets_is_spent_in_both_and_counted_once():
+    entries = [_rule("dental"), _rule("claimable dental", claimable=True), _rule("dental implant", threshold=Decimal("5000"))]
+    rules = SimpleNamespace(match_non_covered=lambda name: [e for e in entries if e.name_lower in name])
+    claim = SimpleNamespace(patient_id="P1", id=7)
+    lines = [
+        {"item_code": "D1", "name": "Dental implant crown", "qty": 2, "cost": 1500},
+        {"item_code": "X1", "name": "X-ray", "qty": 1, "cost": 300},
+    ]
+
+    rows = _ledger_rows(rules, claim, lines, date(2026, 10, 18))
+
+    assert [(r.item_code, r.non_covered, r.qty, r.amount) for r in rows] == [
+        ("D1", "dental", 2, Decimal("3000")),
+        ("D1", "dental implant", 0, Decimal("3000")),
+        ("X1", None, 1, Decimal("300")),
+    ]